@@ -4,11 +4,8 @@ import logging
 import time
 from itertools import islice
 import os
-
-try:
-    import numpy as np
-except:
-    print("Can run without Numpy but will be slower")
+from profiler import profiler
+from gcode_io import open_gcode, split_compression, is_binary
 
 class GcodeParser:
     """
@@ -26,16 +23,45 @@ class GcodeParser:
         Opens and reads the GCODE file
         incrementing a line counter,
         removing trailing linefeed and
-        parsing the line.
+        parsing the line. Compressed files (.gz, .bz2,
+        .xz, .zst) are decompressed as they are read,
+        binary G-code (.gcb) is decoded.
+        """
+        if is_binary(path):
+            from gcode_binary import parse_binary
+
+            with open_gcode(path, "rb") as f:
+                return parse_binary(self, f)
+        with open_gcode(path, "r") as f:
+            return self.parse_lines(f)
+
+    def parse_layers(self, path, first, last=None, index=None):
         """
-        with open(path, "r") as f:
+        Parses only layers first..last (inclusive) of a plain text
+        GCODE file, seeking straight to the first of them with the
+        layer index of the file (built and saved next to it if
+        missing or out of date).
+        """
+        from layer_index import LayerIndex
+
+        if index is None:
+            index = LayerIndex.open(path)
+        return index.parse(self, first, last)
+
+    def parse_lines(self, lines):
+        """
+        Parses an iterable of GCODE lines,
+        e.g. an open file or a list of strings.
+        """
+        with profiler.stage("parse") as stage:
             self.line_num = 0
-            for line in f:
+            for line in lines:
                 self.line_num += 1
                 self.line = line.rstrip()
                 self.parse_line()
 
-        self.model.post_process()
+            self.model.post_process()
+            stage.add(self.line_num)
         return self.model
 
     def parse_line(self):
@@ -99,6 +125,18 @@ class GcodeParser:
         """
         self.model.do_G1(self.parse_args(args), type)
 
+    def parse_G2(self, args, type="G2"):
+        """
+        G2 - clockwise arc
+        """
+        self.model.do_G2(self.parse_args(args), type)
+
+    def parse_G3(self, args):
+        """
+        G3 - counter-clockwise arc
+        """
+        self.parse_G2(args, "G3")
+
     def parse_G20(self, args):
         """
         G20 - set units to inches
@@ -272,12 +310,51 @@ class GcodeModel:
 
         self.relative_extrusion = False
 
+        # coords before the first segment and (layer index, layer Z) in effect,
+        # only set when parsing starts part way through a file
+        self.start = None
+        self.start_layer = (0, 0)
+
+        # columnar index of the lines for query(), built on first use
+        self.line_index = None
+
     def write(self, file_path):
-        with open(file_path, "w+") as fp:
-            for layer in self.layers:
-                for segment in layer.lines:
-                    fp.write(segment.line)
-                    fp.write("\n")
+        if is_binary(file_path):
+            from gcode_binary import write_binary
+
+            with profiler.stage("write") as stage:
+                with open_gcode(file_path, "wb") as fp:
+                    write_binary(self.iter_lines(), fp)
+                stage.add(sum(len(layer.lines) for layer in self.layers))
+            return
+        with profiler.stage("write") as stage:
+            with open_gcode(file_path, "w") as fp:
+                for layer in self.layers:
+                    for segment in layer.lines:
+                        fp.write(segment.line)
+                        fp.write("\n")
+                    stage.add(len(layer.lines))
+
+    def iter_lines(self):
+        """
+        Yields the GCODE text of every line of the model,
+        layer by layer, without the trailing linefeed.
+        """
+        for layer in self.layers:
+            for segment in layer.lines:
+                yield segment.line
+
+    def query(self, refresh=False):
+        """
+        Query over all the lines of the model, see model_query.Query.
+        The index behind it is kept until the layers change, pass
+        refresh after editing lines in place.
+        """
+        from model_query import LineIndex, Query
+
+        if refresh or self.line_index is None or not self.line_index.matches(self):
+            self.line_index = LineIndex(self)
+        return Query(self.line_index)
 
     def add_comment(self, _comment):
         """ """
@@ -321,6 +398,21 @@ class GcodeModel:
         # update model coords
         self.relative = coords
 
+    def do_G2(self, args, type):
+        """
+        G2/G3: Clockwise/counter-clockwise arc in the XY plane,
+        around the centre at the I/J offsets from the start or
+        with radius R
+        """
+        centre = {axis: args.pop(axis) for axis in ("I", "J", "R") if axis in args}
+        start = {
+            axis: self.offset.get(axis, 0.0) + self.relative[axis]
+            for axis in self.relative
+        }
+        self.do_G1(args, type)
+        seg = self.segments[-1]
+        self.segments[-1] = Arc(type, seg.coords, seg.line_num, seg.line, start, centre)
+
     def do_G21(self, args):
         """
         G21: set units to millimeters
@@ -470,6 +562,11 @@ class GcodeModel:
         """
         self.parser.error(msg)
 
+    def start_coords(self):
+        if self.start is not None:
+            return dict(self.start)
+        return {"X": 0.0, "Y": 0.0, "Z": 0.0, "F": 0.0, "E": 0.0}
+
     def classify_segments(self):
         """
         Applies intelligence (rough rules of thumb ;) )
@@ -477,11 +574,10 @@ class GcodeModel:
         """
 
         # start model at 0
-        coords = {"X": 0.0, "Y": 0.0, "Z": 0.0, "F": 0.0, "E": 0.0}
+        coords = self.start_coords()
 
         # first layer at Z=0
-        current_layer_idx = 0
-        currentLayerZ = 0
+        current_layer_idx, currentLayerZ = self.start_layer
 
         for seg in self.segments:
             if not isinstance(seg, Segment):
@@ -490,9 +586,13 @@ class GcodeModel:
             # default style is fly (move, no extrusion)
             style = "fly"
 
+            # full circle arcs end where they start but still move
+            circle = isinstance(seg, Arc) and abs(seg.sweep) == 2 * math.pi
+
             # no horizontal movement, but extruder movement: retraction/refill
             if (
-                (seg.coords["X"] == coords["X"])
+                not circle
+                and (seg.coords["X"] == coords["X"])
                 and (seg.coords["Y"] == coords["Y"])
                 and (seg.coords["E"] != coords["E"])
             ):
@@ -503,6 +603,8 @@ class GcodeModel:
                 (seg.coords["X"] != coords["X"])
                 or (seg.coords["Y"] != coords["Y"])
                 and (seg.coords["E"] > coords["E"])
+                or circle
+                and (seg.coords["E"] > coords["E"])
             ):
                 style = "extrude"
 
@@ -525,7 +627,7 @@ class GcodeModel:
         """
 
         # start model at 0
-        coords = {"X": 0.0, "Y": 0.0, "Z": 0.0, "F": 0.0, "E": 0.0}
+        coords = self.start_coords()
 
         # init layer store
         self.layers = []
@@ -589,10 +691,15 @@ class GcodeModel:
                     continue
 
                 # calc XYZ distance
-                d = (line.coords["X"] - coords["X"]) ** 2
-                d += (line.coords["Y"] - coords["Y"]) ** 2
-                d += (line.coords["Z"] - coords["Z"]) ** 2
-                line.distance = math.sqrt(d)
+                if isinstance(line, Arc):
+                    line.distance = line.length()
+                    for point in line.extremes():
+                        extend(self.bbox, point)
+                else:
+                    d = (line.coords["X"] - coords["X"]) ** 2
+                    d += (line.coords["Y"] - coords["Y"]) ** 2
+                    d += (line.coords["Z"] - coords["Z"]) ** 2
+                    line.distance = math.sqrt(d)
 
                 # calc extrudate
                 if line.style == "extrude":
@@ -679,6 +786,86 @@ class Segment(Line):
         )
 
 
+class Arc(Segment):
+    """
+    Class for a G2/G3 arc segment in the XY plane,
+    helical if Z changes along it
+    """
+
+    def __init__(self, type, coords, line_num, line, start, centre):
+        """
+        Parameters::
+                start - absolute coords at the start of the arc
+                centre - I/J offsets of the centre from the start, or radius R
+        """
+        super().__init__(type, coords, line_num, line)
+        self.start = start
+        self.clockwise = type == "G2"
+        x0, y0 = start["X"], start["Y"]
+        x1, y1 = coords["X"], coords["Y"]
+        if "R" in centre:
+            # centre on the bisector of the chord, R < 0 for arcs over 180 degrees
+            r = centre["R"]
+            dx, dy = x1 - x0, y1 - y0
+            chord = math.hypot(dx, dy)
+            offset = math.sqrt(max(r * r - chord * chord / 4, 0.0)) / chord if chord else 0.0
+            if self.clockwise == (r < 0):
+                offset = -offset
+            self.centre = ((x0 + x1) / 2 + offset * dy, (y0 + y1) / 2 - offset * dx)
+        else:
+            self.centre = (x0 + centre.get("I", 0.0), y0 + centre.get("J", 0.0))
+        cx, cy = self.centre
+        self.radius = math.hypot(x0 - cx, y0 - cy)
+        self.angle = math.atan2(y0 - cy, x0 - cx)
+        # angle swept, negative clockwise, a full circle if it ends where it starts
+        sweep = math.atan2(y1 - cy, x1 - cx) - self.angle
+        if self.clockwise:
+            sweep = -((-sweep) % (2 * math.pi)) or -2 * math.pi
+        else:
+            sweep = (sweep % (2 * math.pi)) or 2 * math.pi
+        self.sweep = sweep if self.radius else 0.0
+
+    def length(self):
+        """
+        Length along the arc, including any Z change
+        """
+        dz = self.coords["Z"] - self.start["Z"]
+        if not self.sweep:
+            return math.sqrt(
+                (self.coords["X"] - self.start["X"]) ** 2
+                + (self.coords["Y"] - self.start["Y"]) ** 2
+                + dz**2
+            )
+        return math.hypot(self.radius * self.sweep, dz)
+
+    def extremes(self):
+        """
+        Points where the arc reaches its furthest X or Y,
+        for the bounding box
+        """
+        cx, cy = self.centre
+        points = []
+        if not self.sweep:
+            return points
+        for k in range(4):
+            angle = k * math.pi / 2
+            # angle turned from the start to reach it
+            if self.sweep > 0:
+                turned = (angle - self.angle) % (2 * math.pi)
+            else:
+                turned = (self.angle - angle) % (2 * math.pi)
+            t = turned / abs(self.sweep)
+            if t <= 1:
+                points.append(
+                    {
+                        "X": cx + self.radius * math.cos(angle),
+                        "Y": cy + self.radius * math.sin(angle),
+                        "Z": self.start["Z"] + t * (self.coords["Z"] - self.start["Z"]),
+                    }
+                )
+        return points
+
+
 class Layer:
     """
     Class for a layer of GCODE
@@ -697,7 +884,7 @@ class Layer:
         )
 
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(
         prog="gcode_parser.py",
         usage="%(prog)s [options]",
@@ -722,15 +909,45 @@ if __name__ == "__main__":
         dest="loglevel",
         const=logging.INFO,
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Parse the file on this many processes.",
+        type=int,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Print per-stage timings and counts.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        help="Print per-stage timings, counts and traced allocations (slow).",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
     logging.basicConfig(level=logging.ERROR)
+    if args.profile or args.profile_memory:
+        profiler.enable(args.profile_memory)
     t1 = time.time()
-    parser = GcodeParser()
-    model = parser.parse_file(args.file)
-    filename, ext = os.path.splitext(os.path.basename(args.file))
+    if args.jobs:
+        from parallel_parse import parse_file_parallel
+
+        model = parse_file_parallel(args.file, args.jobs)
+    else:
+        parser = GcodeParser()
+        model = parser.parse_file(args.file)
+    root, compression = split_compression(os.path.basename(args.file))
+    filename, ext = os.path.splitext(root)
     dirname = os.path.dirname(args.file)
-    filename = filename + "_parsed" + ext
+    filename = filename + "_parsed" + ext + compression
     model.write(os.path.join(dirname, filename))
     t2 = time.time()
     print("Completed in: {:.3f} ms".format((t2 - t1) * 1000.0))
     print(model)
+    if args.profile or args.profile_memory:
+        print(profiler.report())
+
+
+if __name__ == "__main__":
+    main()
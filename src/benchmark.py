@@ -0,0 +1,393 @@
+import os
+import json
+import math
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from Gcode_Parser import GcodeParser, Segment
+from conform_surface import increase_z, load_surface
+from kernels import BACKENDS, available_backends
+from line_splitter import convert_to_small_segments
+from point_cloud import extract_point_array
+from profiler import profiler
+
+BED_CENTRE = [117.5, 117.5]  # The centre of a (235, 235) bed found on Creality printers
+SHAPES = ["dome", "ramp", "sine"]
+
+
+def surface_height(shape, x, y, size, height, centre=BED_CENTRE):
+    """
+    Height of the analytic synthetic substrate at (x, y).
+    The substrate covers a square footprint of side size around centre.
+    """
+    u = (x - centre[0]) / (size / 2)
+    v = (y - centre[1]) / (size / 2)
+    if abs(u) > 1 or abs(v) > 1:
+        return 0.0
+    if shape == "dome":
+        r2 = u ** 2 + v ** 2
+        return height * math.sqrt(1 - r2) if r2 < 1 else 0.0
+    if shape == "ramp":
+        return height * (u + 1) / 2
+    if shape == "sine":
+        return height * (0.5 + 0.25 * (math.sin(2 * math.pi * u) + math.sin(2 * math.pi * v)))
+    raise ValueError("Unknown substrate shape '{}'".format(shape))
+
+
+def generate_substrate(path, shape="dome", size=40.0, height=10.0, layer_height=0.2, spacing=1.0):
+    """
+    Writes a G-code substrate of the given shape, built from
+    raster layers which only extrude where the analytic
+    surface is above the current layer height.
+    """
+    lines = ["G90", "M82", "G92 E0"]
+    e = 0.0
+    x0 = BED_CENTRE[0] - size / 2
+    y0 = BED_CENTRE[1] - size / 2
+    steps = int(round(size / spacing))
+    layers = max(1, int(round(height / layer_height)))
+    for layer in range(1, layers + 1):
+        z = round(layer * layer_height, 3)
+        lines.append("G1 Z{:.3f} F3000".format(z))
+        for row in range(steps + 1):
+            y = y0 + row * spacing
+            runs = []
+            start = None
+            for col in range(steps + 1):
+                x = x0 + col * spacing
+                inside = surface_height(shape, x, y, size, height) >= z
+                if inside and start is None:
+                    start = x
+                if start is not None and (not inside or col == steps):
+                    end = x if inside else x - spacing
+                    if end > start:
+                        runs.append((start, end))
+                    start = None
+            if row % 2:
+                runs = [(b, a) for a, b in reversed(runs)]
+            for a, b in runs:
+                lines.append("G0 X{:.3f} Y{:.3f} F3000".format(a, y))
+                e += abs(b - a) * 0.04
+                lines.append("G1 X{:.3f} Y{:.3f} E{:.4f} F1200".format(b, y, e))
+    with open(path, "w+") as fp:
+        fp.write("\n".join(lines))
+        fp.write("\n")
+    return path
+
+
+def generate_part(path, size=20.0, layers=5, layer_height=0.2, spacing=2.0):
+    """
+    Writes a flat square G-code part (perimeter and zig-zag infill)
+    to be conformed onto a substrate.
+    """
+    lines = ["G90", "M82", "G92 E0"]
+    e = 0.0
+    x0, x1 = BED_CENTRE[0] - size / 2, BED_CENTRE[0] + size / 2
+    y0, y1 = BED_CENTRE[1] - size / 2, BED_CENTRE[1] + size / 2
+    rows = int(round(size / spacing))
+    for layer in range(1, layers + 1):
+        z = round(layer * layer_height, 3)
+        lines.append("G1 Z{:.3f} F3000".format(z))
+        lines.append("G0 X{:.3f} Y{:.3f} F3000".format(x0, y0))
+        points = [(x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+        for row in range(rows + 1):
+            y = y0 + row * spacing
+            points += [(x0, y), (x1, y)] if row % 2 == 0 else [(x1, y), (x0, y)]
+        x, y = x0, y0
+        for nx, ny in points:
+            e += math.hypot(nx - x, ny - y) * 0.04
+            lines.append("G1 X{:.3f} Y{:.3f} E{:.4f} F1200".format(nx, ny, e))
+            x, y = nx, ny
+        lines.append("G92 E0")
+        e = 0.0
+    with open(path, "w+") as fp:
+        fp.write("\n".join(lines))
+        fp.write("\n")
+    return path
+
+
+def generate_point_cloud(shape="dome", points=10000, size=40.0, height=10.0):
+    """
+    Samples roughly the requested number of points on a regular
+    grid over the analytic surface, in the "X Y Z" string format
+    read by increase_z.
+    """
+    side = max(2, int(round(math.sqrt(points))))
+    step = size / (side - 1)
+    x0 = BED_CENTRE[0] - size / 2
+    y0 = BED_CENTRE[1] - size / 2
+    coordinates = []
+    for i in range(side):
+        for j in range(side):
+            x = round(x0 + i * step, 3)
+            y = round(y0 + j * step, 3)
+            z = round(surface_height(shape, x, y, size, height), 3)
+            coordinates.append("{0} {1} {2}".format(x, y, z))
+    return coordinates
+
+
+def count_segments(model):
+    return sum(
+        1 for layer in model.layers for line in layer.lines if isinstance(line, Segment)
+    )
+
+
+def run_stage(results, name, func, count, memory=False):
+    """
+    Times a single pipeline stage, recording the wall time,
+    throughput of the items returned by count and, if memory
+    is true, the peak traced allocation size.
+    """
+    # a caller already tracing (e.g. the profiler) keeps its session
+    tracing = tracemalloc.is_tracing()
+    if memory:
+        if tracing:
+            start_bytes = tracemalloc.get_traced_memory()[0]
+            profiler.reset_peak()
+        else:
+            start_bytes = 0
+            tracemalloc.start()
+    t1 = time.perf_counter()
+    value = func()
+    t2 = time.perf_counter()
+    stage = {"seconds": t2 - t1}
+    if memory:
+        stage["peak_bytes"] = tracemalloc.get_traced_memory()[1] - start_bytes
+        if not tracing:
+            tracemalloc.stop()
+    items = count(value)
+    stage["items"] = items
+    stage["items_per_second"] = items / stage["seconds"] if stage["seconds"] > 0 else None
+    results[name] = stage
+    return value
+
+
+def benchmark(part_path, surface_path, length=1.0, cloud=None, memory=False, out_dir=None):
+    """
+    Runs the conforming pipeline once, timing each stage separately.
+
+    Parameters::
+            part_path - G-code to be conformed
+            surface_path - G-code of the substrate
+            length - maximum split length in mm
+            cloud - optional point cloud to conform to instead of the extracted one
+            memory - trace peak memory of each stage (slows the run down)
+            out_dir - directory for the conformed output (default: a temporary one)
+    """
+    stages = {}
+    model = run_stage(
+        stages, "parse_surface",
+        lambda: GcodeParser().parse_file(surface_path),
+        lambda m: len(m.segments), memory,
+    )
+    model = run_stage(
+        stages, "split_surface",
+        lambda: convert_to_small_segments(model, length / 2, arcs=True),
+        count_segments, memory,
+    )
+    coordinates = run_stage(
+        stages, "point_cloud",
+        lambda: extract_point_array(model)[0],
+        len, memory,
+    )
+    del model
+    surface = cloud if cloud is not None else coordinates
+
+    part = run_stage(
+        stages, "parse",
+        lambda: GcodeParser().parse_file(part_path),
+        lambda m: len(m.segments), memory,
+    )
+    # increase_z splits internally, so the split stage runs on its own copy
+    split_model = GcodeParser().parse_file(part_path)
+    run_stage(
+        stages, "split",
+        lambda: convert_to_small_segments(split_model, length, arcs=True),
+        count_segments, memory,
+    )
+    del split_model
+    part = run_stage(
+        stages, "increase_z",
+        lambda: increase_z(part, surface, length),
+        count_segments, memory,
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conformed_path = os.path.join(out_dir or tmp, "conformed.gcode")
+        run_stage(
+            stages, "write",
+            lambda: part.write(conformed_path),
+            lambda _: sum(len(layer.lines) for layer in part.layers), memory,
+        )
+        output_bytes = os.path.getsize(conformed_path)
+
+    return {
+        "part": part_path,
+        "surface": surface_path,
+        "length": length,
+        "cloud_points": len(surface),
+        "output_bytes": output_bytes,
+        "total_seconds": sum(stage["seconds"] for stage in stages.values()),
+        "stages": stages,
+    }
+
+
+def benchmark_backends(part_path, surface_path, length=1.0, repeat=3):
+    """
+    Times increase_z on each conforming backend, over the same
+    surface index, and checks they write the same G-code. The
+    first run of a compiled backend includes compiling it, so
+    the best of repeat runs is reported as well.
+    """
+    model = convert_to_small_segments(GcodeParser().parse_file(surface_path), length / 2, arcs=True)
+    surface = load_surface(extract_point_array(model)[0])
+    del model
+    results = {}
+    reference = None
+    for backend in BACKENDS:
+        if backend not in available_backends():
+            results[backend] = {"available": False}
+            continue
+        times = []
+        for _ in range(repeat):
+            part = GcodeParser().parse_file(part_path)
+            t1 = time.perf_counter()
+            part = increase_z(part, surface, length, progress=False, backend=backend)
+            times.append(time.perf_counter() - t1)
+        lines = list(part.iter_lines())
+        if reference is None:
+            reference = lines
+        results[backend] = {
+            "available": True,
+            "first_seconds": times[0],
+            "best_seconds": min(times),
+            "segments": count_segments(part),
+            "identical": lines == reference,
+        }
+    return {
+        "part": part_path,
+        "surface": surface_path,
+        "length": length,
+        "cloud_points": len(surface),
+        "backends": results,
+    }
+
+
+def synthetic_case(directory, shape, layers, points, size=40.0, height=10.0, length=1.0, memory=False):
+    """
+    Generates and benchmarks a reproducible synthetic case.
+    """
+    name = "{}_{}l_{}p".format(shape, layers, points)
+    surface_path = generate_substrate(
+        os.path.join(directory, "{}_surface.gcode".format(name)), shape, size, height
+    )
+    part_path = generate_part(
+        os.path.join(directory, "{}_part.gcode".format(name)), size / 2, layers
+    )
+    cloud = generate_point_cloud(shape, points, size, height) if points else None
+    result = benchmark(part_path, surface_path, length, cloud, memory)
+    result["case"] = name
+    return result
+
+
+def max_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmark.py",
+        usage="%(prog)s [options]",
+        description="Benchmarks the conforming pipeline stage by stage.",
+    )
+    parser.add_argument("-f", "--file", help="Path to the G-code file to be conformed.")
+    parser.add_argument("-s", "--surface", help="Path to the G-code file of substrate/surface.")
+    parser.add_argument(
+        "--shape",
+        choices=SHAPES,
+        action="append",
+        help="Synthetic substrate shape, can be repeated (default: all).",
+    )
+    parser.add_argument(
+        "-n", "--layers", help="Layers in the synthetic part.", type=int, default=2
+    )
+    parser.add_argument(
+        "-m",
+        "--points",
+        help="Points in the synthetic cloud (0 uses the extracted cloud).",
+        type=int,
+        default=2500,
+    )
+    parser.add_argument(
+        "--size", help="Side of the synthetic substrate in mm.", type=float, default=40.0
+    )
+    parser.add_argument(
+        "-l", "--length", help="Maximum length of a single line.", type=float, default=1.00
+    )
+    parser.add_argument(
+        "--memory",
+        help="Trace peak memory of each stage (inflates timings).",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--backends",
+        help="Compare the conforming backends instead (default: the test/conform files).",
+        action="store_true",
+    )
+    parser.add_argument("-o", "--output", help="Write the JSON report to this path.")
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    results = []
+    if args.backends:
+        results.append(
+            benchmark_backends(
+                args.file or os.path.join("test", "conform", "Thin_film.gcode"),
+                args.surface or os.path.join("test", "conform", "Dome.gcode"),
+                args.length,
+            )
+        )
+    elif args.file and args.surface:
+        results.append(benchmark(args.file, args.surface, args.length, memory=args.memory))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            for shape in args.shape or SHAPES:
+                results.append(
+                    synthetic_case(
+                        tmp, shape, args.layers, args.points,
+                        size=args.size, length=args.length, memory=args.memory,
+                    )
+                )
+
+    report = json.dumps({"results": results, "max_rss_kb": max_rss_kb()}, indent=2)
+    if args.output:
+        with open(args.output, "w+") as fp:
+            fp.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
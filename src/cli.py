@@ -0,0 +1,123 @@
+import sys
+import logging
+import argparse
+import importlib
+
+# command -> (module providing main(argv), description)
+# modules are imported only when their command runs, so quick jobs
+# never pay for numpy, tqdm or matplotlib
+COMMANDS = {
+    "stat": (None, "Parse a G-code file and print its model summary."),
+    "parse": ("Gcode_Parser", "Parse a G-code file and write it back out."),
+    "split": ("line_splitter", "Split long moves into shorter segments."),
+    "reorder": ("reorder", "Reorder the islands of each layer to shorten travel."),
+    "index": ("layer_index", "Index the layers of a G-code file, parse layer ranges."),
+    "pointcloud": ("point_cloud", "Extract the point cloud of a substrate."),
+    "tiles": ("tiled_surface", "Split a point cloud into memory-mapped surface tiles."),
+    "conform": ("conform", "Conform a G-code file onto a substrate."),
+    "fixed": ("fixed_point", "Split and conform a G-code file in fixed-point integers."),
+    "feedrate": ("feedrate", "Set feedrates of conformed moves from the surface slope."),
+    "time": ("print_time", "Estimate the print time of a G-code file."),
+    "raise": ("select_z_raise", "Raise the Z of selected regions."),
+    "bench": ("benchmark", "Benchmark the conforming pipeline."),
+    "serve": ("conform_server", "Serve conform and split jobs over local HTTP."),
+    "stream": ("stream_conform", "Stream split/conformed G-code line by line."),
+    "plot": (None, "Plot a G-code file or point cloud."),
+    "report": ("report", "Render the comparison plots of a conform job."),
+}
+
+
+def stat(argv=None):
+    from Gcode_Parser import GcodeParser
+    from profiler import profiler
+
+    parser = argparse.ArgumentParser(
+        prog="cli.py stat",
+        description="Parses a G-code file and prints its model summary.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the G-code file to be parsed.")
+    parser.add_argument(
+        "--profile",
+        help="Print per-stage timings and counts.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        help="Print per-stage timings, counts and traced allocations (slow).",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+    if args.profile or args.profile_memory:
+        profiler.enable(args.profile_memory)
+    model = GcodeParser().parse_file(args.file)
+    print(model)
+    if args.profile or args.profile_memory:
+        print(profiler.report())
+
+
+def plot(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="cli.py plot",
+        description="Plots a G-code file or an extracted point cloud.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the G-code or point cloud file.")
+    parser.add_argument(
+        "--cloud",
+        help="The file is a point cloud rather than G-code.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--scatter",
+        help="Scatter plot instead of a line plot.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-b",
+        "--budget",
+        help="Most points to draw, larger files are decimated.",
+        type=int,
+        default=200000,
+    )
+    parser.add_argument(
+        "--layer-step",
+        help="Only draw every n-th layer.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument("--dpi", help="Resolution of the saved plot.", type=int, default=300)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    from visualise import plot_gcode, plot_point_cloud
+
+    if args.cloud:
+        plot_point_cloud(args.file, args.budget, args.dpi)
+    else:
+        plot_gcode(args.file, args.scatter, args.budget, args.layer_step, args.dpi)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="cli.py",
+        usage="%(prog)s <command> [options]",
+        description="Conformal 3D printing G-code tools.",
+        epilog="commands:\n"
+        + "\n".join("  {:<12}{}".format(name, help) for name, (_, help) in COMMANDS.items())
+        + "\n\nRun '%(prog)s <command> -h' for the options of a command.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("command", choices=list(COMMANDS), metavar="command")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    module, _ = COMMANDS[args.command]
+    if module is None:
+        run = globals()[args.command]
+    else:
+        run = importlib.import_module(module).main
+    run(args.args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,12 +2,22 @@ import os
 import logging
 import argparse
 import time
+import numpy as np
 from Gcode_Parser import GcodeParser
+from gcode_io import split_compression
+from gcode_edit import relative_anywhere
 from conform_surface import increase_z
 from line_splitter import convert_to_small_segments
-from point_cloud import extract_point_cloud, convert_to_number, convert_to_list, coord_write
+from point_cloud import extract_point_array, extract_top_surface, point_array_to_list, coord_write
+from profiler import profiler
+from simplify import merge_collinear
+from feedrate import schedule_feedrates
+from print_time import format_duration
+from surface_normals import NormalField, offset_normals
+from tiled_surface import TiledSurface, build_tiles, is_tiled
+from fixed_point import FixedMoves
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         prog="select_z_raise.py",
         usage="%(prog)s [options]",
@@ -32,6 +42,46 @@ def main():
         type=float,
         default=1.00,
     )
+    parser.add_argument(
+        "-r",
+        "--resolution",
+        help="Keep only the highest cloud point per XY cell of this size in mm.",
+        type=float,
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        help="Only split where the surface height changes by more than this in mm.",
+        type=float,
+    )
+    parser.add_argument(
+        "-m",
+        "--merge",
+        help="Merge conformed moves which are collinear within this distance in mm.",
+        type=float,
+    )
+    parser.add_argument(
+        "--feedrate",
+        help="Set extruding moves to FLAT mm/min on flat regions down to STEEP on steep ones.",
+        type=float,
+        nargs=2,
+        metavar=("FLAT", "STEEP"),
+    )
+    parser.add_argument(
+        "-n",
+        "--normal",
+        help="Offset the print along the surface normals instead of straight up.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fixed",
+        help="Split and conform with fixed-point integer coordinates (uniform split only).",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tiles",
+        help="Directory of memory-mapped surface tiles, built from the point cloud if missing.",
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -49,34 +99,80 @@ def main():
         dest="loglevel",
         const=logging.INFO,
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--profile",
+        help="Print per-stage timings and counts.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        help="Print per-stage timings, counts and traced allocations (slow).",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+    if args.normal and (args.tolerance is not None or args.tiles):
+        parser.error("-n/--normal cannot be combined with -t/--tolerance or --tiles")
+    if args.fixed and (args.tolerance is not None or args.normal):
+        parser.error("--fixed cannot be combined with -t/--tolerance or -n/--normal")
     logging.basicConfig(level=logging.ERROR)
+    if args.profile or args.profile_memory:
+        profiler.enable(args.profile_memory)
 
-    in_file, _ = os.path.splitext(os.path.basename(args.file))
-    pointcloud_path = os.path.join(
-        os.path.dirname(args.file),
-        "pointcloud_{}_{}.txt".format(args.length, in_file),
-    )
+    root, compression = split_compression(os.path.basename(args.file))
+    in_file, _ = os.path.splitext(root)
+    if args.resolution:
+        cloud_name = "pointcloud_{}_{}_{}.txt".format(args.length, args.resolution, in_file)
+    else:
+        cloud_name = "pointcloud_{}_{}.txt".format(args.length, in_file)
+    pointcloud_path = os.path.join(os.path.dirname(args.file), cloud_name)
     # check if the point cloud has already been generated
     if not os.path.exists(pointcloud_path):
         # generate the point cloud
+        profiler.miss("point_cloud_file")
         print("Generating point cloud file...")
         t1 = time.time()
-        parser = GcodeParser()
-        model = parser.parse_file(args.surface)
-        model = convert_to_small_segments(model, args.length / 2) # split into 1mm units
-        coordinates = extract_point_cloud(model)
-        coordinates = convert_to_number(coordinates)
-        coordinates = convert_to_list(coordinates)
-        coord_write(coordinates, pointcloud_path) # changed output file path
+        if args.resolution:
+            # stream the substrate keeping only its top surface
+            points = extract_top_surface(args.surface, args.resolution, args.length / 2)
+            print("Top surface of {} points".format(len(points)))
+        else:
+            model = GcodeParser().parse_file(args.surface)
+            model = convert_to_small_segments(model, args.length / 2, arcs=True) # split into 1mm units
+            points, _, _ = extract_point_array(model)
+        coord_write(point_array_to_list(points), pointcloud_path) # changed output file path
         t2 = time.time()
         print("Extracted point cloud in {:.3f} ms".format((t2 - t1) * 1000.0))
     else:
+        profiler.hit("point_cloud_file")
         print("Point cloud file already exists...")
 
-    print("Reading in point cloud...")
-    with open(pointcloud_path) as f:
-        surface = f.read().splitlines()
+    if args.normal:
+        # computed once per point cloud and saved next to it
+        field_path = os.path.splitext(pointcloud_path)[0] + "_normals.npz"
+        if os.path.exists(field_path) and os.path.getmtime(field_path) >= os.path.getmtime(
+            pointcloud_path
+        ):
+            profiler.hit("normal_field")
+            surface = NormalField.load(field_path)
+        else:
+            profiler.miss("normal_field")
+            print("Computing surface normals...")
+            points = np.loadtxt(pointcloud_path, ndmin=2)[:, :3]
+            surface = NormalField.build(points, args.length * 0.5)
+            surface.save(field_path)
+    elif args.tiles:
+        # the manifest is written last, so it dates the tiles
+        if is_tiled(args.tiles, pointcloud_path):
+            profiler.hit("surface_tiles_build")
+        else:
+            profiler.miss("surface_tiles_build")
+            print("Splitting point cloud into tiles...")
+            build_tiles(pointcloud_path, args.tiles)
+        surface = TiledSurface(args.tiles)
+    else:
+        print("Reading in point cloud...")
+        with open(pointcloud_path) as f:
+            surface = f.read().splitlines()
 
     splitted_path = os.path.join(
         os.path.dirname(args.file),
@@ -85,26 +181,54 @@ def main():
 
     conformed_path = os.path.join(
         os.path.dirname(args.file),
-        "conformed_{}_{}.gcode".format(args.length, in_file),
+        "conformed_{}_{}.gcode{}".format(args.length, in_file, compression),
     )
     t1 = time.time()
-    parser = GcodeParser()
-    model = parser.parse_file(args.file)
+    model = GcodeParser().parse_file(args.file)
+    if args.normal and relative_anywhere(model):
+        parser.error("-n/--normal needs absolute moves and extrusion, the file uses G91 or M83")
+    if args.merge and relative_anywhere(model):
+        parser.error("-m/--merge needs absolute moves and extrusion, the file uses G91 or M83")
     print()
     print("Model information before conforming:")
     print(model)
     print()
     print("Conforming print to point cloud surface...")
-    model = increase_z(model, surface, args.length)
+    if args.normal:
+        model = offset_normals(model, surface, args.length)
+    elif args.fixed:
+        moves = FixedMoves(model).split(args.length)
+        model = moves.conform(surface, args.length * 0.5).apply()
+    else:
+        model = increase_z(model, surface, args.length, tolerance=args.tolerance)
+    if args.merge:
+        report = merge_collinear(model, args.merge)
+        print(
+            "Merged {lines_before} lines into {lines_after} in {ms:.3f} ms".format(
+                ms=report["seconds"] * 1000.0, **report
+            )
+        )
+    if args.feedrate:
+        report = schedule_feedrates(
+            model, *args.feedrate, field=surface if args.normal else None
+        )
+        print(
+            "Set the feedrate of {} moves, estimated print time {} -> {}".format(
+                report["moves_changed"],
+                format_duration(report["time_before"]),
+                format_duration(report["time_after"]),
+            )
+        )
     model.write(conformed_path) # changed file path for saving output
     t2 = time.time()
     print("Conformed in {:.3f} ms".format((t2 - t1) * 1000.0))
-    parser = GcodeParser()
-    model = parser.parse_file(conformed_path)
+    model = GcodeParser().parse_file(conformed_path)
     print()
     print("Model information after conforming:")
     print(model)
     print()
+    if args.profile or args.profile_memory:
+        print(profiler.report())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from Gcode_Parser import GcodeParser
+from conform_surface import increase_z, load_surface_file
+from line_splitter import convert_to_small_segments
+from profiler import profiler
+
+
+class SurfaceCache:
+    """
+    Least recently used cache of surface indices, keyed by
+    the substrate path, its modification time and split length
+    so edited fixtures are rebuilt.
+
+    Each entry is a future, so a surface is built once outside
+    the lock while other requests for it wait on the future and
+    requests for other surfaces go ahead.
+    """
+
+    def __init__(self, capacity=4):
+        self.capacity = capacity
+        self.surfaces = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, length):
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime_ns, length)
+        with self.lock:
+            future = self.surfaces.get(key)
+            build = future is None
+            if build:
+                self.misses += 1
+                profiler.miss("surface_cache")
+                future = self.surfaces[key] = Future()
+                while len(self.surfaces) > self.capacity:
+                    self.surfaces.popitem(last=False)
+            else:
+                self.surfaces.move_to_end(key)
+                self.hits += 1
+                profiler.hit("surface_cache")
+        if build:
+            try:
+                future.set_result(load_surface_file(path, length))
+            except Exception as e:
+                # not cached, the next request tries again
+                with self.lock:
+                    if self.surfaces.get(key) is future:
+                        del self.surfaces[key]
+                future.set_exception(e)
+        return future.result()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "surfaces": [
+                    {"path": path, "length": length, "points": len(future.result())}
+                    for (path, _, length), future in self.surfaces.items()
+                    if future.done() and future.exception() is None
+                ],
+            }
+
+
+class ConformHandler(BaseHTTPRequestHandler):
+    """
+    Handles conform and split jobs.
+
+    POST /conform?surface=<path>&length=<mm>  body: G-code to conform
+    POST /split?length=<mm>                   body: G-code to split
+    GET  /stats                               cache and job stats
+    """
+
+    # flush the streamed G-code in chunks of this many bytes
+    chunk_size = 1 << 16
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/stats":
+            self.send_error(404, "Unknown path '{}'".format(url.path))
+            return
+        body = json.dumps(
+            {"cache": self.server.cache.stats(), "jobs": self.server.jobs}, indent=2
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path not in ("/conform", "/split"):
+            self.send_error(404, "Unknown path '{}'".format(url.path))
+            return
+        try:
+            length = float(query.get("length", 1.0))
+        except ValueError:
+            self.send_error(400, "Invalid length '{}'".format(query["length"]))
+            return
+        surface = None
+        if url.path == "/conform":
+            if "surface" not in query:
+                self.send_error(400, "Missing surface")
+                return
+            try:
+                surface = self.server.cache.get(query["surface"], length)
+            except OSError as e:
+                self.send_error(404, "Cannot read surface: {}".format(e))
+                return
+
+        t1 = time.time()
+        content_length = int(self.headers.get("Content-Length", 0))
+        lines = self.rfile.read(content_length).decode().splitlines()
+        try:
+            model = GcodeParser().parse_lines(lines)
+            if surface is None:
+                model = convert_to_small_segments(model, length)
+            else:
+                model = increase_z(model, surface, length, progress=False)
+        except Exception as e:
+            logging.exception("Job failed")
+            self.send_error(500, "Job failed: {}".format(e))
+            return
+
+        # no Content-Length, the G-code is streamed until the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        chunk = []
+        size = 0
+        for line in model.iter_lines():
+            chunk.append(line)
+            size += len(line) + 1
+            if size >= self.chunk_size:
+                chunk.append("")
+                self.wfile.write("\n".join(chunk).encode())
+                chunk = []
+                size = 0
+        if chunk:
+            chunk.append("")
+            self.wfile.write("\n".join(chunk).encode())
+        self.server.job_done()
+        logging.info("%s done in %.3f ms", url.path, (time.time() - t1) * 1000.0)
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.address_string(), format % args)
+
+
+class ConformServer(ThreadingHTTPServer):
+    """
+    Local HTTP server keeping parsed substrates and their
+    surface indices warm between jobs.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, capacity=4):
+        super().__init__(address, ConformHandler)
+        self.cache = SurfaceCache(capacity)
+        self.jobs = 0
+        # handler threads finish jobs concurrently
+        self.jobs_lock = threading.Lock()
+
+    def job_done(self):
+        with self.jobs_lock:
+            self.jobs += 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="conform_server.py",
+        usage="%(prog)s [options]",
+        description="Serves conform and split jobs with warm surface indices.",
+    )
+    parser.add_argument("--host", help="Address to listen on.", default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="Port to listen on.", type=int, default=8765)
+    parser.add_argument(
+        "-c",
+        "--capacity",
+        help="Number of surfaces kept in memory.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "-s",
+        "--surface",
+        action="append",
+        default=[],
+        help="Surface to load at start-up, can be repeated.",
+    )
+    parser.add_argument(
+        "-l",
+        "--length",
+        help="Split length of the preloaded surfaces.",
+        type=float,
+        default=1.00,
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    server = ConformServer((args.host, args.port), args.capacity)
+    for surface in args.surface:
+        server.cache.get(surface, args.length)
+    print("Serving on http://{}:{}".format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,17 @@
 from Gcode_Parser import GcodeParser, Segment
+from gcode_io import open_gcode, split_compression
 import os
 import math
 import argparse
 import logging
 from line_splitter import convert_to_small_segments
 import time
-from point_cloud import convert_to_number
-from tqdm import tqdm
+from point_cloud import convert_to_number, extract_point_array, extract_top_surface
+from profiler import profiler
+from kernels import check_backend
+
+# clearance added above the surface when a segment is raised onto it
+EPSILON = 0.2
 
 class NotRelativeExtrusion(ValueError):
     pass
@@ -20,10 +25,312 @@ def coord_is_valid(line, coord, max_seg_length):
     return False
 
 
-def increase_z(model, surface_coords, max_seg_length):
-    e_diff = 0
-    model = convert_to_small_segments(model, max_seg_length)
-    surface_coords = convert_to_number(surface_coords)
+class SurfaceIndex:
+    """
+    Grid hash of the surface point cloud, so the window
+    around a segment only scans the points of nearby cells
+    instead of the whole cloud.
+    """
+
+    def __init__(self, surface_coords, cell_size=0.5):
+        """
+        Parameters::
+                surface_coords - list of [X, Y, Z] coordinates
+                cell_size - side of a grid cell in mm
+        """
+        self.cell_size = cell_size
+        self.cells = {}
+        for coord in surface_coords:
+            key = (math.floor(coord[0] / cell_size), math.floor(coord[1] / cell_size))
+            cell = self.cells.get(key)
+            if cell is None:
+                cell = self.cells[key] = []
+            cell.append(coord)
+        self.size = len(surface_coords)
+
+    def __len__(self):
+        return self.size
+
+    def packed(self):
+        """
+        The cells as flat arrays for the compiled kernels,
+        see kernels.pack_cells, built on first use.
+        """
+        if getattr(self, "_packed", None) is None:
+            from kernels import pack_cells
+
+            self._packed = pack_cells(self.cells, self.cell_size)
+        return self._packed
+
+    def max_z(self, x, y, half_width):
+        """
+        Highest Z of the points strictly inside the square window
+        of the given half width around (x, y), 0 if it is empty.
+        """
+        cell_size = self.cell_size
+        z_max = None
+        for ix in range(
+            math.floor((x - half_width) / cell_size),
+            math.floor((x + half_width) / cell_size) + 1,
+        ):
+            for iy in range(
+                math.floor((y - half_width) / cell_size),
+                math.floor((y + half_width) / cell_size) + 1,
+            ):
+                cell = self.cells.get((ix, iy))
+                if cell is None:
+                    continue
+                for coord in cell:
+                    if abs(x - coord[0]) < half_width and abs(y - coord[1]) < half_width:
+                        if z_max is None or coord[2] > z_max:
+                            z_max = coord[2]
+        return z_max if z_max is not None else 0
+
+
+def load_surface(surface_coords, cell_size=0.5):
+    """
+    Builds a SurfaceIndex from "X Y Z" point cloud strings or
+    an (N, 3) point array, an existing index is returned as is.
+    """
+    if isinstance(surface_coords, SurfaceIndex):
+        return surface_coords
+    with profiler.stage("surface_load") as stage:
+        if hasattr(surface_coords, "tolist"):
+            surface_coords = surface_coords.tolist()
+        else:
+            surface_coords = convert_to_number(surface_coords)
+        surface = SurfaceIndex(surface_coords, cell_size)
+        stage.add(len(surface))
+    return surface
+
+
+def conform_line(line, previous, surface, half_width, e_running, first=False):
+    """
+    Raises a single segment onto the surface and compensates its
+    extrusion for the extra length, rewriting its G-code.
+
+    Parameters::
+            line - the segment to conform
+            previous - the segment before it, already conformed
+            surface - SurfaceIndex of the substrate
+            half_width - half width of the surface lookup window
+            e_running - running E correction of the earlier segments
+            first - line is the first segment (no E compensation)
+
+    Returns the updated running E correction.
+    """
+    if "G92 E0" in line.line:
+        e_running = 0
+    z_max = surface.max_z(line.coords["X"], line.coords["Y"], half_width)
+    if z_max:
+        line.coords["Z"] = z_max + line.coords["Z"] + EPSILON
+    z_diff = abs(previous.coords["Z"] - line.coords["Z"])
+    if line.coords.get("E") and previous.coords.get("E") and (z_max or z_diff):
+        if not first:
+            x_diff = abs(previous.coords["X"] - line.coords["X"])
+            y_diff = abs(previous.coords["Y"] - line.coords["Y"])
+            z_diff = abs(previous.coords["Z"] - line.coords["Z"])
+            distance = math.sqrt((x_diff ** 2) + (y_diff ** 2))
+            if distance > 0: # new segment to if function to prevent zero error. 
+                factor = math.sqrt((distance ** 2) + (z_diff ** 2)) / distance
+                line.coords["E"] = line.coords["E"] + e_running
+                e_diff = abs(previous.coords["E"] - line.coords["E"])
+                new_e = previous.coords["E"] + (e_diff * factor)
+                e_running = e_running + (new_e - line.coords["E"])
+                line.coords["E"] = new_e
+
+        if line.type == "G1":
+            line.line = "{0} X{1} Y{2} Z{3} E{4} F{5}".format(
+                line.type,
+                line.coords["X"],
+                line.coords["Y"],
+                line.coords["Z"],
+                line.coords["E"],
+                line.coords["F"],
+            )
+    else:
+        if line.type == "G1":
+            if line.coords.get("E") and "E" in line.line:
+                line.coords["E"] += e_running
+                line.line = "{0} X{1} Y{2} Z{3} E{4} F{5}".format(
+                    line.type,
+                    line.coords["X"],
+                    line.coords["Y"],
+                    line.coords["Z"],
+                    line.coords["E"],
+                    line.coords["F"],
+                )
+            else:
+                line.line = "{0} X{1} Y{2} Z{3} F{4}".format(
+                    line.type,
+                    line.coords["X"],
+                    line.coords["Y"],
+                    line.coords["Z"],
+                    line.coords["F"],
+                )
+    return e_running
+
+
+def conform_lines(lines, surface, half_width):
+    """
+    Conforms the segments with the compiled kernels, giving the
+    same coordinates and G-code as calling conform_line on each in
+    turn: every surface lookup is done first in one batch, then the
+    raise and E compensation run over the segments as arrays.
+    """
+    import numpy as np
+    from kernels import window_max, compensate_e, WRITE_E, WRITE_NO_E
+
+    n = len(lines)
+    coords = np.array(
+        [
+            (line.coords["X"], line.coords["Y"], line.coords["Z"], line.coords.get("E") or 0.0)
+            for line in lines
+        ],
+        dtype=np.float64,
+    ).reshape(n, 4)
+    x, y, z, e = (np.ascontiguousarray(coords[:, i]) for i in range(4))
+    z_max = np.zeros(n)
+    window_max(x, y, half_width, surface.cell_size, *surface.packed(), z_max)
+
+    reset = np.fromiter(("G92 E0" in line.line for line in lines), dtype=bool, count=n)
+    g1 = np.fromiter((line.type == "G1" for line in lines), dtype=bool, count=n)
+    e_text = np.fromiter(("E" in line.line for line in lines), dtype=bool, count=n)
+    out_z = np.zeros(n)
+    out_e = np.zeros(n)
+    rewrite = np.zeros(n, dtype=np.int8)
+    compensate_e(x, y, z, e, z_max, reset, g1, e_text, EPSILON, out_z, out_e, rewrite)
+
+    for line, new_z, new_e, how in zip(lines, out_z.tolist(), out_e.tolist(), rewrite.tolist()):
+        line.coords["Z"] = new_z
+        if line.coords.get("E"):
+            line.coords["E"] = new_e
+        if how == WRITE_E:
+            line.line = "{0} X{1} Y{2} Z{3} E{4} F{5}".format(
+                line.type,
+                line.coords["X"],
+                line.coords["Y"],
+                line.coords["Z"],
+                line.coords["E"],
+                line.coords["F"],
+            )
+        elif how == WRITE_NO_E:
+            line.line = "{0} X{1} Y{2} Z{3} F{4}".format(
+                line.type,
+                line.coords["X"],
+                line.coords["Y"],
+                line.coords["Z"],
+                line.coords["F"],
+            )
+
+
+def load_surface_file(path, length, resolution=None):
+    """
+    Builds the surface index of a substrate, given either as
+    G-code (split at length / 2 as in conform.py) or as an
+    extracted point cloud text file. If a resolution is given
+    only the top surface of the G-code is kept, with one
+    point per XY cell. A directory of surface tiles written by
+    tiled_surface.build_tiles is opened as a TiledSurface.
+    """
+    if os.path.isdir(path):
+        from tiled_surface import TiledSurface
+
+        return TiledSurface(path)
+    if os.path.splitext(split_compression(path)[0])[1] == ".txt":
+        with open_gcode(path) as f:
+            return load_surface(f.read().splitlines())
+    if resolution:
+        return load_surface(extract_top_surface(path, resolution, length / 2))
+    parser = GcodeParser()
+    model = parser.parse_file(path)
+    model = convert_to_small_segments(model, length / 2, arcs=True)
+    points, _, _ = extract_point_array(model)
+    return load_surface(points)
+
+
+def simplify_profile(heights, tolerance):
+    """
+    Douglas-Peucker simplification of a height profile sampled
+    at equal spacing. Returns the sorted indices of the interior
+    samples to keep so that linear interpolation between kept
+    samples is within tolerance of every sample.
+    """
+    keep = []
+    stack = [(0, len(heights) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        h1 = heights[first]
+        slope = (heights[last] - h1) / (last - first)
+        worst = None
+        worst_error = tolerance
+        for i in range(first + 1, last):
+            error = abs(heights[i] - (h1 + slope * (i - first)))
+            if error > worst_error:
+                worst = i
+                worst_error = error
+        if worst is not None:
+            keep.append(worst)
+            stack.append((first, worst))
+            stack.append((worst, last))
+    keep.sort()
+    return keep
+
+
+def adaptive_fractions(surface, max_seg_length, tolerance):
+    """
+    Returns a split_fractions function for convert_to_small_segments
+    which samples the surface every max_seg_length along a segment
+    and only cuts it where the raised height would otherwise be
+    more than tolerance away from the uniformly split toolpath.
+    """
+    half_width = max_seg_length * 0.5
+
+    def fractions(seg_current, seg_previous):
+        number_of_segs = math.ceil(seg_current.distance / max_seg_length)
+        x1 = seg_previous.coords["X"]
+        y1 = seg_previous.coords["Y"]
+        x2 = seg_current.coords["X"]
+        y2 = seg_current.coords["Y"]
+        heights = []
+        for i in range(number_of_segs + 1):
+            k = i / number_of_segs
+            z_max = surface.max_z(
+                round(x1 + k * (x2 - x1), 3), round(y1 + k * (y2 - y1), 3), half_width
+            )
+            # conform_line leaves points off the surface untouched
+            heights.append(z_max + EPSILON if z_max else 0)
+        profiler.count("adaptive_samples", len(heights))
+        return [i / number_of_segs for i in simplify_profile(heights, tolerance)]
+
+    return fractions
+
+
+def increase_z(
+    model, surface_coords, max_seg_length, progress=True, tolerance=None, backend=None
+):
+    """
+    Conforms the model onto the surface, given either as point
+    cloud strings or as a prebuilt SurfaceIndex.
+
+    If a tolerance (in mm) is given, segments are only split
+    where the surface height changes along them, keeping the
+    raised toolpath within tolerance of a uniform split.
+
+    backend is "python" or "numba" (see kernels.BACKENDS), by
+    default numba when it is installed. Both give the same output.
+    """
+    from tqdm import tqdm
+
+    backend = check_backend(backend)
+    surface = load_surface(surface_coords)
+    split_fractions = None
+    if tolerance is not None:
+        split_fractions = adaptive_fractions(surface, max_seg_length, tolerance)
+    model = convert_to_small_segments(model, max_seg_length, split_fractions, arcs=True)
+    half_width = max_seg_length * 0.5
 
     lines = [
         line
@@ -32,70 +339,22 @@ def increase_z(model, surface_coords, max_seg_length):
         if isinstance(line, Segment)
     ]
 
-    for line_idx, line in tqdm(enumerate(lines), total=len(lines)):
-        if "G92 E0" in line.line:
-            e_running = 0
-        z = [
-            coord[2]
-            for coord in surface_coords
-            if abs(line.coords["X"] - coord[0]) < (max_seg_length * 0.5)
-            and abs(line.coords["Y"] - coord[1]) < (max_seg_length * 0.5)
-        ]
-        z = z if z else [0]
-        if z:
-            z_max = max(z)
-            if z_max:
-                epsilon = 0.2
-                line.coords["Z"] = max(z) + line.coords["Z"] + epsilon
-            z_diff = abs(lines[line_idx - 1].coords["Z"] - line.coords["Z"])
-            if line.coords.get("E") and lines[line_idx - 1].coords.get("E") and (z_max or z_diff):
-                if line_idx > 0:
-                    x_diff = abs(lines[line_idx - 1].coords["X"] - line.coords["X"])
-                    y_diff = abs(lines[line_idx - 1].coords["Y"] - line.coords["Y"])
-                    z_diff = abs(lines[line_idx - 1].coords["Z"] - line.coords["Z"])
-                    distance = math.sqrt((x_diff ** 2) + (y_diff ** 2))
-                    if distance > 0: # new segment to if function to prevent zero error. 
-                        factor = math.sqrt((distance ** 2) + (z_diff ** 2)) / distance
-                        line.coords["E"] = line.coords["E"] + e_running
-                        e_diff = abs(lines[line_idx - 1].coords["E"] - line.coords["E"])
-                        new_e = lines[line_idx - 1].coords["E"] + (e_diff * factor)
-                        e_running = e_running + (new_e - line.coords["E"])
-                        line.coords["E"] = new_e
-                
-                if line.type == "G1":
-                    line.line = "{0} X{1} Y{2} Z{3} E{4} F{5}".format(
-                        line.type,
-                        line.coords["X"],
-                        line.coords["Y"],
-                        line.coords["Z"],
-                        line.coords["E"],
-                        line.coords["F"],
-                    )
-            else:
-                if line.type == "G1":
-                    if line.coords.get("E") and "E" in line.line:
-                        line.coords["E"] += e_running
-                        line.line = "{0} X{1} Y{2} Z{3} E{4} F{5}".format(
-                            line.type,
-                            line.coords["X"],
-                            line.coords["Y"],
-                            line.coords["Z"],
-                            line.coords["E"],
-                            line.coords["F"],
-                        )
-                    else:
-                        line.line = "{0} X{1} Y{2} Z{3} F{4}".format(
-                            line.type,
-                            line.coords["X"],
-                            line.coords["Y"],
-                            line.coords["Z"],
-                            line.coords["F"],
-                        )
-                
+    e_running = 0
+    with profiler.stage("conform") as stage:
+        stage.add(len(lines))
+        profiler.count("surface_lookups", len(lines))
+        if backend == "numba" and lines and surface.packed() is not None:
+            conform_lines(lines, surface, half_width)
+            return model
+        for line_idx, line in tqdm(enumerate(lines), total=len(lines), disable=not progress):
+            e_running = conform_line(
+                line, lines[line_idx - 1], surface, half_width, e_running, line_idx == 0
+            )
+
     return model
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         prog="select_z_raise.py",
         usage="%(prog)s [options]",
@@ -130,8 +389,20 @@ def main():
         dest="loglevel",
         const=logging.INFO,
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--profile",
+        help="Print per-stage timings and counts.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        help="Print per-stage timings, counts and traced allocations (slow).",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
     logging.basicConfig(level=args.loglevel)
+    if args.profile or args.profile_memory:
+        profiler.enable(args.profile_memory)
     t1 = time.time()
     parser = GcodeParser()
     model = parser.parse_file(args.file)
@@ -145,6 +416,8 @@ def main():
     model.write("test/raised_{}.gcode".format(in_file)) #changed file path for saving output
     t2 = time.time()
     print("Completed in: {:.3f} ms".format((t2 - t1) * 1000.0))
+    if args.profile or args.profile_memory:
+        print(profiler.report())
 
 
 if __name__ == "__main__":
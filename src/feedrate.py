@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+from Gcode_Parser import GcodeParser
+from gcode_edit import FEEDRATE, set_feedrate
+from move_arrays import MoveArrays
+from print_time import estimate_time, format_duration, model_moves
+from profiler import profiler
+
+# slopes (degrees) up to which moves run at the flat feedrate, and from which at the steep one
+FLAT_ANGLE = 5.0
+STEEP_ANGLE = 45.0
+
+def slope_angles(start, end, field=None):
+    """
+    Slope in degrees under each move: that of the surface at its
+    midpoint if a NormalField is given, otherwise the rise over
+    run of the move itself, which on a conformed toolpath follows
+    the surface.
+    """
+    if field is not None:
+        middle = (start + end) / 2
+        _, normals = field.lookup(middle[:, 0], middle[:, 1])
+        return np.degrees(np.arccos(np.clip(normals[:, 2], -1.0, 1.0)))
+    run = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+    rise = np.abs(end[:, 2] - start[:, 2])
+    return np.degrees(np.arctan2(rise, run))
+
+
+def schedule_feedrates(
+    model,
+    flat_feedrate,
+    steep_feedrate,
+    flat_angle=FLAT_ANGLE,
+    steep_angle=STEEP_ANGLE,
+    field=None,
+):
+    """
+    Sets the feedrate of every extruding G1 move from the slope
+    under it: flat_feedrate (mm/min) up to flat_angle degrees,
+    steep_feedrate from steep_angle, linearly in between. Travel
+    and extruder only moves keep their feedrate. Meant for
+    conformed models, where the slope changes along a layer.
+
+    Returns a report of the moves changed and of the estimated
+    print time before and after, in seconds.
+    """
+    t1 = time.perf_counter()
+    arrays = MoveArrays(model)
+    before = estimate_time(model, arrays=arrays)
+    with profiler.stage("feedrate") as stage:
+        index, start, _, _ = model_moves(arrays)
+        end = arrays.xyz[index]
+        # split moves without extrusion have no E, the extruder stays where it was
+        has_e = np.fromiter(
+            ("E" in seg.coords for seg in arrays.segments), dtype=bool, count=len(arrays)
+        )
+        last_e = np.maximum.accumulate(np.where(has_e, np.arange(len(arrays)), -1))
+        e = np.where(last_e >= 0, arrays.e[np.maximum(last_e, 0)], 0.0)
+        e_start = np.concatenate([[0.0], e])[index]
+        angles = slope_angles(start, end, field)
+        feedrate = np.round(
+            np.interp(angles, [flat_angle, steep_angle], [flat_feedrate, steep_feedrate]), 1
+        )
+        moving = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1]) > 0
+        g1 = np.fromiter(
+            (arrays.segments[i].type == "G1" for i in index.tolist()), dtype=bool, count=len(index)
+        )
+        extruding = (
+            g1
+            & moving
+            & (e[index] > e_start)
+        )
+        old = arrays.f[index]
+        changed = extruding & (feedrate != old)
+
+        # a move without its own F runs at the one before, so it needs one
+        # written out when the move before it changes
+        follows = np.zeros(len(index), dtype=bool)
+        follows[1:] = changed[:-1]
+        for i, new in zip(index[changed].tolist(), feedrate[changed].tolist()):
+            seg = arrays.segments[i]
+            seg.coords = dict(seg.coords, F=new)
+            seg.line = set_feedrate(seg.line, new)
+        for i in index[follows & ~changed].tolist():
+            seg = arrays.segments[i]
+            if not FEEDRATE.search(seg.line.partition(";")[0]):
+                seg.line = set_feedrate(seg.line, seg.coords["F"])
+        stage.add(len(index))
+    after = estimate_time(model)
+    return {
+        "moves": len(index),
+        "moves_changed": int(np.count_nonzero(changed)),
+        "time_before": before["total"],
+        "time_after": after["total"],
+        "saving": before["total"] - after["total"],
+        "seconds": time.perf_counter() - t1,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="feedrate.py",
+        usage="%(prog)s [options]",
+        description="Sets the feedrate of conformed moves from the slope of the surface.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the conformed G-code file.")
+    parser.add_argument(
+        "--flat", help="Feedrate on flat regions in mm/min.", type=float, default=3000.0
+    )
+    parser.add_argument(
+        "--steep", help="Feedrate on steep regions in mm/min.", type=float, default=1200.0
+    )
+    parser.add_argument(
+        "--flat-angle",
+        help="Slope in degrees up to which the flat feedrate is used.",
+        type=float,
+        default=FLAT_ANGLE,
+    )
+    parser.add_argument(
+        "--steep-angle",
+        help="Slope in degrees from which the steep feedrate is used.",
+        type=float,
+        default=STEEP_ANGLE,
+    )
+    parser.add_argument("-o", "--out", help="Output path (default: feedrate_<file>).")
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    model = GcodeParser().parse_file(args.file)
+    report = schedule_feedrates(
+        model, args.flat, args.steep, args.flat_angle, args.steep_angle
+    )
+    out = args.out or os.path.join(
+        os.path.dirname(args.file), "feedrate_" + os.path.basename(args.file)
+    )
+    model.write(out)
+    print(
+        "Set the feedrate of {} of {} moves in {:.3f} ms".format(
+            report["moves_changed"], report["moves"], report["seconds"] * 1000.0
+        )
+    )
+    print(
+        "Estimated print time {} -> {} (saves {})".format(
+            format_duration(report["time_before"]),
+            format_duration(report["time_after"]),
+            format_duration(report["saving"]),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
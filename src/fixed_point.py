@@ -0,0 +1,369 @@
+import time
+import logging
+import argparse
+import numpy as np
+from Gcode_Parser import GcodeParser, Segment, Arc
+from conform_surface import EPSILON, load_surface
+from gcode_binary import format_fixed
+from gcode_edit import EXTRUSION
+from profiler import profiler
+
+AXES = ["X", "Y", "Z", "E", "F"]
+# decimals kept of each axis: microns for XYZ, nanometres of filament for E
+DECIMALS = np.array([3, 3, 3, 6, 3])
+SCALE = 10 ** DECIMALS
+_DECIMALS = dict(zip(AXES, DECIMALS.tolist()))
+_SCALES = SCALE.tolist()
+
+
+def to_fixed(values, axis):
+    """
+    Integer mantissas of values (in mm) on the fixed-point scale of axis
+    """
+    return np.round(np.asarray(values, dtype=np.float64) * SCALE[AXES.index(axis)]).astype(
+        np.int64
+    )
+
+
+def format_value(mantissa, axis):
+    """
+    Shortest text of a fixed-point value, e.g. (88700, "X") -> "88.7"
+    """
+    text = format_fixed(mantissa, _DECIMALS[axis])
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return text
+
+
+def _divide(numerator, denominator):
+    """
+    numerator / denominator rounded half up, exactly, in integers
+    """
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+class FixedMoves:
+    """
+    The segments of a parsed model as int64 fixed-point arrays
+    (see DECIMALS), one row per segment end point in file order,
+    so splitting, raising and conforming are exact integer math
+    and only the rows they change are formatted again, by
+    apply(), straight from the integers.
+
+    Only absolute moves and extrusion are supported.
+    """
+
+    def __init__(self, model):
+        if model.is_relative or model.relative_extrusion:
+            raise ValueError("Fixed-point moves need absolute moves and extrusion")
+        self.model = model
+        self.layers = list(model.layers)
+        self.lines = [line for layer in self.layers for line in layer.lines]
+        self.offsets = np.cumsum([0] + [len(layer.lines) for layer in self.layers])
+        rows = [i for i, line in enumerate(self.lines) if isinstance(line, Segment)]
+        segments = [self.lines[i] for i in rows]
+        n = len(segments)
+        # row of each line the row is (part of) the end point of
+        self.owner = np.array(rows, dtype=np.int64)
+
+        coords = np.full((n, len(AXES)), np.nan)
+        for i, seg in enumerate(segments):
+            for j, axis in enumerate(AXES):
+                if axis in seg.coords:
+                    coords[i, j] = seg.coords[axis]
+        # split segments without extrusion have no E, the extruder stays where it was
+        e = coords[:, 3]
+        known = np.maximum.accumulate(np.where(np.isnan(e), -1, np.arange(n)))
+        start = model.start_coords()
+        coords[:, 3] = np.where(known >= 0, e[np.maximum(known, 0)], start["E"])
+        self.coords = np.zeros((n, len(AXES)), dtype=np.int64)
+        for j, axis in enumerate(AXES):
+            self.coords[:, j] = to_fixed(np.nan_to_num(coords[:, j]), axis)
+        self.start = np.array([to_fixed(start.get(axis, 0.0), axis) for axis in AXES])
+
+        self.move = np.fromiter(
+            (seg.type in ("G0", "G1") and not isinstance(seg, Arc) for seg in segments),
+            dtype=bool,
+            count=n,
+        )
+        self.arc = np.fromiter((isinstance(seg, Arc) for seg in segments), dtype=bool, count=n)
+        # G92 and G28 set the position instead of moving to it
+        self.reset = np.fromiter(
+            (seg.type in ("G92", "G28") for seg in segments), dtype=bool, count=n
+        )
+        self.g92 = np.fromiter((seg.type == "G92" for seg in segments), dtype=bool, count=n)
+        self.e_text = np.fromiter(
+            ("E" in seg.line.partition(";")[0] for seg in segments), dtype=bool, count=n
+        )
+        self.changed = np.zeros(n, dtype=bool)
+
+    def __len__(self):
+        return len(self.owner)
+
+    def previous(self):
+        """
+        Start point of each row: E of the row before it, and XYZ
+        of the last row before it which is not a G92, as setting
+        the position does not move and G92 rows are never raised.
+        """
+        n = len(self)
+        previous = np.vstack([self.start, self.coords[:-1]])
+        moved = np.maximum.accumulate(np.where(self.g92, -1, np.arange(n)))
+        moved = np.concatenate([[-1], moved[:-1]])
+        previous[:, :3] = np.where(
+            (moved >= 0)[:, None], self.coords[np.maximum(moved, 0), :3], self.start[:3]
+        )
+        return previous
+
+    def mm(self, axis):
+        """
+        Values of an axis in mm, e.g. to select rows to raise
+        """
+        j = AXES.index(axis)
+        return self.coords[:, j] / SCALE[j]
+
+    def split(self, max_seg_length):
+        """
+        Splits every G0/G1 move longer than max_seg_length into
+        equal parts. The points are rounded to the nearest micron
+        (nanometre of E) once, from the exact integer ends of the
+        move, so the last part ends exactly where the move did and
+        no extrusion is lost or gained.
+
+        G2/G3 arcs are replaced by G1 chords of at most
+        max_seg_length of arc, which can then be conformed.
+        """
+        with profiler.stage("split") as stage:
+            start = self.previous()
+            delta = self.coords - start
+            length = np.linalg.norm(delta[:, :3] / SCALE[:3], axis=1)
+            arcs = np.flatnonzero(self.arc)
+            length[arcs] = [self.lines[i].length() for i in self.owner[arcs].tolist()]
+            parts = np.where(
+                (self.move | self.arc) & (length > max_seg_length),
+                np.ceil(length / max_seg_length).astype(np.int64),
+                1,
+            )
+            stage.add(len(self))
+            if (parts == 1).all() and not len(arcs):
+                return self
+            row = np.repeat(np.arange(len(self)), parts)
+            # 1..parts for each row
+            first = np.cumsum(parts) - parts
+            k = np.arange(len(row)) - np.repeat(first, parts) + 1
+            count = parts[row]
+            coords = start[row] + _divide(delta[row] * k[:, None], count[:, None])
+            # the feedrate is not interpolated
+            coords[:, 4] = self.coords[row, 4]
+
+            # chords end on the arc, the last one where the arc does
+            chords = np.flatnonzero(self.arc[row] & (k < count))
+            for i, owner in zip(chords.tolist(), self.owner[row[chords]].tolist()):
+                arc = self.lines[owner]
+                if arc.sweep:
+                    angle = arc.angle + arc.sweep * k[i] / count[i]
+                    coords[i, 0] = to_fixed(arc.centre[0] + arc.radius * np.cos(angle), "X")
+                    coords[i, 1] = to_fixed(arc.centre[1] + arc.radius * np.sin(angle), "Y")
+
+            self.coords = coords
+            self.owner = self.owner[row]
+            self.changed = self.changed[row] | (count > 1) | self.arc[row]
+            self.move = self.move[row] | self.arc[row]
+            self.arc = np.zeros(len(row), dtype=bool)
+            self.reset = self.reset[row]
+            self.g92 = self.g92[row]
+            self.e_text = self.e_text[row]
+            profiler.count("split_segments", len(row) - len(parts))
+        return self
+
+    def raise_z(self, mask, amount):
+        """
+        Raises the moves selected by a boolean mask by amount mm
+        """
+        mask = mask & self.move
+        self.coords[mask, 2] += to_fixed(amount, "Z")
+        self.changed |= mask
+        return self
+
+    def conform(self, surface, half_width):
+        """
+        Raises every move onto the surface (a SurfaceIndex, or the
+        point cloud strings load_surface takes) plus EPSILON, as
+        conform_surface.increase_z does, and scales the extrusion
+        of each extruding move by how much longer raising made it.
+        E is then accumulated again from the integer extrusion of
+        each move, restarting at every G92, so it does not drift.
+        """
+        surface = load_surface(surface)
+        with profiler.stage("conform") as stage:
+            n = len(self)
+            x = self.mm("X")
+            y = self.mm("Y")
+            packed = surface.packed()
+            if packed is not None:
+                from kernels import BACKEND, window_max, window_max_arrays
+
+                z_max = np.zeros(n)
+                kernel = window_max if BACKEND == "numba" else window_max_arrays
+                kernel(x, y, half_width, surface.cell_size, *packed, z_max)
+            else:
+                z_max = np.array(
+                    [surface.max_z(*point, half_width) for point in zip(x.tolist(), y.tolist())]
+                )
+            profiler.count("surface_lookups", n)
+            before = np.linalg.norm(self.coords[:, :3] - self.previous()[:, :3], axis=1)
+            raised = self.move & (z_max != 0)
+            self.coords[raised, 2] += to_fixed(z_max[raised] + EPSILON, "Z")
+            start = self.previous()
+            after = np.linalg.norm(self.coords[:, :3] - start[:, :3], axis=1)
+
+            extrusion = np.where(self.reset, 0, self.coords[:, 3] - start[:, 3])
+            scaled = self.move & (extrusion > 0) & (before > 0) & (after != before)
+            factor = after[scaled] / before[scaled]
+            extrusion[scaled] = np.round(extrusion[scaled] * factor).astype(np.int64)
+
+            # absolute E from the position set by the last G92 before each row
+            total = np.cumsum(extrusion)
+            last = np.maximum.accumulate(np.where(self.reset, np.arange(n), -1))
+            base = np.where(
+                last >= 0,
+                self.coords[np.maximum(last, 0), 3] - total[np.maximum(last, 0)],
+                self.start[3],
+            )
+            e = base + total
+            self.changed |= raised | (e != self.coords[:, 3])
+            self.coords[:, 3] = e
+            stage.add(n)
+        return self
+
+    def apply(self):
+        """
+        Writes the rows back into the lines of the model, adding
+        the parts of split moves after the line they came from.
+        Returns the model.
+        """
+        with profiler.stage("fixed_apply") as stage:
+            changed = np.flatnonzero(self.changed)
+            parts = {}
+            last = np.ones(len(changed), dtype=bool)
+            last[:-1] = self.owner[changed][1:] != self.owner[changed][:-1]
+            for owner, values, move, e_text, end in zip(
+                self.owner[changed].tolist(),
+                self.coords[changed].tolist(),
+                self.move[changed].tolist(),
+                self.e_text[changed].tolist(),
+                last.tolist(),
+            ):
+                parts.setdefault(owner, []).append((values, move, e_text, end))
+            for layer, start, stop in zip(self.layers, self.offsets[:-1], self.offsets[1:]):
+                if not any(i in parts for i in range(start, stop)):
+                    continue
+                lines = []
+                for i in range(start, stop):
+                    seg = self.lines[i]
+                    rows = parts.get(i)
+                    if rows is None:
+                        lines.append(seg)
+                        continue
+                    for row in rows:
+                        if row[3] and not (isinstance(seg, Arc) and row[1]):
+                            seg.coords = _coords(row[0], seg)
+                            seg.line = _text(*row, seg)
+                            lines.append(seg)
+                            continue
+                        # parts of a split move, and the chords of an arc
+                        piece = Segment(
+                            "G1" if isinstance(seg, Arc) else seg.type,
+                            _coords(row[0], seg),
+                            seg.line_num,
+                            _text(*row, seg),
+                        )
+                        piece.style = seg.style
+                        piece.layer_idx = seg.layer_idx
+                        lines.append(piece)
+                layer.lines = lines
+            self.model.segments = [line for layer in self.model.layers for line in layer.lines]
+            self.model.calc_metrics()
+            stage.add(len(changed))
+        return self.model
+
+
+def _text(values, move, e_text, last, seg):
+    """
+    G-code of a row of values for the segment it belongs to,
+    the last row of the segment keeps its comment
+    """
+    x, y, z, e, f = values
+    command, semicolon, comment = seg.line.partition(";")
+    if not move:
+        # arcs keep their words, only E can have changed
+        return EXTRUSION.sub("E" + format_value(e, "E"), command, count=1) + semicolon + comment
+    words = [
+        "G1" if isinstance(seg, Arc) else seg.type,
+        "X" + format_value(x, "X"),
+        "Y" + format_value(y, "Y"),
+        "Z" + format_value(z, "Z"),
+    ]
+    if e_text:
+        words.append("E" + format_value(e, "E"))
+    words.append("F" + format_value(f, "F"))
+    if last and semicolon:
+        words.append(semicolon + comment)
+    return " ".join(words)
+
+
+def _coords(values, seg):
+    coords = {axis: value / scale for axis, value, scale in zip(AXES, values, _SCALES)}
+    if "E" not in seg.coords:
+        del coords["E"]
+    return coords
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="fixed_point.py",
+        usage="%(prog)s [options]",
+        description="Splits and conforms a G-code file with fixed-point integer coordinates.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the G-code file.")
+    parser.add_argument("-o", "--out", required=True, help="Output path.")
+    parser.add_argument(
+        "-l", "--length", help="Split moves into this length in mm.", type=float, default=1.0
+    )
+    parser.add_argument("-s", "--surface", help="Point cloud file to conform onto.")
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    model = GcodeParser().parse_file(args.file)
+    t1 = time.perf_counter()
+    moves = FixedMoves(model).split(args.length)
+    if args.surface:
+        with open(args.surface) as f:
+            moves.conform(f.read().splitlines(), args.length * 0.5)
+    moves.apply().write(args.out)
+    print(
+        "Wrote {} moves in fixed point in {:.3f} ms".format(
+            len(moves), (time.perf_counter() - t1) * 1000.0
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import re
+import struct
+from itertools import islice
+import numpy as np
+from gcode_io import BINARY_EXTENSION
+from profiler import profiler
+
+# binary G-code files start with this and end in this extension
+MAGIC = b"GCB\x02"
+EXTENSION = BINARY_EXTENSION
+
+# line tags, text lines are 0 and the move shapes defined in the file are numbered from 1
+TEXT = 0
+# the tags are unsigned shorts
+MAX_SHAPES = (1 << 16) - 1
+# lines per block, a block is decoded at once
+BLOCK_LINES = 1 << 16
+
+AXES = "XYZEF"
+# smallest numpy code each column of deltas fits in
+WIDTHS = [("i1", 1 << 7), ("i2", 1 << 15), ("i4", 1 << 31), ("i8", 1 << 63)]
+# how a move's value is written back: fixed-point values with fewer digits
+# than FAST_MANTISSA divide exactly with numpy and survive "%.*f", others
+# are Python's shortest repr of the float or else kept digit for digit
+FAST, SHORTEST, EXACT = range(3)
+FAST_MANTISSA = 10**15
+SCALES = np.array([10**d for d in range(16)], dtype=np.float64)
+# changes of larger mantissas might not fit the int64 columns
+MAX_MANTISSA = 1 << 62
+
+# lines, shapes defined and text lines of a block
+_BLOCK = struct.Struct("<IHI")
+# decimals, changes, their width and the changes too wide for it in a column
+_COLUMN = struct.Struct("<BI2sI")
+_MOVE = re.compile(r"(G[01])((?: [XYZEF]-?\d+(?:\.\d+)?)+)")
+
+
+def format_fixed(mantissa, decimals):
+    """
+    Text of the fixed-point number mantissa * 10 ** -decimals,
+    e.g. (-1250, 3) -> "-1.250"
+    """
+    sign = "-" if mantissa < 0 else ""
+    digits = str(abs(mantissa))
+    if not decimals:
+        return sign + digits
+    digits = digits.rjust(decimals + 1, "0")
+    return sign + digits[:-decimals] + "." + digits[-decimals:]
+
+
+def pack_move(text):
+    """
+    Splits a move into (type, axes, mantissas, decimals) if it
+    is written exactly as format_move would write it again,
+    otherwise returns None and the line is kept as text.
+    """
+    match = _MOVE.fullmatch(text)
+    if match is None:
+        return None
+    axes = []
+    mantissas = []
+    decimals = []
+    for token in match.group(2).split():
+        axis, value = token[0], token[1:]
+        if axes and AXES.index(axis) <= AXES.index(axes[-1]):
+            return None
+        whole, _, fraction = value.partition(".")
+        mantissa = int(whole + fraction)
+        if abs(mantissa) >= MAX_MANTISSA or len(fraction) > 255:
+            return None
+        if format_fixed(mantissa, len(fraction)) != value:
+            return None
+        axes.append(axis)
+        mantissas.append(mantissa)
+        decimals.append(len(fraction))
+    return match.group(1), axes, mantissas, decimals
+
+
+def format_move(type, axes, mantissas, decimals):
+    return " ".join(
+        [type]
+        + [axis + format_fixed(m, d) for axis, m, d in zip(axes, mantissas, decimals)]
+    )
+
+
+def encode_lines(lines, block_lines=BLOCK_LINES):
+    """
+    Encodes G-code lines into binary blocks, yielding the bytes
+    of each block.
+
+    Each block of block_lines lines holds the tag of every line,
+    the text lines, and per axis and decimals one column of the
+    changes of the moves giving that axis with those decimals,
+    in fixed-point, in the integer type making the column
+    smallest, the few changes too wide for it following as
+    int64 with their index. A move's tag is its shape (type,
+    axes, decimals and how each value is written back), defined
+    in the block it is first used in. Moves which would not be
+    written back identically are kept as text.
+    """
+    yield MAGIC
+    shapes = {}
+    previous = {}
+    lines = iter(lines)
+    while True:
+        block = list(islice(lines, block_lines))
+        if not block:
+            break
+        tags = []
+        texts = []
+        defined = []
+        deltas = {axis: {} for axis in AXES}
+        for text in block:
+            move = pack_move(text)
+            tag = None
+            if move is not None:
+                type, axes, mantissas, decimals = move
+                styles = tuple(map(_style, mantissas, decimals))
+                key = (type, "".join(axes), tuple(decimals), styles)
+                tag = shapes.get(key)
+                if tag is None and len(shapes) < MAX_SHAPES:
+                    tag = shapes[key] = len(shapes) + 1
+                    defined.append(key)
+            if tag is None:
+                tags.append(TEXT)
+                texts.append(text.encode())
+                continue
+            tags.append(tag)
+            for axis, m, d in zip(axes, mantissas, decimals):
+                deltas[axis].setdefault(d, []).append(m - previous.get((axis, d), 0))
+                previous[axis, d] = m
+
+        parts = [_BLOCK.pack(len(block), len(defined), len(texts))]
+        for type, axes, decimals, styles in defined:
+            parts.append(struct.pack("<BB", int(type[1]), len(axes)))
+            parts.extend(
+                axis.encode() + struct.pack("<BB", d, style)
+                for axis, d, style in zip(axes, decimals, styles)
+            )
+        parts.append(np.array(tags, dtype="<u2").tobytes())
+        parts.append(np.array([len(text) for text in texts], dtype="<u4").tobytes())
+        parts.extend(texts)
+        for axis in AXES:
+            parts.append(struct.pack("<B", len(deltas[axis])))
+            for d, column in sorted(deltas[axis].items()):
+                parts.extend(_encode_column(d, np.array(column, dtype=np.int64)))
+        yield b"".join(parts)
+
+
+def _style(mantissa, decimals):
+    if abs(mantissa) < FAST_MANTISSA and decimals < len(SCALES):
+        return FAST
+    if repr(mantissa / 10**decimals) == format_fixed(mantissa, decimals):
+        return SHORTEST
+    return EXACT
+
+
+def _encode_column(decimals, column):
+    """
+    Bytes of a column of changes, in the width taking the
+    fewest bytes once the changes too wide for it are added
+    """
+    best = None
+    for code, bound in WIDTHS:
+        wide = np.flatnonzero((column >= bound) | (column < -bound))
+        size = len(column) * int(code[1]) + 12 * len(wide)
+        if best is None or size < best[0]:
+            best = (size, code, wide)
+    _, code, wide = best
+    narrow = column.copy()
+    narrow[wide] = 0
+    return [
+        _COLUMN.pack(decimals, len(column), code.encode(), len(wide)),
+        narrow.astype("<" + code).tobytes(),
+        wide.astype("<u4").tobytes(),
+        column[wide].astype("<i8").tobytes(),
+    ]
+
+
+def read_blocks(fp):
+    """
+    Decodes binary G-code from a file object a block at a time,
+    yielding (tags, lines, values, shapes) per block: the tag of
+    each line, the text of every line, the (lines, 5) XYZEF
+    values of the moves and the shapes defined so far, (type,
+    axes) by tag. The changes of each axis are summed with numpy.
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a binary G-code file")
+    shapes = [None]
+    # per tag, the axes it gives, their decimals and styles, its move format if all are fast
+    given = [[False] * len(AXES)]
+    decimals = [[0] * len(AXES)]
+    fast = [[False] * len(AXES)]
+    specs = [None]
+    formats = [None]
+    columns = [None]
+    previous = np.zeros((len(AXES), 256), dtype=np.int64)
+    while True:
+        header = fp.read(_BLOCK.size)
+        if not header:
+            break
+        count, defined, text_count = _BLOCK.unpack(header)
+        for _ in range(defined):
+            type, axis_count = struct.unpack("<BB", fp.read(2))
+            fields = struct.unpack("<" + "cBB" * axis_count, fp.read(3 * axis_count))
+            spec = [(axis.decode(), d, style) for axis, d, style in zip(*[iter(fields)] * 3)]
+            axes = [axis for axis, _, _ in spec]
+            type = "G{}".format(type)
+            shapes.append((type, axes))
+            specs.append(spec)
+            given.append([axis in axes for axis in AXES])
+            decimals.append([next((d for a, d, _ in spec if a == axis), 0) for axis in AXES])
+            fast.append([any(a == axis and style == FAST for a, _, style in spec) for axis in AXES])
+            formats.append(
+                " ".join([type] + ["{}%.{}f".format(a, d) for a, d, _ in spec])
+                if all(style == FAST for _, _, style in spec)
+                else None
+            )
+            columns.append([AXES.index(axis) for axis in axes])
+        shape_given = np.array(given)
+        shape_decimals = np.array(decimals)
+        shape_fast = np.array(fast)
+        tags = np.frombuffer(fp.read(2 * count), dtype="<u2")
+        lengths = np.frombuffer(fp.read(4 * text_count), dtype="<u4").tolist()
+        data = fp.read(sum(lengths))
+        mantissas = np.zeros((count, len(AXES)), dtype=np.int64)
+        values = np.zeros((count, len(AXES)))
+        for column in range(len(AXES)):
+            given_rows = np.flatnonzero(shape_given[tags, column])
+            given_decimals = shape_decimals[tags[given_rows], column]
+            for _ in range(fp.read(1)[0]):
+                d, size, code, wide = _COLUMN.unpack(fp.read(_COLUMN.size))
+                dtype = np.dtype("<" + code.decode())
+                deltas = np.frombuffer(fp.read(size * dtype.itemsize), dtype=dtype).astype(np.int64)
+                if wide:
+                    index = np.frombuffer(fp.read(4 * wide), dtype="<u4")
+                    deltas[index] = np.frombuffer(fp.read(8 * wide), dtype="<i8")
+                rows = given_rows[given_decimals == d]
+                mantissas[rows, column] = previous[column, d] + np.cumsum(deltas, dtype=np.int64)
+                previous[column, d] = mantissas[rows[-1], column]
+                if d < len(SCALES):
+                    # exact integers over exact powers of ten, the same floats as float(text)
+                    rows = rows[shape_fast[tags[rows], column]]
+                    values[rows, column] = mantissas[rows, column] / SCALES[d]
+
+        lines = [None] * count
+        # the lines of each tag in turn, formatting only the columns it gives
+        order = np.argsort(tags, kind="stable")
+        used, starts = np.unique(tags[order], return_index=True)
+        for tag, rows in zip(used.tolist(), np.split(order, starts[1:])):
+            if tag == TEXT:
+                ends = np.cumsum(lengths).tolist()
+                for row, start, end in zip(rows.tolist(), [0] + ends, ends):
+                    lines[row] = data[start:end].decode()
+                continue
+            picked = np.ix_(rows, columns[tag])
+            if formats[tag] is not None:
+                format = formats[tag]
+                for row, value in zip(rows.tolist(), values[picked].tolist()):
+                    lines[row] = format % tuple(value)
+                continue
+            type = shapes[tag][0]
+            spec = specs[tag]
+            moves = []
+            for row, row_mantissas, value in zip(
+                rows.tolist(), mantissas[picked].tolist(), values[picked].tolist()
+            ):
+                words = [type]
+                for i, (axis, d, style) in enumerate(spec):
+                    if style == FAST:
+                        words.append("%s%.*f" % (axis, d, value[i]))
+                        continue
+                    # correctly rounded int division, the same float as float(text)
+                    value[i] = row_mantissas[i] / 10**d
+                    if style == SHORTEST:
+                        words.append(axis + repr(value[i]))
+                    else:
+                        words.append(axis + format_fixed(row_mantissas[i], d))
+                lines[row] = " ".join(words)
+                moves.append(value)
+            values[picked] = moves
+        yield tags, lines, values, shapes
+
+
+def decode_lines(fp):
+    """
+    Text of the lines of binary G-code, identical to
+    the lines it was encoded from.
+    """
+    for _, lines, _, _ in read_blocks(fp):
+        yield from lines
+
+
+def write_binary(lines, fp):
+    """
+    Writes G-code lines to a binary file object
+    """
+    for block in encode_lines(lines):
+        fp.write(block)
+
+
+def parse_binary(parser, fp):
+    """
+    Builds the model of binary G-code as parse_lines would for its
+    text, a block at a time. The moves are decoded straight into
+    the columns parallel_parse.add_lines takes, so only the text
+    lines are tokenized and parsed.
+    """
+    from parallel_parse import MOVE, add_lines, tokenize_line
+
+    with profiler.stage("parse") as stage:
+        parser.line_num = 0
+        for tags, texts, values, shapes in read_blocks(fp):
+            # tokens of the lines changing the position, in line order
+            kinds = np.where(tags != TEXT, MOVE, -1).astype(np.int8)
+            bitmasks = [0] + [sum(1 << AXES.index(axis) for axis in axes) for _, axes in shapes[1:]]
+            mask = np.array(bitmasks, dtype=np.uint8)[tags]
+            values = values.copy()
+            types = [shapes[tag][0] if tag != TEXT else None for tag in tags.tolist()]
+            for row in np.flatnonzero(tags == TEXT).tolist():
+                token = tokenize_line(texts[row])
+                if token is not None:
+                    kinds[row], mask[row], values[row], types[row] = token
+            add_lines(parser, texts, types, kinds, mask, values)
+            stage.add(len(tags))
+        parser.model.post_process()
+    return parser.model
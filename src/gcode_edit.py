@@ -0,0 +1,30 @@
+import re
+
+# F and E words of a command, not inside other words
+FEEDRATE = re.compile(r"(?<=\s)F-?\d+(?:\.\d+)?")
+EXTRUSION = re.compile(r"(?<=\s)E-?\d+(?:\.\d+)?")
+
+
+def set_feedrate(text, f):
+    """
+    text with its F word set to f, added after the other words if missing
+    """
+    command, semicolon, comment = text.partition(";")
+    value = "F{}".format(f)
+    if FEEDRATE.search(command):
+        command = FEEDRATE.sub(value, command, count=1)
+    else:
+        command = command.rstrip() + " " + value + (" " if semicolon else "")
+    return command + semicolon + comment
+
+
+def relative_anywhere(model):
+    """
+    True if any part of the model moves or extrudes relatively,
+    not only at the end of the file
+    """
+    return (
+        model.is_relative
+        or model.relative_extrusion
+        or any(line.type in ("G91", "M83") for layer in model.layers for line in layer.lines)
+    )
@@ -0,0 +1,68 @@
+import io
+import os
+import bz2
+import gzip
+import lzma
+
+
+def _zstd_open(path, mode):
+    # zstd is only in the standard library from Python 3.14
+    try:
+        from compression import zstd
+    except ImportError:
+        try:
+            import zstandard as zstd
+        except ImportError:
+            raise ValueError(
+                "Reading or writing '{}' needs Python 3.14 or the zstandard package".format(path)
+            )
+    return zstd.open(path, mode)
+
+
+# extension of binary G-code files, see gcode_binary
+BINARY_EXTENSION = ".gcb"
+
+# compressed file extension -> function opening it like open(path, mode)
+CODECS = {
+    ".gz": lambda path, mode: gzip.open(path, mode, compresslevel=6),
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+    ".lzma": lzma.open,
+    ".zst": _zstd_open,
+}
+
+
+def split_compression(path):
+    """
+    Splits the compression extension off a path,
+    e.g. "part.gcode.gz" -> ("part.gcode", ".gz")
+    """
+    root, ext = os.path.splitext(path)
+    if ext.lower() in CODECS:
+        return root, ext.lower()
+    return path, ""
+
+
+def open_gcode(path, mode="r"):
+    """
+    Opens a G-code (or point cloud) file as text, compressed
+    files are decompressed or compressed on the fly in chunks
+    as they are read or written, chosen by their extension.
+
+    Parameters::
+            path - file path, ending in e.g. .gz, .bz2, .xz or .zst if compressed
+            mode - "r" to read, "w" to write, "rb"/"wb" for binary G-code
+    """
+    _, ext = split_compression(path)
+    if not ext:
+        return open(path, mode)
+    binary = "b" in mode
+    f = CODECS[ext](path, mode.replace("+", "").replace("t", "").replace("b", "") + "b")
+    return f if binary else io.TextIOWrapper(f)
+
+
+def is_binary(path):
+    """
+    True for binary G-code (.gcb) files, compressed or not
+    """
+    return os.path.splitext(split_compression(path)[0])[1].lower() == BINARY_EXTENSION
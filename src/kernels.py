@@ -0,0 +1,209 @@
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# compiled kernels when numba is importable, the plain Python loops otherwise.
+# Only the conforming loops (window scan and E compensation) have kernels,
+# parsing, splitting and classifying build Python objects per line and stay
+# as they are on both backends
+BACKENDS = ["python", "numba"]
+BACKEND = "numba" if numba is not None else "python"
+
+
+def available_backends():
+    return [backend for backend in BACKENDS if backend == "python" or numba is not None]
+
+
+def check_backend(backend):
+    """
+    The backend to use, the default one if backend is None
+    """
+    if backend is None:
+        return BACKEND
+    if backend not in available_backends():
+        raise ValueError(
+            "Unknown or unavailable backend '{}', choose from {}".format(
+                backend, available_backends()
+            )
+        )
+    return backend
+
+
+def jit(func):
+    """
+    Compiles func with numba in nopython mode if it is installed,
+    otherwise returns it unchanged so it still runs (slowly) as
+    Python.
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True)(func)
+
+
+def pack_cells(cells, cell_size):
+    """
+    Flattens the grid hash of a SurfaceIndex into arrays the
+    kernels can scan: the points of every cell stored contiguously
+    in XY, Z arrays and a dense table of the offset of each cell.
+
+    Returns (origin_x, origin_y, nx, ny, starts, xs, ys, zs).
+    """
+    if not cells:
+        empty = np.zeros(0)
+        return 0, 0, 0, 0, np.zeros(1, dtype=np.int64), empty, empty, empty
+    keys = np.array(list(cells), dtype=np.int64)
+    ox, oy = keys.min(axis=0)
+    nx, ny = keys.max(axis=0) - (ox, oy) + 1
+    flat = (keys[:, 0] - ox) * ny + (keys[:, 1] - oy)
+    counts = np.zeros(nx * ny, dtype=np.int64)
+    counts[flat] = [len(points) for points in cells.values()]
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    points = np.zeros((starts[-1], 3))
+    for index, cell in zip(flat.tolist(), cells.values()):
+        points[starts[index] : starts[index + 1]] = [coord[:3] for coord in cell]
+    return (
+        int(ox), int(oy), int(nx), int(ny), starts,
+        np.ascontiguousarray(points[:, 0]),
+        np.ascontiguousarray(points[:, 1]),
+        np.ascontiguousarray(points[:, 2]),
+    )
+
+
+@jit
+def window_max(qx, qy, half_width, cell_size, ox, oy, nx, ny, starts, xs, ys, zs, out):
+    """
+    SurfaceIndex.max_z of every (qx, qy) query point into out
+    """
+    for q in range(len(qx)):
+        x = qx[q]
+        y = qy[q]
+        found = False
+        z_max = 0.0
+        for ix in range(
+            math.floor((x - half_width) / cell_size), math.floor((x + half_width) / cell_size) + 1
+        ):
+            if ix < ox or ix >= ox + nx:
+                continue
+            for iy in range(
+                math.floor((y - half_width) / cell_size),
+                math.floor((y + half_width) / cell_size) + 1,
+            ):
+                if iy < oy or iy >= oy + ny:
+                    continue
+                cell = (ix - ox) * ny + (iy - oy)
+                for p in range(starts[cell], starts[cell + 1]):
+                    if abs(x - xs[p]) < half_width and abs(y - ys[p]) < half_width:
+                        if not found or zs[p] > z_max:
+                            z_max = zs[p]
+                            found = True
+        out[q] = z_max
+
+
+def window_max_arrays(
+    qx, qy, half_width, cell_size, ox, oy, nx, ny, starts, xs, ys, zs, out, chunk=1 << 16
+):
+    """
+    window_max with numpy, for when numba is not installed: for
+    each cell offset in the window, the points of the cell under
+    every query point are gathered at once and reduced with
+    np.maximum.at, a chunk of query points at a time.
+    """
+    out[:] = 0.0
+    if not nx:
+        return
+    for lo in range(0, len(qx), chunk):
+        x = qx[lo : lo + chunk]
+        y = qy[lo : lo + chunk]
+        x0 = np.floor((x - half_width) / cell_size).astype(np.int64)
+        x1 = np.floor((x + half_width) / cell_size).astype(np.int64)
+        y0 = np.floor((y - half_width) / cell_size).astype(np.int64)
+        y1 = np.floor((y + half_width) / cell_size).astype(np.int64)
+        best = np.full(len(x), -np.inf)
+        for dx in range(int((x1 - x0).max()) + 1):
+            ix = x0 + dx
+            for dy in range(int((y1 - y0).max()) + 1):
+                iy = y0 + dy
+                q = np.flatnonzero(
+                    (ix <= x1) & (iy <= y1)
+                    & (ix >= ox) & (ix < ox + nx) & (iy >= oy) & (iy < oy + ny)
+                )
+                cell = (ix[q] - ox) * ny + (iy[q] - oy)
+                begin = starts[cell]
+                count = starts[cell + 1] - begin
+                total = int(count.sum())
+                if not total:
+                    continue
+                # every (query, point of its cell) pair
+                pair_q = np.repeat(q, count)
+                pair_p = np.repeat(begin - (np.cumsum(count) - count), count) + np.arange(total)
+                inside = (np.abs(x[pair_q] - xs[pair_p]) < half_width) & (
+                    np.abs(y[pair_q] - ys[pair_p]) < half_width
+                )
+                np.maximum.at(best, pair_q[inside], zs[pair_p[inside]])
+        out[lo : lo + chunk] = np.where(np.isfinite(best), best, 0.0)
+
+
+# how conform_line leaves the text of a segment
+KEEP = 0
+WRITE_E = 1
+WRITE_NO_E = 2
+
+
+@jit
+def compensate_e(x, y, z, e, z_max, reset, g1, e_text, epsilon, out_z, out_e, rewrite):
+    """
+    The raise and extrusion compensation of conform_line applied
+    to all the segments in order, a segment without E has E 0.
+    The first segment is compared with the last one as it is
+    before conforming, as in increase_z.
+
+    Parameters::
+            x, y, z, e - coordinates of the segments
+            z_max - surface height under each segment, 0 if none
+            reset - the segment is a "G92 E0"
+            g1 - the segment is a G1 move, the only ones rewritten
+            e_text - E is given in the text of the segment
+            out_z, out_e - conformed Z and E
+            rewrite - KEEP, WRITE_E or WRITE_NO_E, how to rewrite the text
+    """
+    n = len(x)
+    e_running = 0.0
+    for i in range(n):
+        if reset[i]:
+            e_running = 0.0
+        p = i - 1 if i > 0 else n - 1
+        prev_z = out_z[p] if i > 0 else z[p]
+        prev_e = out_e[p] if i > 0 else e[p]
+        zi = z[i]
+        if z_max[i]:
+            zi = z_max[i] + zi + epsilon
+        ei = e[i]
+        z_diff = abs(prev_z - zi)
+        if ei and prev_e and (z_max[i] or z_diff):
+            if i > 0:
+                x_diff = abs(x[p] - x[i])
+                y_diff = abs(y[p] - y[i])
+                z_diff = abs(prev_z - zi)
+                distance = math.sqrt((x_diff ** 2) + (y_diff ** 2))
+                if distance > 0:
+                    factor = math.sqrt((distance ** 2) + (z_diff ** 2)) / distance
+                    ei = ei + e_running
+                    e_diff = abs(prev_e - ei)
+                    new_e = prev_e + (e_diff * factor)
+                    e_running = e_running + (new_e - ei)
+                    ei = new_e
+            rewrite[i] = WRITE_E if g1[i] else KEEP
+        elif g1[i]:
+            if ei and e_text[i]:
+                ei += e_running
+                rewrite[i] = WRITE_E
+            else:
+                rewrite[i] = WRITE_NO_E
+        else:
+            rewrite[i] = KEEP
+        out_z[i] = zi
+        out_e[i] = ei
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import logging
+import argparse
+from Gcode_Parser import GcodeParser, Segment
+from gcode_io import split_compression, is_binary
+from profiler import profiler
+
+# saved next to the G-code file as <path> + SUFFIX
+SUFFIX = ".layers.json"
+
+
+def _state(model):
+    """
+    Modal state of the model needed to carry on parsing
+    """
+    return {
+        "relative": dict(model.relative),
+        "offset": dict(model.offset),
+        "is_relative": model.is_relative,
+        "relative_extrusion": model.relative_extrusion,
+    }
+
+
+class LayerIndex:
+    """
+    Byte offset, line number and starting machine state of each
+    layer of a plain text G-code file, so any range of layers can
+    be parsed without reading the lines before it. Layers are
+    those of GcodeModel.classify_segments, starting at the first
+    extruding move at a new Z.
+    """
+
+    def __init__(self, path, layers, size, mtime_ns):
+        self.path = path
+        self.layers = layers
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    def __len__(self):
+        return len(self.layers)
+
+    @classmethod
+    def build(cls, path):
+        """
+        Parses the whole file, recording each layer as it starts.
+        Returns the index and the parsed model.
+        """
+        if split_compression(path)[1] or is_binary(path):
+            raise ValueError("Layer index needs a plain text G-code file, not '{}'".format(path))
+        stat = os.stat(path)
+        parser = GcodeParser()
+        model = parser.model
+        layer_idx, layer_z = model.start_layer
+        coords = model.start_coords()
+        layers = [
+            dict(
+                layer=0,
+                z=0.0,
+                previous_z=0.0,
+                line=1,
+                byte_offset=0,
+                start=dict(coords),
+                **_state(model)
+            )
+        ]
+        offset = 0
+        with profiler.stage("parse") as stage:
+            with open(path, "rb") as f:
+                for raw in f:
+                    parser.line_num += 1
+                    parser.line = raw.decode().rstrip()
+                    state = _state(model)
+                    count = len(model.segments)
+                    parser.parse_line()
+                    # same layer change rule as classify_segments
+                    for seg in model.segments[count:]:
+                        if not isinstance(seg, Segment):
+                            continue
+                        if seg.coords["E"] > coords["E"] and seg.coords["Z"] != layer_z:
+                            layer_idx += 1
+                            layers.append(
+                                dict(
+                                    layer=layer_idx,
+                                    z=seg.coords["Z"],
+                                    previous_z=layer_z,
+                                    line=parser.line_num,
+                                    byte_offset=offset,
+                                    start=dict(coords),
+                                    **state
+                                )
+                            )
+                            layer_z = seg.coords["Z"]
+                        coords = seg.coords
+                    offset += len(raw)
+            model.post_process()
+            stage.add(parser.line_num)
+        return cls(path, layers, stat.st_size, stat.st_mtime_ns), model
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads the saved index of path, None if there is none
+        or the file changed since it was built.
+        """
+        try:
+            with open(path + SUFFIX) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        stat = os.stat(path)
+        if data["size"] != stat.st_size or data["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        return cls(path, data["layers"], data["size"], data["mtime_ns"])
+
+    @classmethod
+    def open(cls, path):
+        """
+        Saved index of path, built and saved if missing or stale
+        """
+        index = cls.load(path)
+        if index is None:
+            profiler.miss("layer_index")
+            index, _ = cls.build(path)
+            index.save()
+        else:
+            profiler.hit("layer_index")
+        return index
+
+    def save(self):
+        with open(self.path + SUFFIX, "w") as f:
+            json.dump(
+                {"size": self.size, "mtime_ns": self.mtime_ns, "layers": self.layers}, f
+            )
+
+    def parse(self, parser, first, last=None):
+        """
+        Parses layers first..last (inclusive, last layer by default)
+        into the model of parser, restoring the machine state at the
+        start of the first of them.
+        """
+        if last is None:
+            last = len(self.layers) - 1
+        if not 0 <= first <= last < len(self.layers):
+            raise IndexError(
+                "Layers {}..{} out of range 0..{}".format(first, last, len(self.layers) - 1)
+            )
+        start = self.layers[first]
+        stop = self.layers[last + 1]["byte_offset"] if last + 1 < len(self.layers) else None
+
+        model = parser.model
+        model.relative = dict(start["relative"])
+        model.offset = dict(start["offset"])
+        model.is_relative = start["is_relative"]
+        model.relative_extrusion = start["relative_extrusion"]
+        model.start = dict(start["start"])
+        # the first line of the layer moves the layer count on to it
+        model.start_layer = (first - 1, start["previous_z"]) if first else (0, 0)
+
+        with profiler.stage("parse") as stage:
+            parser.line_num = start["line"] - 1
+            offset = start["byte_offset"]
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                for raw in f:
+                    if stop is not None and offset >= stop:
+                        break
+                    parser.line_num += 1
+                    parser.line = raw.decode().rstrip()
+                    parser.parse_line()
+                    offset += len(raw)
+            model.post_process()
+            stage.add(parser.line_num - start["line"] + 1)
+        return model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="layer_index.py",
+        usage="%(prog)s [options]",
+        description="Builds the layer index of a G-code file and parses layer ranges.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the G-code file.")
+    parser.add_argument(
+        "-L",
+        "--layers",
+        help="Parse only layers N:M (inclusive) and write them to <file>_N-M.gcode.",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    t1 = time.time()
+    index = LayerIndex.open(args.file)
+    print("{} layers, indexed in {:.3f} ms".format(len(index), (time.time() - t1) * 1000.0))
+    if args.layers:
+        first, _, last = args.layers.partition(":")
+        first = int(first)
+        last = int(last) if last else first
+        t1 = time.time()
+        model = GcodeParser().parse_layers(args.file, first, last, index)
+        print("Parsed layers {}..{} in {:.3f} ms".format(first, last, (time.time() - t1) * 1000.0))
+        print(model)
+        root, ext = os.path.splitext(args.file)
+        model.write("{}_{}-{}{}".format(root, first, last, ext))
+
+
+if __name__ == "__main__":
+    main()
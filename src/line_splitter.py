@@ -4,14 +4,23 @@ import logging
 import time
 import os
 from itertools import islice
-from Gcode_Parser import GcodeParser, Segment
+from Gcode_Parser import GcodeParser, Segment, Arc
+from gcode_io import split_compression
+from profiler import profiler
 
 
-def split_segments(model, seg_current, seg_previous, max_seg_length):
-    number_of_segs = math.ceil(seg_current.distance / max_seg_length)
+def split_segments(model, seg_current, seg_previous, max_seg_length, fractions=None):
+    """
+    Creates the segments splitting seg_current into equal parts
+    of at most max_seg_length, or at the given fractions of its
+    length (increasing, between 0 and 1) if provided.
+    """
+    if fractions is None:
+        number_of_segs = math.ceil(seg_current.distance / max_seg_length)
+        fractions = [i / number_of_segs for i in range(1, number_of_segs)]
     new_segs = []
-    for i in range(1, number_of_segs):
-        k = i / number_of_segs
+    previous_k = 0
+    for k in fractions:
         x1 = seg_previous.coords["X"]
         y1 = seg_previous.coords["Y"]
         z1 = seg_previous.coords["Z"]
@@ -58,11 +67,62 @@ def split_segments(model, seg_current, seg_previous, max_seg_length):
                 )
 
         seg = Segment(seg_current.type, new_coords, seg_current.line_num, line)
-        seg.distance = seg_current.distance / number_of_segs
+        seg.distance = seg_current.distance * (k - previous_k)
+        previous_k = k
         new_segs.append(seg)
     return new_segs
 
 
+def tessellate_arc(model, arc, max_seg_length):
+    """
+    Replaces a G2/G3 arc by G1 chords of at most max_seg_length
+    of arc, all of them computed at once with numpy. The last
+    chord ends exactly at the end of the arc.
+    """
+    import numpy as np
+
+    count = max(1, math.ceil(arc.distance / max_seg_length))
+    t = np.arange(1, count + 1) / count
+    angle = arc.angle + arc.sweep * t
+    cx, cy = arc.centre
+    start, end = arc.start, arc.coords
+    if arc.sweep:
+        x = cx + arc.radius * np.cos(angle)
+        y = cy + arc.radius * np.sin(angle)
+    else:
+        x = start["X"] + t * (end["X"] - start["X"])
+        y = start["Y"] + t * (end["Y"] - start["Y"])
+    z = start["Z"] + t * (end["Z"] - start["Z"])
+    e = start["E"] + t * (end["E"] - start["E"])
+    points = np.round(np.stack([x, y, z, e], axis=1), 3)
+    points[-1] = [end["X"], end["Y"], end["Z"], end["E"]]
+    previous = np.vstack([[start["X"], start["Y"], start["Z"]], points[:-1, :3]])
+    distances = np.linalg.norm(points[:, :3] - previous, axis=1)
+    # relative extrusion writes each chord's share of the arc's E,
+    # the last one the remainder so the shares add up to the arc's
+    e_steps = [round((end["E"] - start["E"]) / count, 3)] * count
+    e_steps[-1] = round(end["E"] - start["E"] - e_steps[0] * (count - 1), 5)
+    extruding = (start["E"] != end["E"] or model.relative_extrusion) and "E" in arc.line
+
+    chords = []
+    for (new_x, new_y, new_z, new_e), distance, e_step in zip(
+        points.tolist(), distances.tolist(), e_steps
+    ):
+        new_coords = {"X": new_x, "Y": new_y, "Z": new_z, "F": end["F"], "E": new_e}
+        if extruding:
+            line = "G1 X{0} Y{1} Z{2} E{3} F{4}".format(
+                new_x, new_y, new_z, e_step if model.relative_extrusion else new_e, end["F"]
+            )
+        else:
+            line = "G1 X{0} Y{1} Z{2} F{3}".format(new_x, new_y, new_z, end["F"])
+        seg = Segment("G1", new_coords, arc.line_num, line)
+        seg.distance = distance
+        seg.style = arc.style
+        seg.layer_idx = arc.layer_idx
+        chords.append(seg)
+    return chords
+
+
 class Found(Exception):
     pass
 
@@ -76,7 +136,21 @@ def check_halt(line):
         raise Halt
 
 
-def convert_to_small_segments(model, max_seg_length=10):
+def convert_to_small_segments(model, max_seg_length=10, split_fractions=None, arcs=False):
+    """
+    Splits every segment longer than max_seg_length. By default
+    segments are cut into equal parts, split_fractions can be a
+    function of (segment, previous segment) returning the
+    fractions of the segment length to cut it at instead. G2/G3
+    arcs are kept as they are, unless arcs is set: conforming
+    needs straight moves, so they are then replaced by G1 chords.
+    """
+    with profiler.stage("split") as stage:
+        model = _convert_to_small_segments(model, max_seg_length, split_fractions, arcs, stage)
+    return model
+
+
+def _convert_to_small_segments(model, max_seg_length, split_fractions, arcs, stage):
     line = None
     previous_line = None
     try:
@@ -84,6 +158,14 @@ def convert_to_small_segments(model, max_seg_length=10):
             lines_iter = iter(enumerate(layer.lines))
             for line_idx, line in lines_iter:
                 check_halt(line)
+                if isinstance(line, Arc):
+                    if arcs:
+                        chords = tessellate_arc(model, line, max_seg_length)
+                        layer.lines[line_idx : line_idx + 1] = chords
+                        stage.add(len(chords) - 1)
+                        for _ in range(len(chords) - 1):
+                            next(lines_iter)
+                    continue
                 if isinstance(line, Segment) and line.distance > max_seg_length:
                     if line_idx > 0:
                         previous_line = layer.lines[line_idx - 1]
@@ -103,11 +185,17 @@ def convert_to_small_segments(model, max_seg_length=10):
                                 pass
 
                     if isinstance(previous_line, Segment):
+                        fractions = None
+                        if split_fractions is not None:
+                            fractions = split_fractions(line, previous_line)
                         new_segs = split_segments(
-                            model, line, previous_line, max_seg_length
+                            model, line, previous_line, max_seg_length, fractions
                         )
+                        if not new_segs:
+                            continue
                         for i in range(len(new_segs)):
                             layer.lines.insert(line_idx + i, new_segs[i])
+                        stage.add(len(new_segs))
                         next(islice(lines_iter, len(new_segs) - 1, None), "")
     except Halt:
         pass
@@ -135,7 +223,7 @@ def split_directory(dir_path, seg_len=1):
             print(model)
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         prog="gcode_parser.py",
         usage="%(prog)s [options]",
@@ -166,17 +254,30 @@ def main():
         dest="loglevel",
         const=logging.INFO,
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--profile",
+        help="Print per-stage timings and counts.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        help="Print per-stage timings, counts and traced allocations (slow).",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
     logging.basicConfig(level=logging.ERROR)
+    if args.profile or args.profile_memory:
+        profiler.enable(args.profile_memory)
     t1 = time.time()
     parser = GcodeParser()
     model = parser.parse_file(args.file)
     print(model)
-    in_file, _ = os.path.splitext(os.path.basename(args.file))
+    root, compression = split_compression(os.path.basename(args.file))
+    in_file, _ = os.path.splitext(root)
     model = convert_to_small_segments(model, args.length)
     split_path = os.path.join(
         os.path.dirname(args.file),
-        "split_{}mm_{}.gcode".format(args.length, in_file),
+        "split_{}mm_{}.gcode{}".format(args.length, in_file, compression),
     )
     model.write(split_path)
     t2 = time.time()
@@ -185,6 +286,8 @@ def main():
     parser = GcodeParser()
     model = parser.parse_file(split_path)
     print(model)
+    if args.profile or args.profile_memory:
+        print(profiler.report())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+import numpy as np
+from Gcode_Parser import Segment
+from move_arrays import AXES, STYLES
+
+
+class LineIndex:
+    """
+    Columnar index of every line of a model (comments and
+    commands included) in file order, so queries are evaluated
+    as numpy boolean masks instead of loops over layer.lines.
+
+    Lines other than segments have NaN coordinates and take
+    the layer index of the segment before them.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.layers = list(model.layers)
+        self.lines = [line for layer in self.layers for line in layer.lines]
+        n = len(self.lines)
+        # offset of the first line of each layer, and one past the last
+        self.offsets = np.cumsum([0] + [len(layer.lines) for layer in self.layers])
+
+        self.coords = np.full((n, len(AXES)), np.nan)
+        self.layer = np.empty(n, dtype=np.int32)
+        segment = np.zeros(n, dtype=bool)
+        codes = {style: code for code, style in enumerate(STYLES)}
+        style = np.full(n, -1, dtype=np.int8)
+        layer_idx = model.start_layer[0]
+        for i, line in enumerate(self.lines):
+            if line.layer_idx is not None:
+                layer_idx = line.layer_idx
+            self.layer[i] = layer_idx
+            if isinstance(line, Segment):
+                segment[i] = True
+                style[i] = codes.get(line.style, -1)
+                coords = line.coords
+                self.coords[i] = (
+                    coords["X"],
+                    coords["Y"],
+                    coords["Z"],
+                    coords.get("E", 0.0),
+                    coords.get("F", 0.0),
+                )
+        self.segment = segment
+        self.style = style
+        self.type = np.array([line.type for line in self.lines], dtype=str)
+        # first word of the text, e.g. "M400" for lines parsed as MISC
+        self.command = np.array(
+            [
+                (line.line.split(";", 1)[0].split(None, 1) or [""])[0].upper()
+                for line in self.lines
+            ],
+            dtype=str,
+        )
+
+    def __len__(self):
+        return len(self.lines)
+
+    def matches(self, model):
+        """
+        Whether the layers of model still hold the indexed lines,
+        as far as can be told without walking them all.
+        """
+        return (
+            len(model.layers) == len(self.layers)
+            and all(a is b for a, b in zip(model.layers, self.layers))
+            and all(
+                len(layer.lines) == stop - start
+                for layer, start, stop in zip(self.layers, self.offsets[:-1], self.offsets[1:])
+            )
+        )
+
+    def compress(self, keep):
+        """
+        Drops the rows where keep is false, after deleting their lines
+        """
+        self.lines = [line for line, kept in zip(self.lines, keep.tolist()) if kept]
+        self.offsets = np.concatenate([[0], np.cumsum(keep)])[self.offsets]
+        for name in ("coords", "layer", "segment", "style", "type", "command"):
+            setattr(self, name, getattr(self, name)[keep])
+
+
+class Query:
+    """
+    Selection of lines of a model, from GcodeModel.query().
+
+    Each filter returns a new query with its condition added
+    (combine queries with &, | and ~), evaluated at once over the
+    columns of the LineIndex. Iterating yields the selected line
+    objects of the model themselves, nothing is copied.
+
+        model.query().styles("extrude").layers(2, 5).region(0, 0, 50, 50)
+        model.query().types(";").delete()
+    """
+
+    def __init__(self, index, mask=None):
+        self.index = index
+        self.mask = np.ones(len(index), dtype=bool) if mask is None else mask
+
+    def where(self, condition):
+        return Query(self.index, self.mask & condition)
+
+    def __and__(self, other):
+        return Query(self.index, self.mask & other.mask)
+
+    def __or__(self, other):
+        return Query(self.index, self.mask | other.mask)
+
+    def __invert__(self):
+        return Query(self.index, ~self.mask)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask))
+
+    def __iter__(self):
+        lines = self.index.lines
+        for i in self.indices.tolist():
+            yield lines[i]
+
+    @property
+    def indices(self):
+        """
+        Positions of the selected lines in file order
+        """
+        return np.flatnonzero(self.mask)
+
+    def lines(self):
+        return list(self)
+
+    def column(self, axis):
+        """
+        Values of an axis (one of move_arrays.AXES) of the selected lines
+        """
+        return self.index.coords[self.mask, AXES.index(axis)]
+
+    # filters
+
+    def segments(self):
+        return self.where(self.index.segment)
+
+    def layers(self, first, last=None):
+        """
+        Lines of layers first..last (inclusive), by layer index
+        """
+        last = first if last is None else last
+        return self.where((self.index.layer >= first) & (self.index.layer <= last))
+
+    def styles(self, *styles):
+        """
+        Segments of the given styles (fly, extrude, retract, restore)
+        """
+        return self.where(np.isin(self.index.style, [STYLES.index(s) for s in styles]))
+
+    def types(self, *types):
+        """
+        Lines parsed as the given types, e.g. "G1", ";" for
+        comments or "MISC" for unknown commands
+        """
+        return self.where(np.isin(self.index.type, types))
+
+    def commands(self, prefix):
+        """
+        Lines whose command starts with prefix, e.g. "M" for all
+        M commands whatever type they were parsed as
+        """
+        return self.where(np.char.startswith(self.index.command, prefix.upper()))
+
+    def region(self, x_min, y_min, x_max, y_max):
+        """
+        Segments ending inside an XY rectangle, edges included
+        """
+        x = self.index.coords[:, 0]
+        y = self.index.coords[:, 1]
+        return self.where((x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max))
+
+    def z_range(self, z_min, z_max):
+        z = self.index.coords[:, 2]
+        return self.where((z >= z_min) & (z <= z_max))
+
+    def e_above(self, value=0.0):
+        """
+        Segments with E greater than value, the points extract_point_cloud keeps
+        """
+        return self.where(self.index.coords[:, 3] > value)
+
+    # bulk edits, one pass over the model whatever the number of lines
+
+    def delete(self):
+        """
+        Removes the selected lines from the layers (and segments)
+        of the model. Returns the number removed. Other queries
+        made before the deletion are no longer valid.
+        """
+        index = self.index
+        model = index.model
+        removed = len(self)
+        if not removed:
+            return 0
+        keep = ~self.mask
+        for layer, start, stop in zip(index.layers, index.offsets[:-1], index.offsets[1:]):
+            layer_keep = keep[start:stop]
+            if not layer_keep.all():
+                layer.lines = [
+                    line for line, kept in zip(layer.lines, layer_keep.tolist()) if kept
+                ]
+        dropped = {id(index.lines[i]) for i in self.indices.tolist()}
+        model.segments = [line for line in model.segments if id(line) not in dropped]
+        index.compress(keep)
+        self.mask = np.zeros(len(index), dtype=bool)
+        return removed
+
+    def rewrite(self, func):
+        """
+        Replaces the text of each selected line by func(line).
+        Returns the number of lines rewritten.
+        """
+        lines = self.index.lines
+        for i in self.indices.tolist():
+            line = lines[i]
+            line.line = func(line)
+        return len(self)
@@ -0,0 +1,81 @@
+import numpy as np
+from Gcode_Parser import Segment
+
+AXES = ["X", "Y", "Z", "E", "F"]
+# style codes, segments which were never classified (e.g. split ones) are -1
+STYLES = ["fly", "extrude", "retract", "restore"]
+
+
+class MoveArrays:
+    """
+    Columnar copy of the segments of a parsed G-code model,
+    one row per segment in file order, so the moves can be
+    filtered and transformed with numpy instead of per-segment
+    Python loops.
+    """
+
+    def __init__(self, model):
+        self.segments = [
+            line
+            for layer in model.layers
+            for line in layer.lines
+            if isinstance(line, Segment)
+        ]
+        n = len(self.segments)
+        # split segments without extrusion have no E, treat it as 0
+        self.coords = np.array(
+            [
+                (
+                    seg.coords["X"],
+                    seg.coords["Y"],
+                    seg.coords["Z"],
+                    seg.coords.get("E", 0.0),
+                    seg.coords.get("F", 0.0),
+                )
+                for seg in self.segments
+            ],
+            dtype=np.float64,
+        ).reshape(n, len(AXES))
+        codes = {style: code for code, style in enumerate(STYLES)}
+        self.style = np.fromiter(
+            (codes.get(seg.style, -1) for seg in self.segments), dtype=np.int8, count=n
+        )
+        self.layer = np.fromiter(
+            (-1 if seg.layer_idx is None else seg.layer_idx for seg in self.segments),
+            dtype=np.int32,
+            count=n,
+        )
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def x(self):
+        return self.coords[:, 0]
+
+    @property
+    def y(self):
+        return self.coords[:, 1]
+
+    @property
+    def z(self):
+        return self.coords[:, 2]
+
+    @property
+    def e(self):
+        return self.coords[:, 3]
+
+    @property
+    def f(self):
+        return self.coords[:, 4]
+
+    @property
+    def xyz(self):
+        return self.coords[:, :3]
+
+    def style_mask(self, styles):
+        """
+        Boolean mask of the segments with one of the given styles
+        """
+        codes = [STYLES.index(style) for style in styles]
+        return np.isin(self.style, codes)
@@ -0,0 +1,305 @@
+import io
+import os
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Gcode_Parser import GcodeParser, Segment
+from gcode_io import split_compression, is_binary
+from profiler import profiler
+
+AXES = "XYZEF"
+# columns of the position reset by G92/G28, there is no feedrate offset
+OFFSETS = "XYZE"
+E = AXES.index("E")
+# the lines changing the modal state, all other lines are left to the parser
+MOVE, ARC, G90, G91, M82, M83, G92, G28 = range(8)
+CODES = {
+    "G0": MOVE,
+    "G1": MOVE,
+    "G2": ARC,
+    "G3": ARC,
+    "G90": G90,
+    "G91": G91,
+    "M82": M82,
+    "M83": M83,
+    "G92": G92,
+    "G28": G28,
+}
+# axes set by a G92/G28 without any
+RESETS = {G92: "XYZE", G28: "XYZ"}
+# per-axis operations of the position lines
+KEEP, SET, ADD = range(3)
+
+
+def chunk_ranges(path, count):
+    """
+    Splits a file into about count byte ranges, each ending at
+    the end of a line.
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        for i in range(1, count + 1):
+            if start >= size:
+                break
+            end = size * i // count
+            if end < size:
+                f.seek(max(end - 1, start))
+                f.readline()
+                end = f.tell()
+            if end > start:
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+
+def read_chunk(path, start, end):
+    """
+    Reads the lines of a byte range of a file, split the same
+    way as iterating over the file in text mode.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return list(io.TextIOWrapper(io.BytesIO(data)))
+
+
+def tokenize_line(line):
+    """
+    Tokenizes a line changing the modal state (a move, an arc,
+    G90/G91, M82/M83, G92 or G28) the same way
+    GcodeParser.parse_line would, into its kind, a bitmask of the
+    axes it gives, their values and, for a G0/G1 move giving only
+    axes (and so no warnings), its type. Returns None for any
+    other line.
+    """
+    comm = line.rstrip().split(";", 1)[0].strip().split(None, 1)
+    kind = CODES.get(comm[0]) if comm else None
+    if kind is None:
+        return None
+    args = {}
+    plain = kind == MOVE
+    for bit in comm[1].split() if len(comm) > 1 else []:
+        try:
+            args[bit[0]] = float(bit[1:])
+        except ValueError:
+            plain = False
+            continue
+        if bit[0] not in AXES:
+            plain = False
+    if kind in RESETS and not args:
+        args = dict.fromkeys(RESETS[kind], 0.0)
+    row = [0.0] * len(AXES)
+    bitmask = 0
+    for column, axis in enumerate(OFFSETS if kind in RESETS else AXES):
+        if axis in args:
+            row[column] = args[axis]
+            bitmask |= 1 << column
+    return kind, bitmask, row, comm[0] if plain else None
+
+
+def tokenize_chunk(path, start, end):
+    """
+    Tokenizes a byte range of a file into columns, see add_lines.
+
+    Returns (texts, types, kinds, mask, values) of its lines.
+    """
+    texts = [line.rstrip() for line in read_chunk(path, start, end)]
+    types = [None] * len(texts)
+    kinds = [-1] * len(texts)
+    mask = [0] * len(texts)
+    values = [None] * len(texts)
+    empty = [0.0] * len(AXES)
+    for i, text in enumerate(texts):
+        token = tokenize_line(text)
+        if token is None:
+            values[i] = empty
+        else:
+            kinds[i], mask[i], values[i], types[i] = token
+    return (
+        texts,
+        types,
+        np.array(kinds, dtype=np.int8),
+        np.array(mask, dtype=np.uint8),
+        np.array(values, dtype=np.float64).reshape(len(texts), len(AXES)),
+    )
+
+
+def _modes(kinds, on, off, incoming):
+    """
+    The mode (True/False) in effect at each row, set by the
+    last on/off row before it or incoming.
+    """
+    set = np.where(kinds == on, 1, np.where(kinds == off, 0, -1))
+    last = np.maximum.accumulate(np.where(set >= 0, np.arange(len(kinds)), -1))
+    return np.where(last >= 0, set[np.maximum(last, 0)], incoming).astype(bool)
+
+
+def operations(tokens, is_relative, relative_extrusion):
+    """
+    The per-axis operation (KEEP, SET or ADD) of each position
+    line (moves, arcs, G92 and G28) of tokenized lines, given the
+    modes at their start, as GcodeModel.do_G1/do_G92 apply them.
+
+    Returns (ops, values, reset) of the position lines, reset
+    marking the G92/G28 ones.
+    """
+    kinds, mask, values = tokens
+    relative = _modes(kinds, G91, G90, is_relative)
+    extrusion = _modes(kinds, M83, M82, relative_extrusion)
+    rows = np.isin(kinds, [MOVE, ARC, G92, G28])
+    kinds, mask, values = kinds[rows], mask[rows], values[rows]
+    relative, extrusion = relative[rows], extrusion[rows]
+    reset = (kinds == G92) | (kinds == G28)
+    given = (mask[:, None] >> np.arange(len(AXES))) & 1 == 1
+    # do_G1 adds every axis in relative mode, and E with relative extrusion
+    add = relative[:, None] | (np.arange(len(AXES)) == E) & extrusion[:, None]
+    ops = np.where(given, np.where(add & ~reset[:, None], ADD, SET), KEEP)
+    return ops.astype(np.int8), values, reset
+
+
+def resolve(ops, values, start):
+    """
+    The value of one axis after each position line, folding the
+    relative steps in order from the last value set (or start).
+    """
+    rows = np.arange(len(ops))
+    sets = np.flatnonzero(ops == SET)
+    anchor = np.maximum.accumulate(np.where(ops == SET, rows, -1)) if len(ops) else rows
+    out = np.where(anchor >= 0, values[np.maximum(anchor, 0)], start)
+    steps = np.where(ops == ADD, values, 0.0)
+    for run in np.unique(anchor[ops == ADD]).tolist():
+        first = run + 1 if run >= 0 else 0
+        later = np.searchsorted(sets, run, side="right")
+        last = sets[later] if later < len(sets) else len(ops)
+        base = values[run] if run >= 0 else start
+        out[first:last] = np.cumsum(np.concatenate([[base], steps[first:last]]))[1:]
+    return out
+
+
+def add_lines(parser, texts, types, kinds, mask, values):
+    """
+    Adds lines to the model of parser as parse_line would, in one
+    pass. The positions after each move, arc, G92 and G28 are
+    resolved from the modal state of the model with numpy, the
+    moves with a type go straight into the model as segments and
+    only the other lines are parsed, from the position before them.
+
+    Parameters::
+            texts - text of each line, without the linefeed
+            types - segment type (G0/G1) of each plain move, None for lines to parse
+            kinds, mask, values - tokens of each line as tokenize_line
+                    gives them, kind -1 for lines not changing the modal state
+    """
+    model = parser.model
+    rows = kinds >= 0
+    ops, ops_values, reset = operations(
+        (kinds[rows], mask[rows], values[rows]), model.is_relative, model.relative_extrusion
+    )
+    relative = np.empty(ops_values.shape)
+    absolute = np.empty(ops_values.shape)
+    for column, axis in enumerate(AXES):
+        relative[:, column] = resolve(ops[:, column], ops_values[:, column], model.relative[axis])
+        absolute[:, column] = relative[:, column]
+        if axis in OFFSETS:
+            absolute[:, column] += resolve(
+                np.where(reset, ops[:, column], KEEP), ops_values[:, column], model.offset[axis]
+            )
+    # position rows before each line
+    position = np.isin(kinds, [MOVE, ARC, G92, G28])
+    before = (np.cumsum(position) - position).tolist()
+    position = position.tolist()
+    absolute = absolute.tolist()
+    segments = model.segments
+    moved = False
+    for line, type in enumerate(types):
+        parser.line_num += 1
+        if type is not None:
+            segments.append(
+                Segment(type, _coords(absolute[before[line]]), parser.line_num, texts[line])
+            )
+            moved = True
+            continue
+        parser.line = texts[line]
+        if moved and position[line]:
+            # the position the moves went to, as do_G1 would have left it
+            model.relative = _coords(relative[before[line] - 1].tolist())
+            moved = False
+        parser.parse_line()
+    if moved:
+        model.relative = _coords(relative[-1].tolist())
+
+
+def _coords(row):
+    x, y, z, e, f = row
+    return {"X": x, "Y": y, "Z": z, "F": f, "E": e}
+
+
+def parse_file_parallel(path, workers=None, chunks_per_worker=4):
+    """
+    Parses a G-code file into the same model as
+    GcodeParser().parse_file(path). Chunks of the file are
+    tokenized into columns on a process pool, then added to the
+    model in order by add_lines, which resolves the modal state
+    and builds the segments in one serial pass.
+    """
+    parser = GcodeParser()
+    if split_compression(path)[1] or is_binary(path):
+        return parser.parse_file(path)
+    workers = workers or os.cpu_count() or 1
+    ranges = chunk_ranges(path, workers * chunks_per_worker)
+    pool = ProcessPoolExecutor(workers) if workers > 1 and len(ranges) > 1 else None
+    map_chunks = pool.map if pool else map
+    try:
+        with profiler.stage("parse") as stage:
+            parser.line_num = 0
+            for chunk in map_chunks(tokenize_chunk, *zip(*[(path, s, e) for s, e in ranges])):
+                add_lines(parser, *chunk)
+            parser.model.post_process()
+            stage.add(parser.line_num)
+    finally:
+        if pool:
+            pool.shutdown()
+    return parser.model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="parallel_parse.py",
+        usage="%(prog)s [options]",
+        description="Parses a G-code file, chunks of it in parallel.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the G-code file to be parsed.")
+    parser.add_argument("-j", "--jobs", help="Number of worker processes.", type=int)
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    t1 = time.time()
+    model = parse_file_parallel(args.file, args.jobs)
+    t2 = time.time()
+    print("Completed in: {:.3f} ms".format((t2 - t1) * 1000.0))
+    print(model)
+
+
+if __name__ == "__main__":
+    main()
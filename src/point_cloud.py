@@ -1,22 +1,171 @@
+import math
+import time
 import argparse
 import logging
+import tracemalloc
 from Gcode_Parser import GcodeParser, Segment
+from gcode_io import open_gcode, split_compression
 from line_splitter import convert_to_small_segments
+from profiler import profiler
 import os
 
 
 def extract_point_cloud(model):
-    coordinates = []
-    lines = [line for layer in model.layers for line in layer.lines]
-    for seg in lines:
-        if isinstance(seg, Segment) and seg.coords.get("E", 0) > 0:
-            coordinate = "{0} {1} {2}".format(
-                seg.coords["X"], seg.coords["Y"], seg.coords["Z"]
-            )  # return a string
-            coordinates.append(coordinate)
+    with profiler.stage("point_cloud") as stage:
+        coordinates = []
+        lines = [line for layer in model.layers for line in layer.lines]
+        for seg in lines:
+            if isinstance(seg, Segment) and seg.coords.get("E", 0) > 0:
+                coordinate = "{0} {1} {2}".format(
+                    seg.coords["X"], seg.coords["Y"], seg.coords["Z"]
+                )  # return a string
+                coordinates.append(coordinate)
+        stage.add(len(coordinates))
     return coordinates
 
 
+def extract_point_array(model, styles=None):
+    """
+    Vectorised extract_point_cloud, working on the columnar
+    coordinates of the model instead of formatting strings.
+
+    Parameters::
+            model - the parsed (and usually split) substrate
+            styles - only keep segments of these styles (default: all)
+
+    Returns a tuple of the (N, 3) array of extruding points,
+    their bbox as [[xmin, ymin, zmin], [xmax, ymax, zmax]]
+    and the XY centre of the bbox, as found by find_centre.
+    """
+    import numpy as np
+    from move_arrays import MoveArrays
+
+    with profiler.stage("point_cloud") as stage:
+        moves = MoveArrays(model)
+        mask = moves.e > 0
+        if styles is not None:
+            mask &= moves.style_mask(styles)
+        points = np.ascontiguousarray(moves.xyz[mask])
+        if len(points):
+            bbox = np.array([points.min(axis=0), points.max(axis=0)])
+            centre = (bbox[0, :2] + bbox[1, :2]) / 2
+        else:
+            bbox = centre = None
+        stage.add(len(points))
+    return points, bbox, centre
+
+
+def decimate_point_array(points, resolution):
+    """
+    Voxel grid decimation keeping only the highest point of
+    each XY cell, which is the only one a conforming lookup
+    window covering the cell can return.
+
+    Parameters::
+            points - (N, 3) point array
+            resolution - side of a grid cell in mm
+
+    Returns a tuple of the decimated points, in cell order, and
+    a report of the point counts, reduction ratio, peak memory
+    and time taken.
+    """
+    import numpy as np
+
+    t1 = time.perf_counter()
+    # a caller already tracing (e.g. the profiler) keeps its session,
+    # only the peak is reset to measure this call
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    profiler.reset_peak()
+
+    with profiler.stage("decimate") as stage:
+        cells = np.floor(points[:, :2] / resolution).astype(np.int64)
+        # sort by cell, highest point first within each cell
+        order = np.lexsort((-points[:, 2], cells[:, 1], cells[:, 0]))
+        cells = cells[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = np.any(cells[1:] != cells[:-1], axis=1)
+        decimated = points[order[first]]
+        stage.add(len(points))
+
+    peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+    if not tracing:
+        tracemalloc.stop()
+    report = {
+        "points_in": len(points),
+        "points_out": len(decimated),
+        "reduction": len(points) / len(decimated) if len(decimated) else None,
+        "peak_bytes": peak_bytes,
+        "seconds": time.perf_counter() - t1,
+    }
+    return decimated, report
+
+
+class TopSurface:
+    """
+    Running highest point of each XY cell of a grid, keeping
+    memory proportional to the footprint of the substrate.
+    """
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def add(self, x, y, z):
+        key = (math.floor(x / self.resolution), math.floor(y / self.resolution))
+        point = self.cells.get(key)
+        if point is None or z > point[2]:
+            self.cells[key] = (x, y, z)
+
+    def points(self):
+        """
+        Returns the (N, 3) array of the top points in cell order,
+        the same as decimate_point_array gives.
+        """
+        import numpy as np
+
+        return np.array(
+            [self.cells[key] for key in sorted(self.cells)], dtype=np.float64
+        ).reshape(-1, 3)
+
+
+def extract_top_surface(path, resolution, max_seg_length=0.5):
+    """
+    Streams a substrate G-code file, splitting it into segments
+    of at most max_seg_length, and keeps only the highest
+    extruding point of each XY cell, without ever holding the
+    parsed model or the full point cloud in memory.
+
+    Gives the same points as splitting the parsed model,
+    extracting its point array and decimating it.
+    """
+    from stream_conform import StreamConformer
+
+    top = TopSurface(resolution)
+    conformer = StreamConformer(None, max_seg_length)
+    with profiler.stage("top_surface") as stage:
+        with open_gcode(path, "r") as f:
+            for text in f:
+                for seg in conformer.feed_lines(text):
+                    if isinstance(seg, Segment) and seg.coords.get("E", 0) > 0:
+                        top.add(seg.coords["X"], seg.coords["Y"], seg.coords["Z"])
+                stage.add(1)
+    return top.points()
+
+
+def point_array_to_list(points):
+    """
+    Formats an (N, 3) point array as "X Y Z" strings,
+    identical to those of extract_point_cloud.
+    """
+    return ["{0} {1} {2}".format(x, y, z) for x, y, z in points.tolist()]
+
+
 def create_coord(coordinate):
     bit = coordinate.split(" ", 2)
     coord = [float(bit[0]), float(bit[1]), float(bit[2])]
@@ -51,7 +200,7 @@ def coord_write(coordinates, file_path):
             fp.write("\n")
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         prog="Coordinates.py",
         usage="%(prog)s [options]",
@@ -59,6 +208,12 @@ def main():
                                                   into a custom object.",
     )
     parser.add_argument("-f", "--file", help="Path to the G-code file to be parsed.")
+    parser.add_argument(
+        "-r",
+        "--resolution",
+        help="Keep only the highest point per XY cell of this size in mm.",
+        type=float,
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -76,8 +231,20 @@ def main():
         dest="loglevel",
         const=logging.INFO,
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--profile",
+        help="Print per-stage timings and counts.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        help="Print per-stage timings, counts and traced allocations (slow).",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
     logging.basicConfig(level=args.loglevel)
+    if args.profile or args.profile_memory:
+        profiler.enable(args.profile_memory)
     parser = GcodeParser()
 
     model = parser.parse_file(args.file)
@@ -91,12 +258,14 @@ def main():
         for line in layer.lines:
             print(line)
             
-    coordinates = extract_point_cloud(model)
-    coordinates = convert_to_number(coordinates)
-    centre = find_centre(coordinates)
-    coordinates = convert_to_list(coordinates)
-    in_file, _ = os.path.splitext(os.path.basename(args.file))
-    coord_write(coordinates, "test/extracted_{}.txt".format(in_file)) #changed output file path
+    points, bbox, centre = extract_point_array(model)
+    if args.resolution:
+        points, report = decimate_point_array(points, args.resolution)
+        print(report)
+    in_file, _ = os.path.splitext(split_compression(os.path.basename(args.file))[0])
+    coord_write(point_array_to_list(points), "test/extracted_{}.txt".format(in_file)) #changed output file path
+    if args.profile or args.profile_memory:
+        print(profiler.report())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,231 @@
+import time
+import logging
+import argparse
+import numpy as np
+from Gcode_Parser import GcodeParser, Segment, Arc
+from move_arrays import MoveArrays
+from profiler import profiler
+
+# default machine limits, roughly those of Marlin
+ACCELERATION = 1000.0  # mm/s^2
+JUNCTION_DEVIATION = 0.05  # mm
+MAX_SPEED = 300.0  # mm/s
+
+
+def move_times(
+    start,
+    end,
+    e_length,
+    f,
+    acceleration=ACCELERATION,
+    junction_deviation=JUNCTION_DEVIATION,
+    max_speed=MAX_SPEED,
+    length=None,
+):
+    """
+    Time in seconds of each move of a toolpath.
+
+    Parameters::
+            start - (N, 3) XYZ start points of the moves
+            end - (N, 3) XYZ end points of the moves
+            e_length - (N,) filament moved by each move
+            f - (N,) feedrates of the moves in mm/min
+            acceleration - acceleration in mm/s^2
+            junction_deviation - Marlin style junction deviation in mm
+            max_speed - speed cap in mm/s
+            length - (N,) path length of the moves, e.g. along arcs,
+                     the distance from start to end by default
+
+    Speeds at the junctions are planned with a forward and a
+    backward pass, each vectorised as a running minimum: the
+    squared speed at junction j is at most J_k + 2a|s_j - s_k| for
+    every junction k, where J_k is its junction limit and s the
+    distance along the path. Each move then follows a trapezoid
+    (or triangle) profile between its entry and exit speeds.
+    """
+    delta = end - start
+    chord = np.linalg.norm(delta, axis=1)
+    if length is None:
+        length = chord
+    # extruder only moves, e.g. retractions, start and stop at rest
+    still = length == 0
+    travel = np.where(still, e_length, length)
+    nominal = np.minimum(f / 60.0, max_speed)
+    # arcs turn along the way, their chord gives the direction at the junctions
+    unit = np.zeros_like(delta)
+    unit[chord > 0] = delta[chord > 0] / chord[chord > 0, None]
+
+    # junction limits, Marlin's junction deviation capped by both nominal speeds
+    junction = np.zeros(len(length) + 1)
+    if len(length) > 1:
+        cos_theta = -np.einsum("ij,ij->i", unit[:-1], unit[1:])
+        sin_theta_d2 = np.sqrt(np.clip(0.5 * (1.0 - cos_theta), 0.0, 1.0))
+        with np.errstate(divide="ignore"):
+            v2 = acceleration * junction_deviation * sin_theta_d2 / (1.0 - sin_theta_d2)
+        v2 = np.minimum(v2, np.minimum(nominal[:-1], nominal[1:]) ** 2)
+        # stop where the path is broken (e.g. by G92) or around extruder only moves
+        joined = np.all(end[:-1] == start[1:], axis=1) & ~still[:-1] & ~still[1:]
+        junction[1:-1] = np.where(joined, v2, 0.0)
+
+    # reachable squared speeds, forward and backward as running minima
+    s = np.concatenate([[0.0], np.cumsum(2.0 * acceleration * np.where(still, 0.0, length))])
+    forward = s + np.minimum.accumulate(junction - s)
+    backward = np.minimum.accumulate((junction + s)[::-1])[::-1] - s
+    v2 = np.maximum(np.minimum(forward, backward), 0.0)
+    v_in = np.sqrt(v2[:-1])
+    v_out = np.sqrt(v2[1:])
+
+    moving = (travel > 0) & (nominal > 0)
+    nominal = np.where(moving, nominal, 1.0)
+    accel_d = (nominal**2 - v2[:-1]) / (2.0 * acceleration)
+    decel_d = (nominal**2 - v2[1:]) / (2.0 * acceleration)
+    cruise = travel - accel_d - decel_d
+    trapezoid = (2.0 * nominal - v_in - v_out) / acceleration + cruise / nominal
+    peak = np.sqrt((2.0 * acceleration * travel + v2[:-1] + v2[1:]) / 2.0)
+    triangle = (2.0 * peak - v_in - v_out) / acceleration
+    times = np.where(cruise >= 0, trapezoid, triangle)
+    return np.where(moving, times, 0.0)
+
+
+def model_moves(arrays):
+    """
+    Indices of the G0/G1 moves and G2/G3 arcs of MoveArrays,
+    their start points, the end of the segment before, and
+    their path lengths, along the arc for arcs.
+    Returns (index, start xyz, start e, length).
+    """
+    index = np.flatnonzero(
+        np.fromiter(
+            (seg.type in ("G0", "G1", "G2", "G3") for seg in arrays.segments),
+            dtype=bool,
+            count=len(arrays),
+        )
+    )
+    # the first segment starts at the origin
+    previous = np.concatenate([np.zeros((1, arrays.coords.shape[1])), arrays.coords])[index]
+    length = np.linalg.norm(arrays.xyz[index] - previous[:, :3], axis=1)
+    for k, i in enumerate(index.tolist()):
+        seg = arrays.segments[i]
+        if isinstance(seg, Arc):
+            length[k] = seg.length()
+    return index, previous[:, :3], previous[:, 3], length
+
+
+def estimate_time(
+    model,
+    acceleration=ACCELERATION,
+    junction_deviation=JUNCTION_DEVIATION,
+    max_speed=MAX_SPEED,
+    arrays=None,
+):
+    """
+    Estimates the print time of a parsed model from its
+    G0/G1 moves and G2/G3 arcs.
+
+    Returns a report with the total and per-layer (keyed by the
+    index of the layer in model.layers) times in seconds, the number of moves and the
+    milliseconds taken to compute it.
+    """
+    t1 = time.perf_counter()
+    with profiler.stage("print_time") as stage:
+        if arrays is None:
+            arrays = MoveArrays(model)
+        index, start, e_start, length = model_moves(arrays)
+        times = move_times(
+            start,
+            arrays.xyz[index],
+            np.abs(arrays.e[index] - e_start),
+            arrays.f[index],
+            acceleration,
+            junction_deviation,
+            max_speed,
+            length,
+        )
+        # split segments have no layer_idx, the layer holding them is what counts
+        layer = np.repeat(
+            np.arange(len(model.layers)),
+            [sum(isinstance(line, Segment) for line in layer.lines) for layer in model.layers],
+        )[index]
+        per_layer = np.bincount(layer, weights=times)
+        stage.add(len(index))
+    return {
+        "total": float(times.sum()),
+        "layers": {i: float(t) for i, t in enumerate(per_layer) if t},
+        "moves": len(index),
+        "compute_ms": (time.perf_counter() - t1) * 1000.0,
+    }
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}h {:02d}m {:02d}s".format(hours, minutes, seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="print_time.py",
+        usage="%(prog)s [options]",
+        description="Estimates the print time of a G-code file.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the G-code file.")
+    parser.add_argument(
+        "-a",
+        "--acceleration",
+        help="Acceleration in mm/s^2.",
+        type=float,
+        default=ACCELERATION,
+    )
+    parser.add_argument(
+        "-j",
+        "--junction-deviation",
+        help="Junction deviation in mm.",
+        type=float,
+        default=JUNCTION_DEVIATION,
+    )
+    parser.add_argument(
+        "-m",
+        "--max-speed",
+        help="Maximum speed in mm/s.",
+        type=float,
+        default=MAX_SPEED,
+    )
+    parser.add_argument(
+        "--layers",
+        help="Print the time of every layer.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    model = GcodeParser().parse_file(args.file)
+    report = estimate_time(model, args.acceleration, args.junction_deviation, args.max_speed)
+    if args.layers:
+        for layer, seconds in report["layers"].items():
+            print("Layer {}: {:.1f} s".format(layer, seconds))
+    print(
+        "Estimated print time {} for {} moves, computed in {:.3f} ms".format(
+            format_duration(report["total"]), report["moves"], report["compute_ms"]
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
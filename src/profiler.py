@@ -0,0 +1,199 @@
+import json
+import time
+import tracemalloc
+
+
+class _NullStage:
+    """
+    Stage returned while profiling is disabled,
+    entering, leaving and counting do nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, items=1):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """
+    Times a single run of a named pipeline stage
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.items = 0
+        self.child_peak = 0
+
+    def add(self, items=1):
+        self.items += items
+
+    def __enter__(self):
+        if self.profiler.track_allocations:
+            self.start_bytes = tracemalloc.get_traced_memory()[0]
+            self.profiler.reset_peak()
+        self.profiler._stack.append(self)
+        self.t1 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t1
+        self.profiler._stack.pop()
+        peak = None
+        if self.profiler.track_allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            # a nested stage resets the peak, so take the largest kept by reset_peak
+            peak = max(peak, self.child_peak)
+            if self.profiler._stack:
+                parent = self.profiler._stack[-1]
+                parent.child_peak = max(parent.child_peak, peak)
+            peak = {
+                "allocated_bytes": current - self.start_bytes,
+                "peak_bytes": peak - self.start_bytes,
+            }
+        self.profiler._record(self.name, seconds, self.items, peak)
+        return False
+
+
+class Profiler:
+    """
+    Records per-stage wall time, item counts, allocations
+    and cache hit rates of the G-code pipeline.
+
+    Disabled by default, in which case stage() hands back a
+    shared no-op context manager so the instrumented code
+    pays only for an attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.track_allocations = False
+        self._started_tracing = False
+        self._stack = []
+        self.reset()
+
+    def reset(self):
+        """Clears all recorded stages, counters and caches"""
+        self.stages = {}
+        self.counters = {}
+        self.caches = {}
+
+    def enable(self, track_allocations=False):
+        """
+        Starts recording. If track_allocations is true, tracemalloc
+        is started to record the allocations of each stage, which
+        slows down the instrumented code considerably.
+        """
+        self.enabled = True
+        self.track_allocations = track_allocations
+        if track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def disable(self):
+        """Stops recording, keeping the stats gathered so far"""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self.enabled = False
+        self.track_allocations = False
+
+    def reset_peak(self):
+        """
+        Resets the tracemalloc peak, keeping the peak reached so
+        far for the running stage so it still counts when it ends.
+        """
+        if self._stack:
+            stage = self._stack[-1]
+            stage.child_peak = max(stage.child_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    def stage(self, name):
+        """
+        Context manager timing a named stage. Call add(n) on the
+        returned object to count the items the stage processed.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def count(self, name, items=1):
+        """Increments a named counter"""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + items
+
+    def hit(self, cache, hits=1):
+        """Records a hit of the named cache"""
+        if self.enabled:
+            self.caches.setdefault(cache, [0, 0])[0] += hits
+
+    def miss(self, cache, misses=1):
+        """Records a miss of the named cache"""
+        if self.enabled:
+            self.caches.setdefault(cache, [0, 0])[1] += misses
+
+    def _record(self, name, seconds, items, memory):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"calls": 0, "seconds": 0.0, "items": 0}
+        stage["calls"] += 1
+        stage["seconds"] += seconds
+        stage["items"] += items
+        if memory:
+            stage["allocated_bytes"] = stage.get("allocated_bytes", 0) + memory["allocated_bytes"]
+            stage["peak_bytes"] = max(stage.get("peak_bytes", 0), memory["peak_bytes"])
+
+    def stats(self):
+        """
+        Returns the recorded stats as a dictionary of stages,
+        counters and caches.
+        """
+        stages = {}
+        for name, stage in self.stages.items():
+            stage = dict(stage)
+            stage["items_per_second"] = (
+                stage["items"] / stage["seconds"] if stage["seconds"] > 0 else None
+            )
+            stages[name] = stage
+        caches = {}
+        for name, (hits, misses) in self.caches.items():
+            total = hits + misses
+            caches[name] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / total if total else None,
+            }
+        return {"stages": stages, "counters": dict(self.counters), "caches": caches}
+
+    def report(self):
+        """Returns the stats formatted as JSON"""
+        return json.dumps(self.stats(), indent=2)
+
+
+# shared profiler used by the instrumented pipeline
+profiler = Profiler()
+
+
+def profile(func, *args, track_allocations=False, **kwargs):
+    """
+    Runs func with profiling enabled and returns a tuple of
+    its result and the structured stats of that run.
+    """
+    was_enabled = profiler.enabled
+    profiler.reset()
+    profiler.enable(track_allocations)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        stats = profiler.stats()
+        if not was_enabled:
+            profiler.disable()
+    return result, stats
@@ -0,0 +1,473 @@
+import os
+import math
+import time
+import logging
+import argparse
+import numpy as np
+from Gcode_Parser import GcodeParser, Segment
+from print_time import estimate_time, format_duration, move_times
+from gcode_edit import EXTRUSION, FEEDRATE, relative_anywhere, set_feedrate
+from profiler import profiler
+
+# 2-opt is quadratic in the islands of a layer, above this only nearest neighbour is used
+MAX_TWO_OPT = 2000
+
+
+class Island:
+    """
+    Run of lines between two travel moves which extrudes, ending
+    with the moves closing or wiping it, with the lines met before
+    it since the island before (travel moves, comments,
+    retractions...) and the position and E before its first line
+    and after its last one.
+    """
+
+    def __init__(self, before, start, e):
+        self.before = before
+        self.lines = []
+        self.start = start
+        self.end = start
+        self.e_start = e
+        self.e_end = e
+        # height of its first extruding move
+        self.z = None
+        # where the moves leading to it start from, its start without any
+        self.entry = start
+
+
+def _is_move(line):
+    return isinstance(line, Segment) and line.type in ("G0", "G1", "G2", "G3")
+
+
+def split_islands(lines, position=(0.0, 0.0, 0.0, 0.0)):
+    """
+    Splits lines at their travel moves, moves which change the
+    position without extruding, into islands: the runs of lines
+    in between which extrude. The G1 moves at the same height
+    right after an island's extruding moves close or wipe it and
+    stay with it. Runs which do not extrude (a layer change, a
+    G92) are kept with the island after them, as are the travel
+    moves and the comments before it.
+
+    Returns (islands, suffix), the lines after the last island.
+    """
+    islands = []
+    before = []
+    run = []
+    extrudes = False
+    x, y, z, e = position
+    run_start = (x, y, z)
+    run_e = e
+    z_extrude = None
+    # the last line moved without retracting, so a travel move may close the island
+    closing = False
+
+    def close():
+        # the comments after the island's last segment lead to the next one
+        k = len(run)
+        while k and not isinstance(run[k - 1], Segment):
+            k -= 1
+        island = Island(before, run_start, run_e)
+        island.lines = run[:k]
+        island.end = (x, y, z)
+        island.e_end = e
+        island.z = z_extrude
+        moves = [line.coords for line in before if _is_move(line)]
+        if moves:
+            island.entry = (moves[0]["X"], moves[0]["Y"], moves[0]["Z"])
+        islands.append(island)
+        return run[k:]
+
+    for line in lines:
+        if not isinstance(line, Segment):
+            run.append(line)
+            closing = False
+            continue
+        coords = line.coords
+        new = (coords["X"], coords["Y"], coords["Z"], coords.get("E", e))
+        moves = new[:3] != (x, y, z)
+        if _is_move(line) and moves and new[3] == e:
+            if extrudes and closing and line.type == "G1" and new[2] == z:
+                # closes or wipes the island, nothing in between
+                run.append(line)
+                x, y, z, e = new
+                continue
+            # a travel move closes the run before it
+            if extrudes:
+                before = close()
+            else:
+                before.extend(run)
+            before.append(line)
+            run = []
+            extrudes = False
+            run_start = new[:3]
+            run_e = new[3]
+        else:
+            if not extrudes and _is_move(line) and moves and new[3] > e:
+                extrudes = True
+                z_extrude = new[2]
+            run.append(line)
+        closing = _is_move(line) and moves and new[3] >= e
+        x, y, z, e = new
+    if extrudes:
+        return islands, close()
+    return islands, before + run
+
+
+def layer_groups(islands):
+    """
+    Runs of consecutive islands which start extruding at the
+    same height, the layers of a planar toolpath
+    """
+    groups = []
+    for island in islands:
+        if groups and groups[-1][0].z == island.z:
+            groups[-1].append(island)
+        else:
+            groups.append([island])
+    return groups
+
+
+def _ring(cx, cy, ring):
+    """
+    Cells at Chebyshev distance ring from (cx, cy)
+    """
+    if ring == 0:
+        yield cx, cy
+        return
+    for ix in range(cx - ring, cx + ring + 1):
+        yield ix, cy - ring
+        yield ix, cy + ring
+    for iy in range(cy - ring + 1, cy + ring):
+        yield cx - ring, iy
+        yield cx + ring, iy
+
+
+def nearest_neighbour(starts, ends, origin):
+    """
+    Greedy order of the islands, each time travelling from the
+    end of the last one to the nearest start left. The starts
+    are hashed into a uniform grid of about one per cell, so each
+    step only scans the rings of cells around the current point.
+    """
+    n = len(starts)
+    lo = starts.min(axis=0)
+    cell = max(float((starts.max(axis=0) - lo).max()), 1e-9) / max(1.0, math.sqrt(n))
+    cells = ((starts - lo) // cell).astype(np.int64)
+    size = int(cells.max())
+    grid = {}
+    for i, key in enumerate(map(tuple, cells.tolist())):
+        grid.setdefault(key, []).append(i)
+
+    order = []
+    point = np.asarray(origin, dtype=np.float64)
+    for _ in range(n):
+        cx, cy = ((point - lo) // cell).astype(np.int64).tolist()
+        last_ring = max(abs(cx), abs(cy), abs(size - cx), abs(size - cy))
+        best = None
+        best_d = math.inf
+        for ring in range(last_ring + 1):
+            for key in _ring(cx, cy, ring):
+                for i in grid.get(key, ()):
+                    d = math.hypot(starts[i, 0] - point[0], starts[i, 1] - point[1])
+                    if d < best_d or (d == best_d and i < best):
+                        best, best_d = i, d
+            # anything in the next rings is at least ring cells away
+            if best is not None and best_d <= ring * cell:
+                break
+        grid[tuple(cells[best].tolist())].remove(best)
+        order.append(best)
+        point = ends[best]
+    return order
+
+
+def two_opt(order, starts, ends, origin):
+    """
+    Improves an island order by reversing runs of it while that
+    shortens the travel. The islands themselves keep their
+    direction, so travel costs are asymmetric and the cost of a
+    reversed run is summed from the end of each island to the
+    start of the one before it.
+    """
+    order = np.array(order)
+    n = len(order)
+    if n < 3:
+        return order.tolist()
+    # D[a, b] travel from the end of island a to the start of b, row n from origin
+    froms = np.vstack([ends, [origin]])
+    D = np.hypot(
+        froms[:, None, 0] - starts[None, :, 0], froms[:, None, 1] - starts[None, :, 1]
+    )
+
+    def sums(order):
+        forward = np.concatenate([[0.0], np.cumsum(D[order[:-1], order[1:]])])
+        backward = np.concatenate([[0.0], np.cumsum(D[order[1:], order[:-1]])])
+        return forward, backward
+
+    improved = True
+    while improved:
+        improved = False
+        forward, backward = sums(order)
+        for i in range(n - 1):
+            before = order[i - 1] if i else n
+            j = np.arange(i + 1, n)
+            after = np.where(j + 1 < n, order[np.minimum(j + 1, n - 1)], -1)
+            has_after = after >= 0
+            old = (
+                D[before, order[i]]
+                + forward[j] - forward[i]
+                + np.where(has_after, D[order[j], np.maximum(after, 0)], 0.0)
+            )
+            new = (
+                D[before, order[j]]
+                + backward[j] - backward[i]
+                + np.where(has_after, D[order[i], np.maximum(after, 0)], 0.0)
+            )
+            gain = old - new
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                k = j[best]
+                order[i : k + 1] = order[i : k + 1][::-1].copy()
+                forward, backward = sums(order)
+                improved = True
+    return order.tolist()
+
+
+def _travel_length(order, islands, origin):
+    point = origin
+    length = 0.0
+    for i in order:
+        entry = islands[i].entry
+        length += math.hypot(entry[0] - point[0], entry[1] - point[1])
+        point = islands[i].end
+    return length
+
+
+def _group_lines(group, order):
+    lines = []
+    for i in order:
+        lines.extend(group[i].before)
+        lines.extend(group[i].lines)
+    return lines
+
+
+def _lines_time(lines, deltas):
+    """
+    Estimated time in seconds of the moves of lines, each moving
+    the filament by its E delta
+    """
+    start, end, e, f = [], [], [], []
+    point = None
+    for line in lines:
+        if _is_move(line):
+            coords = line.coords
+            new = (coords["X"], coords["Y"], coords["Z"])
+            start.append(new if point is None else point)
+            end.append(new)
+            e.append(abs(deltas.get(id(line), 0.0)))
+            f.append(coords["F"])
+            point = new
+    if not start:
+        return 0.0
+    return float(move_times(np.array(start), np.array(end), np.array(e), np.array(f)).sum())
+
+
+def _fix_feedrates(lines):
+    """
+    Writes out the F of every move which would otherwise run at
+    the feedrate of a move it no longer follows
+    """
+    feedrate = None
+    for line in lines:
+        if _is_move(line):
+            if FEEDRATE.search(line.line.partition(";")[0]) is None:
+                if line.coords["F"] != feedrate:
+                    line.line = set_feedrate(line.line, line.coords["F"])
+            feedrate = line.coords["F"]
+
+
+def _extrusion_deltas(lines):
+    """
+    E of each segment relative to the segment before it, by id
+    """
+    deltas = {}
+    e = 0.0
+    for line in lines:
+        if isinstance(line, Segment) and "E" in line.coords:
+            # G92 and G28 set the position, the moves are relative to it
+            if line.type not in ("G92", "G28"):
+                deltas[id(line)] = line.coords["E"] - e
+            e = line.coords["E"]
+    return deltas
+
+
+def _rewrite_extrusion(lines, deltas):
+    """
+    Re-accumulates absolute E over the reordered lines from
+    the per-segment deltas, rewriting the lines whose E changed.
+    Returns the number of lines rewritten.
+    """
+    rewritten = 0
+    e = 0.0
+    for line in lines:
+        if not isinstance(line, Segment) or "E" not in line.coords:
+            continue
+        delta = deltas.get(id(line))
+        if delta is None:
+            # G92 and G28
+            e = line.coords["E"]
+            continue
+        new = round(e + delta, 5)
+        if abs(new - line.coords["E"]) > 1e-9:
+            line.coords = dict(line.coords, E=new)
+            command, semicolon, comment = line.line.partition(";")
+            if EXTRUSION.search(command):
+                command = EXTRUSION.sub("E{}".format(new), command, count=1)
+                line.line = command + semicolon + comment
+                rewritten += 1
+        e = new
+    return rewritten
+
+
+def _order_group(group, two_opt_limit):
+    """
+    Order of the islands of a layer after its first one, which
+    stays first as the layer change leads to it
+    """
+    starts = np.array([island.entry[:2] for island in group[1:]], dtype=np.float64)
+    ends = np.array([island.end[:2] for island in group[1:]], dtype=np.float64)
+    origin = np.array(group[0].end[:2], dtype=np.float64)
+    order = nearest_neighbour(starts, ends, origin)
+    if len(order) <= two_opt_limit:
+        order = two_opt(order, starts, ends, origin)
+    return [0] + [i + 1 for i in order]
+
+
+def reorder_islands(model, two_opt_limit=MAX_TWO_OPT):
+    """
+    Reorders the islands of every layer, the runs of extruding
+    lines between travel moves, to shorten the travel between
+    them: nearest neighbour from the end of the layer's first
+    island, then 2-opt. A layer keeps its new order only if its
+    estimated time goes down too. Islands keep their lines and
+    direction, and the lines leading to an island (travel, Z
+    hops, G92...) move with it: no line is added or dropped.
+    Moves are absolute, so they still end where they did, and
+    absolute E is re-accumulated so every move extrudes what it
+    did before.
+
+    Layers are told apart by the height islands start extruding
+    at, so this is meant for planar toolpaths, before conforming.
+
+    Returns a report of the islands, travel distance (mm) and
+    estimated print time (s) before and after. Raises ValueError
+    if the model moves or extrudes relatively anywhere.
+    """
+    t1 = time.perf_counter()
+    if relative_anywhere(model):
+        raise ValueError("Relative moves or extrusion (G91/M83), cannot reorder islands")
+    before = estimate_time(model)
+
+    report = {"islands": 0, "layers_reordered": 0, "travel_before": 0.0, "travel_after": 0.0}
+    with profiler.stage("reorder") as stage:
+        lines = model.segments
+        start = model.start_coords()
+        islands, suffix = split_islands(
+            lines, (start["X"], start["Y"], start["Z"], start.get("E", 0.0))
+        )
+        report["islands"] = len(islands)
+        stage.add(len(lines))
+
+        deltas = _extrusion_deltas(lines)
+        orders = []
+        for group in layer_groups(islands):
+            order = list(range(len(group)))
+            if len(group) > 2:
+                new_order = _order_group(group, two_opt_limit)
+                origin = group[0].end
+                travel_before = _travel_length(order[1:], group, origin)
+                travel_after = _travel_length(new_order[1:], group, origin)
+                report["travel_before"] += travel_before
+                # kept only if the layer also prints faster, not just travels less
+                if travel_after < travel_before and _lines_time(
+                    _group_lines(group, new_order), deltas
+                ) < _lines_time(_group_lines(group, order), deltas):
+                    order = new_order
+                    report["layers_reordered"] += 1
+                    report["travel_after"] += travel_after
+                else:
+                    report["travel_after"] += travel_before
+            orders.append((group, order))
+
+        if report["layers_reordered"]:
+            new_lines = []
+            for group, order in orders:
+                new_lines.extend(_group_lines(group, order))
+            new_lines.extend(suffix)
+            report["e_rewritten"] = _rewrite_extrusion(new_lines, deltas)
+            _fix_feedrates(new_lines)
+            model.segments = new_lines
+            model.split_layers()
+            model.calc_metrics()
+
+    after = estimate_time(model)
+    report["time_before"] = before["total"]
+    report["time_after"] = after["total"]
+    report["seconds"] = time.perf_counter() - t1
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="reorder.py",
+        usage="%(prog)s [options]",
+        description="Reorders the islands of each layer to shorten travel moves.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the G-code file.")
+    parser.add_argument("-o", "--out", help="Output path (default: reordered_<file>).")
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    model = GcodeParser().parse_file(args.file)
+    try:
+        report = reorder_islands(model)
+    except ValueError as e:
+        parser.error(str(e))
+    out = args.out or os.path.join(
+        os.path.dirname(args.file), "reordered_" + os.path.basename(args.file)
+    )
+    model.write(out)
+    print(
+        "Reordered the islands of {} layers ({} islands) in {:.3f} ms".format(
+            report["layers_reordered"], report["islands"], report["seconds"] * 1000.0
+        )
+    )
+    print(
+        "Travel {:.1f} mm -> {:.1f} mm, estimated print time {} -> {}".format(
+            report["travel_before"],
+            report["travel_after"],
+            format_duration(report["time_before"]),
+            format_duration(report["time_after"]),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from visualise import (
+    POINT_BUDGET,
+    GCODE_LIMITS,
+    GCODE_VIEW,
+    CLOUD_LIMITS,
+    CLOUD_VIEW,
+    cloud_points,
+    gcode_points,
+    plot_points,
+)
+
+
+def load_points(kind, path, budget):
+    """
+    Parses one input into a decimated point array, run once
+    per input however many views are drawn from it.
+    """
+    t1 = time.perf_counter()
+    if kind == "cloud":
+        points = cloud_points(path, budget)
+    else:
+        points = gcode_points(path, budget)
+    return points, time.perf_counter() - t1
+
+
+def render(points, out_path, scatter, dpi, limits, view):
+    """
+    Draws one view in a worker process, matplotlib
+    state is never shared between figures.
+    """
+    t1 = time.perf_counter()
+    plot_points(
+        points[:, 0],
+        points[:, 1],
+        points[:, 2],
+        out_path,
+        scatter=scatter,
+        dpi=dpi,
+        limits=limits,
+        view=view,
+    )
+    return time.perf_counter() - t1
+
+
+def build_report(substrate, conformed, cloud=None, out_dir="plots", budget=POINT_BUDGET, dpi=300, workers=None):
+    """
+    Renders the before/after comparison figures of a conform
+    job and writes a summary of them to out_dir/report.json.
+
+    Parameters::
+            substrate - G-code of the substrate (line and scatter plots)
+            conformed - conformed G-code (line and scatter plots)
+            cloud - point cloud of the substrate (scatter plot), optional
+            out_dir - directory the figures and summary are written to
+            budget - most points drawn per figure
+            workers - number of processes, os.cpu_count() by default
+    """
+    t1 = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    inputs = [("substrate", "gcode", substrate), ("conformed", "gcode", conformed)]
+    if cloud:
+        inputs.append(("cloud", "cloud", cloud))
+
+    summary = {"inputs": {}, "figures": [], "budget": budget, "dpi": dpi}
+    with ProcessPoolExecutor(workers) as pool:
+        loads = {
+            name: pool.submit(load_points, kind, path, budget)
+            for name, kind, path in inputs
+        }
+        renders = []
+        for name, kind, path in inputs:
+            points, seconds = loads[name].result()
+            summary["inputs"][name] = {
+                "path": path,
+                "points": len(points),
+                "seconds": seconds,
+            }
+            filename = os.path.splitext(os.path.basename(path))[0]
+            if kind == "cloud":
+                views = [("scatter", True, CLOUD_LIMITS, CLOUD_VIEW)]
+            else:
+                views = [
+                    ("line", False, GCODE_LIMITS, GCODE_VIEW),
+                    ("scatter", True, GCODE_LIMITS, GCODE_VIEW),
+                ]
+            for type, scatter, limits, view in views:
+                out_path = os.path.join(out_dir, "{}_{}.jpg".format(filename, type))
+                future = pool.submit(render, points, out_path, scatter, dpi, limits, view)
+                renders.append((name, type, out_path, future))
+        for name, type, out_path, future in renders:
+            summary["figures"].append(
+                {"input": name, "type": type, "path": out_path, "seconds": future.result()}
+            )
+    summary["seconds"] = time.perf_counter() - t1
+
+    with open(os.path.join(out_dir, "report.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="report.py",
+        usage="%(prog)s [options]",
+        description="Renders the before/after comparison plots of a conform job.",
+    )
+    parser.add_argument(
+        "-s",
+        "--surface",
+        default="test/conform/Dome.gcode",
+        help="Path to the G-code file of the substrate.",
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        default="test/conform/conformed_1.0_Thin_film.gcode",
+        help="Path to the conformed G-code file.",
+    )
+    parser.add_argument(
+        "-p",
+        "--pointcloud",
+        help="Path to the point cloud of the substrate.",
+    )
+    parser.add_argument("-o", "--out", default="plots", help="Directory for the figures and summary.")
+    parser.add_argument(
+        "-b",
+        "--budget",
+        help="Most points to draw per figure.",
+        type=int,
+        default=POINT_BUDGET,
+    )
+    parser.add_argument("--dpi", help="Resolution of the saved plots.", type=int, default=300)
+    parser.add_argument("-j", "--jobs", help="Number of worker processes.", type=int)
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    summary = build_report(
+        args.surface, args.file, args.pointcloud, args.out, args.budget, args.dpi, args.jobs
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 from Gcode_Parser import GcodeParser, Segment
+from profiler import profiler
 import os
 import math
 import argparse
@@ -76,7 +77,7 @@ def increase_z_circle(model, z_raise_amt, x_centre, y_centre, radius):
                     )
                     line.line = new_line
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(prog='select_z_raise.py',
                                      usage='%(prog)s [options]',
                                      description='Parses a G-code file \
@@ -96,8 +97,15 @@ def main():
         help='Be verbose.',
         action='store_const', dest='loglevel', const=logging.INFO,
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--profile',
+        help='Print per-stage timings and counts.',
+        action='store_true',
+    )
+    args = parser.parse_args(argv)
     logging.basicConfig(level=args.loglevel)
+    if args.profile:
+        profiler.enable()
     parser = GcodeParser()
     model = parser.parse_file(args.file)
     increase_z_rect(model, z_raise_amt=3.00, x_min=0, x_max=200, y_min=100, y_max=110)
@@ -105,6 +113,8 @@ def main():
     increase_z_circle(model, z_raise_amt=10.00, x_centre=90, y_centre=65.0, radius=5.0)
     print(model)
     model.write("./test/select_z_raise_circle.gcode")
+    if args.profile:
+        print(profiler.report())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,147 @@
+import time
+import numpy as np
+from Gcode_Parser import Segment
+from gcode_edit import relative_anywhere
+from profiler import profiler
+
+
+def _has_e(line):
+    return "E" in line.line.split(";", 1)[0]
+
+
+def _axes(line):
+    return {word[0] for word in line.line.split(";", 1)[0].split()[1:]}
+
+
+def _mergeable(line):
+    """
+    A G0/G1 move without a comment whose text gives its whole
+    position, so that it still goes to the same place when the
+    moves before it are dropped
+    """
+    return (
+        isinstance(line, Segment)
+        and line.type in ("G0", "G1")
+        and ";" not in line.line
+        and _axes(line) >= set("XYZ")
+    )
+
+
+def _runs(lines):
+    """
+    Yields (start, stop) index ranges of the runs of consecutive
+    G0/G1 moves of the same type and feedrate, without comments,
+    all giving X, Y and Z and either all or none giving E.
+    """
+    start = None
+    for idx, line in enumerate(lines):
+        if start is not None and not (
+            _mergeable(line)
+            and line.type == lines[start].type
+            and line.coords["F"] == lines[start].coords["F"]
+            and _has_e(line) == _has_e(lines[start])
+        ):
+            if idx - start > 2:
+                yield start, idx
+            start = None
+        if start is None and _mergeable(line):
+            start = idx
+    if start is not None and len(lines) - start > 2:
+        yield start, len(lines)
+
+
+def simplify_run(points, extrusion, tolerance, e_tolerance):
+    """
+    Douglas-Peucker simplification of a run of moves.
+
+    Parameters::
+            points - (N, 3) XYZ end points of the moves
+            extrusion - (N,) E at the end of each move
+            tolerance - maximum XYZ distance of a dropped point from the merged move
+            e_tolerance - maximum difference between the E of a dropped point
+                          and the E deposited up to there along the merged move
+
+    Returns a boolean mask of the moves to keep, the first
+    and last are always kept.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a = points[first]
+        ab = points[last] - a
+        ap = points[first + 1 : last] - a
+        length2 = ab.dot(ab)
+        if length2 > 0:
+            t = np.clip(ap.dot(ab) / length2, 0.0, 1.0)
+        else:
+            t = np.zeros(len(ap))
+        distance = np.linalg.norm(ap - t[:, None] * ab, axis=1)
+        e_expected = extrusion[first] + t * (extrusion[last] - extrusion[first])
+        e_error = np.abs(extrusion[first + 1 : last] - e_expected)
+        error = np.maximum(distance / tolerance, e_error / e_tolerance)
+        worst = int(np.argmax(error))
+        if error[worst] > 1.0:
+            worst += first + 1
+            keep[worst] = True
+            stack.append((first, worst))
+            stack.append((worst, last))
+    return keep
+
+
+def merge_collinear(model, tolerance=0.01, e_tolerance=0.001):
+    """
+    Drops moves which lie (within tolerance) on the straight
+    move between their neighbours and whose extrusion matches
+    that move, e.g. runs of conformed segments over the flat top
+    of a substrate. Meant to run after increase_z and before
+    GcodeModel.write, the model layers are modified in place.
+    Only moves giving their whole position are merged.
+
+    Returns a report of the line counts and time taken. Raises
+    ValueError if the model moves or extrudes relatively anywhere.
+    """
+    if relative_anywhere(model):
+        raise ValueError("Relative moves or extrusion (G91/M83), cannot merge collinear moves")
+    t1 = time.perf_counter()
+    lines_before = sum(len(layer.lines) for layer in model.layers)
+    with profiler.stage("merge_collinear") as stage:
+        removed = 0
+        e = 0.0
+        for layer in model.layers:
+            lines = layer.lines
+            # lines without E leave the extruder where the previous move did
+            extrusion = []
+            for line in lines:
+                if isinstance(line, Segment) and _has_e(line):
+                    e = line.coords["E"]
+                extrusion.append(e)
+            drop = []
+            for start, stop in _runs(lines):
+                points = np.array(
+                    [
+                        (seg.coords["X"], seg.coords["Y"], seg.coords["Z"])
+                        for seg in lines[start:stop]
+                    ]
+                )
+                keep = simplify_run(
+                    points, np.array(extrusion[start:stop]), tolerance, e_tolerance
+                )
+                drop.extend(start + idx for idx in np.flatnonzero(~keep))
+            if drop:
+                dropped = set(drop)
+                layer.lines = [
+                    line for idx, line in enumerate(lines) if idx not in dropped
+                ]
+                removed += len(drop)
+            stage.add(len(lines))
+    lines_after = lines_before - removed
+    return {
+        "lines_before": lines_before,
+        "lines_after": lines_after,
+        "reduction": lines_before / lines_after if lines_after else None,
+        "seconds": time.perf_counter() - t1,
+    }
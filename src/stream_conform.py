@@ -0,0 +1,303 @@
+import os
+import sys
+import math
+import stat
+import asyncio
+import logging
+import argparse
+from Gcode_Parser import GcodeParser, Segment, Arc
+from gcode_io import open_gcode
+from conform_surface import conform_line, load_surface_file
+from line_splitter import split_segments, tessellate_arc
+
+
+class StreamConformer:
+    """
+    Splits and conforms G-code one line at a time, keeping only
+    the modal state of the parser and the last segment, so the
+    work per input line is bounded by its number of splits.
+    """
+
+    def __init__(self, surface=None, max_seg_length=1.0):
+        """
+        Parameters::
+                surface - SurfaceIndex to conform onto (None only splits)
+                max_seg_length - maximum length of a single line in mm
+        """
+        self.parser = GcodeParser()
+        self.model = self.parser.model
+        self.surface = surface
+        self.max_seg_length = max_seg_length
+        self.half_width = max_seg_length * 0.5
+        # last segment as parsed, before it was raised onto the surface
+        self.previous = None
+        # last segment as written out
+        self.conformed = None
+        self.e_running = 0
+        self.halted = False
+
+    def feed(self, text):
+        """
+        Processes one line of G-code and returns the list
+        of lines to be sent on in its place.
+        """
+        return [line.line for line in self.feed_lines(text)]
+
+    def feed_lines(self, text):
+        """
+        Processes one line of G-code and returns the list of
+        Line/Segment objects to be sent on in its place.
+        """
+        parser = self.parser
+        parser.line_num += 1
+        parser.line = text.rstrip()
+        parser.parse_line()
+        lines = self.model.segments
+        if not lines:
+            return []
+        self.model.segments = []
+
+        out = []
+        for line in lines:
+            if "EXTRUDING_STOP" in line.line[0:14]:
+                self.halted = True
+            if not isinstance(line, Segment):
+                out.append(line)
+                continue
+
+            if line.coords is self.model.relative:
+                # G28/G92 share the parser state, which conforming must not raise
+                line.coords = dict(line.coords)
+            pieces = [line]
+            previous = self.previous
+            if isinstance(line, Arc) and not self.halted:
+                line.distance = line.length()
+                pieces = tessellate_arc(self.model, line, self.max_seg_length)
+                line = pieces[-1]
+            elif previous is not None:
+                line.distance = math.sqrt(
+                    (line.coords["X"] - previous.coords["X"]) ** 2
+                    + (line.coords["Y"] - previous.coords["Y"]) ** 2
+                    + (line.coords["Z"] - previous.coords["Z"]) ** 2
+                )
+                if not self.halted and line.distance > self.max_seg_length:
+                    pieces = split_segments(self.model, line, previous, self.max_seg_length)
+                    pieces.append(line)
+            self.previous = Segment(line.type, dict(line.coords), line.line_num, line.line)
+
+            for piece in pieces:
+                if self.surface is not None:
+                    self.e_running = conform_line(
+                        piece,
+                        self.conformed or piece,
+                        self.surface,
+                        self.half_width,
+                        self.e_running,
+                        self.conformed is None,
+                    )
+                self.conformed = piece
+                out.append(piece)
+        return out
+
+
+async def conform_lines(source, surface=None, max_seg_length=1.0, yield_every=64):
+    """
+    Async generator of split (and conformed, if a surface is
+    given) lines for the lines of an async source. Lines are
+    only read from the source as fast as they are consumed.
+    """
+    conformer = StreamConformer(surface, max_seg_length)
+    count = 0
+    async for text in source:
+        if isinstance(text, bytes):
+            text = text.decode()
+        for line in conformer.feed(text):
+            yield line
+        count += 1
+        # let other tasks run even if the source never blocks
+        if count % yield_every == 0:
+            await asyncio.sleep(0)
+
+
+async def file_source(path, chunk_size=1 << 16):
+    """
+    Async source of the lines of a file, read in chunks
+    on a worker thread.
+    """
+    with open_gcode(path, "r") as f:
+        async for line in _chunked_lines(f, chunk_size):
+            yield line
+
+
+async def _chunked_lines(f, chunk_size):
+    rest = ""
+    while True:
+        chunk = await asyncio.to_thread(f.read, chunk_size)
+        if not chunk:
+            break
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+async def reader_source(reader):
+    """
+    Async source of the lines of an asyncio.StreamReader,
+    e.g. a socket or pipe.
+    """
+    async for line in reader:
+        yield line.decode()
+
+
+async def pipe_source(pipe=None):
+    """
+    Async source of the lines of a pipe, stdin by default.
+    """
+    pipe = pipe or sys.stdin
+    mode = os.fstat(pipe.fileno()).st_mode
+    if not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode)):
+        # a regular file redirected to stdin cannot be watched by the event loop
+        async for line in _chunked_lines(pipe, 1 << 16):
+            yield line
+        return
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe
+    )
+    async for line in reader_source(reader):
+        yield line
+
+
+def writer_sink(writer):
+    """
+    Sink writing lines to an asyncio.StreamWriter, waiting
+    for its buffer to drain when the other end falls behind.
+    """
+
+    async def sink(line):
+        writer.write(line.encode() + b"\n")
+        await writer.drain()
+
+    return sink
+
+
+async def pump(source, sink, surface=None, max_seg_length=1.0, queue_size=1024):
+    """
+    Conforms the lines of source in a producer task and passes
+    them to the sink coroutine through a bounded queue. The
+    producer stays at most queue_size lines ahead of the sink,
+    so a slow printer link holds back the processing.
+
+    Returns the number of lines sent to the sink.
+    """
+    queue = asyncio.Queue(queue_size)
+
+    async def produce():
+        try:
+            async for line in conform_lines(source, surface, max_seg_length):
+                await queue.put(line)
+        finally:
+            await queue.put(None)
+
+    task = asyncio.create_task(produce())
+    sent = 0
+    try:
+        while True:
+            line = await queue.get()
+            if line is None:
+                break
+            await sink(line)
+            sent += 1
+    except BaseException:
+        task.cancel()
+        raise
+    await task
+    return sent
+
+
+async def run(args, surface):
+    source = pipe_source() if args.file == "-" else file_source(args.file)
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        _, writer = await asyncio.open_connection(host, int(port))
+        sink = writer_sink(writer)
+    else:
+        writer = None
+
+        async def sink(line):
+            sys.stdout.write(line)
+            sys.stdout.write("\n")
+
+    try:
+        return await pump(source, sink, surface, args.length, args.queue)
+    finally:
+        if writer is not None:
+            writer.close()
+            await writer.wait_closed()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="stream_conform.py",
+        usage="%(prog)s [options]",
+        description="Streams split and conformed G-code line by line.",
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        default="-",
+        help="Path to the G-code file to be streamed, - for stdin.",
+    )
+    parser.add_argument(
+        "-s",
+        "--surface",
+        help="G-code or point cloud of the substrate (omit to only split).",
+    )
+    parser.add_argument(
+        "-l",
+        "--length",
+        help="Maximum length of a single line.",
+        type=float,
+        default=1.00,
+    )
+    parser.add_argument(
+        "-c",
+        "--connect",
+        help="Send the output to host:port instead of stdout.",
+    )
+    parser.add_argument(
+        "-q",
+        "--queue",
+        help="Lines processed ahead of the output.",
+        type=int,
+        default=1024,
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+    surface = load_surface_file(args.surface, args.length) if args.surface else None
+    asyncio.run(run(args, surface))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import numpy as np
+from Gcode_Parser import Segment
+from conform_surface import EPSILON
+from gcode_edit import relative_anywhere
+from line_splitter import convert_to_small_segments
+from profiler import profiler
+
+
+def _shift(grid, dx, dy):
+    """
+    grid moved by (dx, dy) cells, NaN where it falls off the edge
+    """
+    shifted = np.full_like(grid, np.nan)
+    nx, ny = grid.shape
+    shifted[max(0, -dx) : nx - max(0, dx), max(0, -dy) : ny - max(0, dy)] = grid[
+        max(0, dx) : nx - max(0, -dx), max(0, dy) : ny - max(0, -dy)
+    ]
+    return shifted
+
+
+def _slope(grid, axis, step, spacing):
+    """
+    Central difference of grid along an axis over +-step cells,
+    one-sided next to holes and 0 where both neighbours are missing.
+    """
+    offset = [0, 0]
+    offset[axis] = step
+    ahead = _shift(grid, *offset)
+    behind = _shift(grid, *[-o for o in offset])
+    slope = np.where(np.isnan(ahead), grid - behind, ahead - grid) / (step * spacing)
+    slope = np.where(
+        ~np.isnan(ahead) & ~np.isnan(behind), (ahead - behind) / (2 * step * spacing), slope
+    )
+    return np.nan_to_num(slope, nan=0.0)
+
+
+class NormalField:
+    """
+    Height map of the substrate on a regular XY grid with the unit
+    surface normal of every cell, computed once from the point
+    cloud so conforming only has to index into it.
+
+    The height of a cell is the highest point within half_width of
+    it, matching the lookup window of SurfaceIndex.max_z (rounded
+    out to whole cells), and the normal comes from the slope of
+    the height map over the same distance.
+    """
+
+    def __init__(self, origin, resolution, heights, normals):
+        self.origin = origin
+        self.resolution = resolution
+        self.heights = heights
+        self.normals = normals
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.heights)))
+
+    @classmethod
+    def build(cls, points, half_width, resolution=None):
+        """
+        Parameters::
+                points - (N, 3) surface point array
+                half_width - half width of the lookup window in mm
+                resolution - side of a grid cell in mm, half_width / 2 by default
+        """
+        resolution = resolution or half_width / 2
+        with profiler.stage("normal_field") as stage:
+            points = np.asarray(points, dtype=np.float64)
+            cells = np.floor(points[:, :2] / resolution).astype(np.int64)
+            origin = cells.min(axis=0)
+            cells -= origin
+            shape = tuple(cells.max(axis=0) + 1)
+            top = np.full(shape, -np.inf)
+            np.maximum.at(top, (cells[:, 0], cells[:, 1]), points[:, 2])
+            top[np.isinf(top)] = np.nan
+
+            # highest point of the cells the lookup window can reach
+            reach = int(np.floor(half_width / resolution))
+            heights = top.copy()
+            for dx in range(-reach, reach + 1):
+                for dy in range(-reach, reach + 1):
+                    if dx or dy:
+                        heights = np.fmax(heights, _shift(top, dx, dy))
+
+            step = max(1, int(round(half_width / resolution)))
+            normals = np.stack(
+                [
+                    -_slope(heights, 0, step, resolution),
+                    -_slope(heights, 1, step, resolution),
+                    np.ones(shape),
+                ],
+                axis=-1,
+            )
+            normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+            stage.add(len(points))
+        return cls(origin, resolution, heights, normals)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data["origin"], float(data["resolution"]), data["heights"], data["normals"]
+            )
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                origin=self.origin,
+                resolution=self.resolution,
+                heights=self.heights,
+                normals=self.normals,
+            )
+
+    def lookup(self, x, y):
+        """
+        Surface heights (NaN off the surface) and (N, 3) unit
+        normals under arrays of XY points.
+        """
+        ix = np.floor(np.asarray(x) / self.resolution).astype(np.int64) - self.origin[0]
+        iy = np.floor(np.asarray(y) / self.resolution).astype(np.int64) - self.origin[1]
+        inside = (ix >= 0) & (ix < self.heights.shape[0]) & (iy >= 0) & (iy < self.heights.shape[1])
+        ix = np.where(inside, ix, 0)
+        iy = np.where(inside, iy, 0)
+        heights = np.where(inside, self.heights[ix, iy], np.nan)
+        normals = np.where(inside[:, None], self.normals[ix, iy], [0.0, 0.0, 1.0])
+        return heights, normals
+
+
+def _format(line, with_e):
+    if with_e:
+        return "{0} X{1} Y{2} Z{3} E{4} F{5}".format(
+            line.type,
+            line.coords["X"],
+            line.coords["Y"],
+            line.coords["Z"],
+            line.coords["E"],
+            line.coords["F"],
+        )
+    return "{0} X{1} Y{2} Z{3} F{4}".format(
+        line.type, line.coords["X"], line.coords["Y"], line.coords["Z"], line.coords["F"]
+    )
+
+
+def offset_normals(model, field, max_seg_length):
+    """
+    Conforms the model onto the surface by offsetting every
+    point along the surface normal under it, by its height above
+    the bed plus EPSILON, instead of straight up as increase_z
+    does. Layers then keep their thickness across steep flanks.
+    Where the surface is flat the extruding moves are the same
+    as with increase_z. G0 travel moves are offset as well, so
+    they clear the surface rather than run through it.
+
+    Parameters::
+            model - parsed model with absolute extrusion
+            field - NormalField of the substrate
+            max_seg_length - maximum length of a single line
+
+    Raises ValueError if the model moves or extrudes relatively
+    anywhere. Extrusion is scaled by the change in length of each
+    move, as increase_z does. Lookups and offsets are applied to all the
+    segments at once as arrays.
+    """
+    if relative_anywhere(model):
+        raise ValueError("Relative moves or extrusion (G91/M83), cannot conform along normals")
+    model = convert_to_small_segments(model, max_seg_length, arcs=True)
+    lines = [
+        line
+        for layer in model.layers
+        for line in layer.lines
+        if isinstance(line, Segment)
+    ]
+    if not lines:
+        return model
+
+    with profiler.stage("conform") as stage:
+        old = np.array(
+            [
+                (line.coords["X"], line.coords["Y"], line.coords["Z"], line.coords.get("E", 0.0))
+                for line in lines
+            ],
+            dtype=np.float64,
+        )
+        moves = np.fromiter(
+            (line.type in ("G0", "G1") for line in lines), dtype=bool, count=len(lines)
+        )
+        g1 = np.fromiter((line.type == "G1" for line in lines), dtype=bool, count=len(lines))
+        profiler.count("surface_lookups", len(lines))
+        heights, normals = field.lookup(old[:, 0], old[:, 1])
+        # as in conform_line, points off the surface are left where they are
+        on = moves & ~np.isnan(heights) & (np.nan_to_num(heights) != 0)
+        # same order of operations as conform_line, so flat regions give the same floats
+        z = old[on, 2, None]
+        new = old[:, :3].copy()
+        new[on, :2] += z * normals[on, :2] + EPSILON * normals[on, :2]
+        new[on, 2] = heights[on] + z[:, 0] * normals[on, 2] + EPSILON * normals[on, 2]
+
+        # extrusion scaled by the ratio of the new to the old length of each move
+        old_length = np.linalg.norm(np.diff(old[:, :3], axis=0), axis=1)
+        new_length = np.linalg.norm(np.diff(new, axis=0), axis=1)
+        factor = np.divide(new_length, old_length, out=np.ones_like(old_length), where=old_length > 0)
+        e_diff = np.diff(old[:, 3])
+        extruding = g1[1:] & g1[:-1] & (e_diff > 0)
+        correction = np.concatenate([[0.0], np.where(extruding, (factor - 1.0) * e_diff, 0.0)])
+        # the running correction starts again after every G92 E0
+        resets = np.fromiter(
+            ("G92 E0" in line.line for line in lines), dtype=bool, count=len(lines)
+        )
+        total = np.cumsum(correction)
+        group = np.cumsum(resets)
+        base = np.concatenate([[0.0], total[resets]])
+        e_new = old[:, 3] + total - base[group]
+        # conform_line also writes out the E of raised moves between extruding ones
+        with_e = np.fromiter(
+            ("E" in line.line.split(";", 1)[0] for line in lines), dtype=bool, count=len(lines)
+        )
+        with_e[1:] |= g1[1:] & on[1:] & (old[1:, 3] != 0) & (old[:-1, 3] != 0)
+
+        for idx in np.flatnonzero(moves).tolist():
+            line = lines[idx]
+            line.coords = dict(line.coords)
+            line.coords["X"], line.coords["Y"], line.coords["Z"] = new[idx].tolist()
+            if "E" in line.coords:
+                line.coords["E"] = float(e_new[idx])
+            line.line = _format(line, with_e[idx])
+        stage.add(len(lines))
+    return model
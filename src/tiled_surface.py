@@ -0,0 +1,240 @@
+import os
+import math
+import json
+import logging
+import argparse
+from collections import OrderedDict
+import numpy as np
+from conform_surface import SurfaceIndex
+from gcode_io import open_gcode
+from profiler import profiler
+
+MANIFEST = "tiles.json"
+
+
+def _tile_path(directory, tx, ty):
+    return os.path.join(directory, "tile_{}_{}.bin".format(tx, ty))
+
+
+def _read_chunks(path, chunk_lines):
+    """
+    (N, 3) arrays of the points of a point cloud file,
+    chunk_lines at a time
+    """
+    with open_gcode(path, "r") as f:
+        while True:
+            lines = [line for _, line in zip(range(chunk_lines), f)]
+            if not lines:
+                break
+            yield np.loadtxt(lines, ndmin=2)[:, :3]
+
+
+def build_tiles(source, directory, tile_size=20.0, cell_size=0.5, chunk_lines=1 << 20):
+    """
+    Splits a point cloud into square XY tiles of raw float64
+    files which TiledSurface memory-maps on demand. The cloud is
+    read chunk_lines points at a time, so it never has to fit in
+    memory.
+
+    Parameters::
+            source - point cloud file, or an (N, 3) point array
+            directory - where the tiles and their manifest are written
+            tile_size - side of a tile in mm, rounded to whole cells
+            cell_size - side of a grid cell of the surface index in mm
+    """
+    os.makedirs(directory, exist_ok=True)
+    cells_per_tile = max(1, round(tile_size / cell_size))
+    if isinstance(source, str):
+        chunks = _read_chunks(source, chunk_lines)
+    else:
+        chunks = [np.asarray(source, dtype=np.float64)[:, :3]]
+    # tiles of an earlier build would otherwise be appended to
+    for name in os.listdir(directory):
+        if name.startswith("tile_") and name.endswith(".bin"):
+            os.remove(os.path.join(directory, name))
+    counts = {}
+    with profiler.stage("build_tiles") as stage:
+        for points in chunks:
+            # tiles of whole cells, so a cell never spans two tiles
+            cell = np.floor(points[:, :2] / cell_size).astype(np.int64)
+            tile = np.floor_divide(cell, cells_per_tile)
+            order = np.lexsort((tile[:, 1], tile[:, 0]))
+            tile = tile[order]
+            points = points[order]
+            starts = np.flatnonzero(np.any(np.diff(tile, axis=0) != 0, axis=1)) + 1
+            for block, key in zip(
+                np.split(points, starts), tile[np.concatenate([[0], starts])].tolist()
+            ):
+                key = tuple(key)
+                mode = "ab" if key in counts else "wb"
+                with open(_tile_path(directory, *key), mode) as f:
+                    f.write(np.ascontiguousarray(block, dtype=np.float64).tobytes())
+                counts[key] = counts.get(key, 0) + len(block)
+            stage.add(len(points))
+        # points sorted by cell, so a loaded tile's cells are slices of its file
+        for key in counts:
+            path = _tile_path(directory, *key)
+            points = np.fromfile(path, dtype=np.float64).reshape(-1, 3)
+            cell = np.floor(points[:, :2] / cell_size).astype(np.int64)
+            points[np.lexsort((cell[:, 1], cell[:, 0]))].tofile(path)
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(
+            {
+                "cell_size": cell_size,
+                "cells_per_tile": cells_per_tile,
+                "points": sum(counts.values()),
+                "tiles": [[tx, ty, count] for (tx, ty), count in sorted(counts.items())],
+            },
+            f,
+        )
+    return directory
+
+
+def is_tiled(path, source=None):
+    """
+    True if path holds tiles built by build_tiles, and
+    they are not older than the point cloud file source if given.
+    """
+    manifest = os.path.join(path, MANIFEST)
+    if not os.path.isfile(manifest):
+        return False
+    return source is None or os.path.getmtime(manifest) >= os.path.getmtime(source)
+
+
+class TileCells:
+    """
+    Mapping of grid cells to their points, memory-mapping the
+    tile holding a cell on first use and keeping only the most
+    recently used tiles open. Opening a tile reads all of it once
+    to find where each cell starts, the points of a cell are then
+    a slice of the tile's memory map rather than a copy.
+    """
+
+    def __init__(self, directory, cell_size, cells_per_tile, counts, capacity):
+        self.directory = directory
+        self.cell_size = cell_size
+        self.cells_per_tile = cells_per_tile
+        self.counts = counts
+        self.capacity = capacity
+        self.tiles = OrderedDict()
+        self.loads = 0
+
+    def tile(self, key):
+        cells = self.tiles.get(key)
+        if cells is not None:
+            self.tiles.move_to_end(key)
+            profiler.hit("surface_tiles")
+            return cells
+        profiler.miss("surface_tiles")
+        cells = {}
+        if key in self.counts:
+            points = np.memmap(_tile_path(self.directory, *key), dtype=np.float64, mode="r")
+            points = points.reshape(-1, 3)
+            # build_tiles sorted the points by cell
+            cell = np.floor(points[:, :2] / self.cell_size).astype(np.int64)
+            starts = np.flatnonzero(np.any(np.diff(cell, axis=0) != 0, axis=1)) + 1
+            bounds = np.concatenate([[0], starts, [len(points)]]).tolist()
+            for start, end, (ix, iy) in zip(bounds[:-1], bounds[1:], cell[bounds[:-1]].tolist()):
+                cells[(ix, iy)] = points[start:end]
+        self.tiles[key] = cells
+        self.loads += 1
+        while len(self.tiles) > self.capacity:
+            self.tiles.popitem(last=False)
+        return cells
+
+    def get(self, key):
+        ix, iy = key
+        return self.tile((ix // self.cells_per_tile, iy // self.cells_per_tile)).get(key)
+
+
+class TiledSurface(SurfaceIndex):
+    """
+    Surface index of a point cloud split into tiles by
+    build_tiles. Only the tiles around the toolpath are held in
+    memory, at most capacity of them at a time, so memory use
+    does not grow with the size of the substrate. Lookups give
+    the same results as a SurfaceIndex of the whole cloud.
+    """
+
+    def __init__(self, directory, capacity=16):
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.cell_size = manifest["cell_size"]
+        self.size = manifest["points"]
+        counts = {(tx, ty): count for tx, ty, count in manifest["tiles"]}
+        self.cells = TileCells(
+            directory, self.cell_size, manifest["cells_per_tile"], counts, capacity
+        )
+
+    def packed(self):
+        # tiles are only loaded on demand, so conforming always goes through max_z
+        return None
+
+    def max_z(self, x, y, half_width):
+        """
+        Highest Z of the points strictly inside the square window
+        of the given half width around (x, y), 0 if it is empty,
+        scanning each cell's slice of its tile at once.
+        """
+        cell_size = self.cell_size
+        z_max = None
+        for ix in range(
+            math.floor((x - half_width) / cell_size),
+            math.floor((x + half_width) / cell_size) + 1,
+        ):
+            for iy in range(
+                math.floor((y - half_width) / cell_size),
+                math.floor((y + half_width) / cell_size) + 1,
+            ):
+                cell = self.cells.get((ix, iy))
+                if cell is None:
+                    continue
+                inside = (np.abs(x - cell[:, 0]) < half_width) & (np.abs(y - cell[:, 1]) < half_width)
+                if inside.any():
+                    z = float(cell[inside, 2].max())
+                    if z_max is None or z > z_max:
+                        z_max = z
+        return z_max if z_max is not None else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="tiled_surface.py",
+        usage="%(prog)s [options]",
+        description="Splits a point cloud into memory-mapped surface tiles.",
+    )
+    parser.add_argument("-f", "--file", required=True, help="Path to the point cloud file.")
+    parser.add_argument("-o", "--out", required=True, help="Directory for the tiles.")
+    parser.add_argument(
+        "-t",
+        "--tile-size",
+        help="Side of a tile in mm.",
+        type=float,
+        default=20.0,
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Print lots of debugging statements.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.ERROR,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Be verbose.",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+    build_tiles(args.file, args.out, args.tile_size)
+    surface = TiledSurface(args.out)
+    print("{} points in {} tiles".format(len(surface), len(surface.cells.counts)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,79 +1,141 @@
-import matplotlib.pyplot as plt
-import numpy as np
-from Gcode_Parser import GcodeParser, Segment
-from point_cloud import convert_to_number
-from plot_config import *
+from Gcode_Parser import GcodeParser
 import os
 import logging
-logging.basicConfig(level=logging.ERROR)
-
-def plot_point_cloud(path):
-    with open(path) as f:
-        pc = f.read().splitlines()    
-    pc = np.array(convert_to_number(pc))
-    X, Y, Z = pc[:, 0], pc[:, 1], pc[:, 2]
-    fig = plt.figure(figsize=[6,6], dpi=300)
-    ax = fig.add_subplot(projection='3d')
-    ax.scatter(X, Y, Z, s=1, marker=".", alpha=0.5, color=colors[4])
-    ax.axes.set_xlim3d(left=95, right=140)
-    ax.axes.set_ylim3d(bottom=95, top=140)
-    ax.axes.set_zlim3d(bottom=0, top=45)
-
-    # Create cubic bounding box to simulate equal aspect ratio
-    max_range = np.array([X.max() - X.min(), Y.max() - Y.min(), Z.max() - Z.min()]).max()
-    Yb = 0.5 * max_range * np.mgrid[-1:2:2,-1:2:2,-1:2:2][1].flatten() + 0.5 * (Y.max() + Y.min())
-    Xb = 0.5 * max_range * np.mgrid[-1:2:2,-1:2:2,-1:2:2][0].flatten() + 0.5 * (X.max() + X.min())
-    Zb = 0.5 * max_range * np.mgrid[-1:2:2,-1:2:2,-1:2:2][2].flatten() + 0.5 * (Z.max() + Z.min())
-    # Add the fake bounding box for make scaling correct:
-    for xb, yb, zb in zip(Xb, Yb, Zb):
-        ax.plot([xb], [yb], [zb], 'w')
-
-    elev, azim = 10, 70
-    ax.view_init(elev, azim)
-    print('ax.azim {}'.format(ax.azim))
-    print('ax.elev {}'.format(ax.elev))
-    fig.savefig("plots/pc.jpg", dpi=300)
-
-def plot_gcode(path, scatter=False):
-    parser = GcodeParser()
-    model = parser.parse_file(path)
-    lines = [
-        line
-        for layer in model.layers
-        for line in layer.lines
-        if isinstance(line, Segment)
-    ]
-
-    fig = plt.figure(figsize=[6,6], dpi=300)
-    ax = fig.add_subplot(projection='3d')
-
-    X, Y, Z = [], [], []
-    for line in lines:
-        if line.coords["E"]>0:
-            # print(line.line)
-            X.append(line.coords["X"])
-            Y.append(line.coords["Y"])
-            Z.append(line.coords["Z"])
-    
+
+# most points drawn in a single plot, beyond this they are no longer distinguishable
+POINT_BUDGET = 200000
+# axis limits and (elevation, azimuth) views of the G-code and point cloud plots
+GCODE_LIMITS = ((75, 160), (75, 160), (0, 100))
+GCODE_VIEW = (20, 70)
+CLOUD_LIMITS = ((95, 140), (95, 140), (0, 45))
+CLOUD_VIEW = (10, 70)
+
+
+def decimate(layer, count, budget=POINT_BUDGET, layer_step=1):
+    """
+    Indices of the points to draw out of count points, so at
+    most about budget points are drawn.
+
+    Parameters::
+            layer - layer index of each point (None to treat them as one layer)
+            count - number of points
+            budget - target number of points to draw
+            layer_step - only draw every layer_step-th layer
+    """
+    import numpy as np
+
+    keep = np.ones(count, dtype=bool)
+    if layer is not None and layer_step > 1:
+        _, inverse = np.unique(layer, return_inverse=True)
+        keep &= inverse % layer_step == 0
+    indices = np.flatnonzero(keep)
+    stride = -(-len(indices) // budget) if budget else 1
+    if stride <= 1:
+        return indices
+    sample = np.zeros(len(indices), dtype=bool)
+    sample[::stride] = True
+    sample[-1] = True
+    if layer is not None:
+        # keep the first and last point of each layer so its outline survives
+        layers = layer[indices]
+        edges = np.flatnonzero(layers[1:] != layers[:-1])
+        sample[edges] = True
+        sample[edges + 1] = True
+    return indices[sample]
+
+
+def _figure(dpi):
+    # headless backend, plots are only ever saved to file
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=[6, 6], dpi=dpi)
+    ax = fig.add_subplot(projection="3d")
+    return plt, fig, ax
+
+
+def plot_points(X, Y, Z, out_path, scatter=True, dpi=300, limits=None, view=GCODE_VIEW):
+    """
+    Plots coordinate arrays and saves the figure to out_path.
+
+    Parameters::
+            X, Y, Z - coordinate arrays of the (already decimated) points
+            scatter - scatter plot rather than a line through the points
+            limits - ((xmin, xmax), (ymin, ymax), (zmin, zmax)) axis limits
+            view - (elevation, azimuth) of the camera
+    """
+    from plot_config import colors
+
+    plt, fig, ax = _figure(dpi)
     if scatter:
-        type = "scatter"
         ax.scatter(X, Y, Z, s=1, marker=".", alpha=0.5, color=colors[4])
     else:
-        type = "line"
         ax.plot(X, Y, Z, color=colors[4])
+    if limits is not None:
+        (xmin, xmax), (ymin, ymax), (zmin, zmax) = limits
+        ax.axes.set_xlim3d(left=xmin, right=xmax)
+        ax.axes.set_ylim3d(bottom=ymin, top=ymax)
+        ax.axes.set_zlim3d(bottom=zmin, top=zmax)
+    ax.view_init(*view)
+    logging.info("ax.azim %s ax.elev %s", ax.azim, ax.elev)
+    fig.savefig(out_path, dpi=dpi)
+    plt.close(fig)
+    return fig, ax
+
+
+def cloud_points(path, budget=POINT_BUDGET):
+    """
+    Decimated (N, 3) array of the points of a point cloud file
+    """
+    import numpy as np
+
+    pc = np.loadtxt(path, ndmin=2)
+    return pc[decimate(None, len(pc), budget), :3]
+
+
+def gcode_points(path, budget=POINT_BUDGET, layer_step=1):
+    """
+    Decimated (N, 3) array of the moves of a G-code file
+    after extrusion has started
+    """
+    from move_arrays import MoveArrays
+
+    parser = GcodeParser()
+    model = parser.parse_file(path)
+    arrays = MoveArrays(model)
+    moving = arrays.e > 0
+    xyz = arrays.xyz[moving]
+    return xyz[decimate(arrays.layer[moving], len(xyz), budget, layer_step)]
+
+
+def plot_point_cloud(path, budget=POINT_BUDGET, dpi=300, out_path="plots/pc.jpg"):
+    pc = cloud_points(path, budget)
+    fig, ax = plot_points(
+        pc[:, 0], pc[:, 1], pc[:, 2], out_path, dpi=dpi, limits=CLOUD_LIMITS, view=CLOUD_VIEW
+    )
+    return fig
 
-    ax.axes.set_xlim3d(left=75, right=160)
-    ax.axes.set_ylim3d(bottom=75, top=160)
-    ax.axes.set_zlim3d(bottom=0, top=100)
 
-    elev, azim = 20, 70
-    ax.view_init(elev, azim)
-    print('ax.azim {}'.format(ax.azim))
-    print('ax.elev {}'.format(ax.elev))
+def plot_gcode(path, scatter=False, budget=POINT_BUDGET, layer_step=1, dpi=300):
+    xyz = gcode_points(path, budget, layer_step)
+    type = "scatter" if scatter else "line"
     filename = os.path.splitext(os.path.basename(path))[0]
-    fig.savefig(f"plots/{filename}_{type}.jpg", dpi=300)
+    fig, ax = plot_points(
+        xyz[:, 0],
+        xyz[:, 1],
+        xyz[:, 2],
+        f"plots/{filename}_{type}.jpg",
+        scatter=scatter,
+        dpi=dpi,
+        limits=GCODE_LIMITS,
+        view=GCODE_VIEW,
+    )
+    return fig
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
     # plot_point_cloud("test/conform/pointcloud_test_rect_absolute.txt")
     # plot_gcode("test/conform/dome.gcode", scatter=False)
     # plot_gcode("test/conform/test_rect_absolute.gcode", scatter=True)
@@ -0,0 +1,93 @@
+import os
+import sys
+
+# the modules in src/ are scripts importing each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+CONFORM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conform")
+
+# modes, G92/G28 resets and arcs changing part way through the file
+MIXED = """\
+; start
+G28
+G92 E0
+G1 Z0.2 F600
+G1 X1 Y1 E0.5 F1200
+G2 X3 Y1 I1 J0 E0.9
+M83
+G1 X2 Y2 E0.125
+G1 X3 Y2 E0.125
+G92 X1 E2.5
+G92 F3
+G1 X4 Y4 E0.1
+G91
+G1 X0.5 Y0.25 E0.1
+G1 X0.5 Y0.25 E0.1 ; relative
+G1 Z0.2
+G1 X-1 Y0.5 E0.2
+G90
+M82
+G92 E0
+G1 X5 Y5 E1.0
+G1 E0.5 F1800
+G1 E1.0
+G1 Z0.6
+G3 X6 Y5 R0.5 E1.5
+G1 X7 Y6 E2.0
+"""
+
+
+def _lines(model):
+    return [
+        (
+            type(line).__name__,
+            line.type,
+            line.line_num,
+            line.line,
+            getattr(line, "coords", None),
+            getattr(line, "style", None),
+            getattr(line, "layer_idx", None),
+            getattr(line, "distance", None),
+            getattr(line, "extrudate", None),
+        )
+        for line in model.segments
+    ]
+
+
+def _layers(model):
+    return [
+        (layer.Z, layer.start, [line.line_num for line in layer.lines], layer.distance, layer.extrudate)
+        for layer in model.layers
+    ]
+
+
+def assert_same_model(model, expected):
+    assert _lines(model) == _lines(expected)
+    assert _layers(model) == _layers(expected)
+    assert vars(model.bbox) == vars(expected.bbox)
+    assert (model.distance, model.extrudate) == (expected.distance, expected.extrudate)
+    assert model.relative == expected.relative
+    assert model.offset == expected.offset
+    assert (model.is_relative, model.relative_extrusion) == (
+        expected.is_relative,
+        expected.relative_extrusion,
+    )
+
+
+def squares(xs, z=0.2):
+    """
+    A layer of 5 mm squares at the given X, printed in that
+    order with absolute E, each closed by a non-extruding move
+    and followed by a wipe
+    """
+    lines = ["G1 Z{} F600".format(z)]
+    e = 0.0
+    for x in xs:
+        lines.append("; square at {}".format(x))
+        lines.append("G1 X{} Y0 F3000".format(x))
+        for dx, dy in [(5, 0), (5, 5), (0, 5), (0, 1)]:
+            e += 0.25
+            lines.append("G1 X{} Y{} E{:.5f} F1200".format(x + dx, dy, e))
+        lines.append("G1 X{} Y0 F1200".format(x))
+        lines.append("G1 X{} Y0 F3000".format(x + 2))
+    return lines
@@ -0,0 +1,57 @@
+import math
+from Gcode_Parser import GcodeParser, Arc
+from line_splitter import convert_to_small_segments
+from print_time import estimate_time
+
+ARCS = [
+    "G1 X10 Y0 Z0.2 F600",
+    "G1 X10 Y0 E1 F600",
+    # half circle of radius 10 around the origin
+    "G3 X-10 Y0 I-10 J0 E2",
+    # full circle back to the same point
+    "G2 X-10 Y0 I10 J0 E3",
+    "G2 X-10 Y0 I10 J0",
+]
+
+
+def _parse(lines):
+    return GcodeParser().parse_lines([line + "\n" for line in lines])
+
+
+def test_split_keeps_arcs_unless_conforming():
+    model = convert_to_small_segments(_parse(ARCS), 1.0)
+    assert sum(isinstance(line, Arc) for line in model.segments) == 3
+    assert [line.line for line in model.layers[-1].lines][-3:] == ARCS[-3:]
+
+    model = convert_to_small_segments(_parse(ARCS), 1.0, arcs=True)
+    lines = [line for layer in model.layers for line in layer.lines]
+    assert not any(isinstance(line, Arc) for line in lines)
+    assert max(line.distance for line in lines[2:]) <= 1.0
+
+
+def test_relative_extrusion_chords_add_up():
+    model = _parse(["M83", "G1 X10 Y0 Z0.2 F600", "G3 X-10 Y0 I-10 J0 E1"])
+    model = convert_to_small_segments(model, 1.0, arcs=True)
+    e = [
+        float(line.line.split(" E")[1].split()[0])
+        for layer in model.layers
+        for line in layer.lines
+        if " E" in line.line
+    ]
+    assert len(e) == math.ceil(10 * math.pi)
+    assert abs(sum(e) - 1.0) < 1e-9
+
+
+def test_full_circles_classified():
+    model = _parse(ARCS)
+    half, full, travel = model.segments[-3:]
+    assert (half.style, full.style, travel.style) == ("extrude", "extrude", "fly")
+    assert full.sweep == -2 * math.pi and abs(half.sweep) == math.pi
+
+
+def test_print_time_follows_arcs():
+    # 10 mm/s along the arcs, plus the accelerations
+    times = estimate_time(_parse(ARCS + ["G1 X-10 Y0 E3 F600"]))
+    assert times["moves"] == 6
+    moving = (10 * math.pi + 20 * math.pi * 2) / 10.0
+    assert moving < times["total"] < moving + 2.0
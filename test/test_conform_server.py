@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+import conform_server
+from conform_server import SurfaceCache
+
+
+def test_surfaces_build_once_outside_the_lock(tmp_path, monkeypatch):
+    paths = []
+    for name in ("a.gcode", "b.gcode"):
+        path = tmp_path / name
+        path.write_text("G1 X1 Y1 Z0.2 E1\n")
+        paths.append(str(path))
+    builds = []
+
+    def load(path, length):
+        builds.append(os.path.basename(path))
+        # the other surface builds while this one is still loading
+        time.sleep(0.5 if path.endswith("a.gcode") else 0.0)
+        return [path]
+
+    monkeypatch.setattr(conform_server, "load_surface_file", load)
+    cache = SurfaceCache()
+    results = {}
+
+    def get(i, path):
+        results[i] = cache.get(path, 1.0)
+
+    threads = [threading.Thread(target=get, args=(i, paths[0])) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    t1 = time.perf_counter()
+    assert cache.get(paths[1], 1.0) == [paths[1]]
+    assert time.perf_counter() - t1 < 0.25
+    for thread in threads:
+        thread.join()
+
+    assert sorted(builds) == ["a.gcode", "b.gcode"]
+    assert all(result == [paths[0]] for result in results.values())
+    assert (cache.hits, cache.misses) == (3, 2)
@@ -0,0 +1,64 @@
+import math
+from Gcode_Parser import GcodeParser, Segment
+from feedrate import schedule_feedrates
+import conform
+
+
+def _moves(path):
+    model = GcodeParser().parse_file(path)
+    return [line for layer in model.layers for line in layer.lines if isinstance(line, Segment)]
+
+
+def test_feedrates_follow_the_slope(tmp_path):
+    rise = 10 * math.tan(math.radians(25))
+    lines = [
+        "G1 X0 Y0 Z0.2 F600",
+        "G1 X10 Y0 E1 F1800",  # flat
+        "G1 X20 Y0 Z{:.4f} E2".format(0.2 + rise),  # 25 degrees, no F of its own
+        "G1 X20 Y1 Z{:.4f} E3".format(10.2 + rise),  # steep
+        "G0 X0 Y0 F6000",  # travel keeps its feedrate
+        "G1 X10 Y0 E4 F3000",  # already flat
+    ]
+    model = GcodeParser().parse_lines([line + "\n" for line in lines])
+    report = schedule_feedrates(model, 3000.0, 1200.0)
+    assert report["moves_changed"] == 3
+    assert report["time_after"] < report["time_before"]
+
+    path = str(tmp_path / "feedrate.gcode")
+    model.write(path)
+    moves = _moves(path)
+    assert [move.coords["F"] for move in moves] == [600.0, 3000.0, 2100.0, 1200.0, 6000.0, 3000.0]
+    with open(path) as f:
+        written = f.read().splitlines()
+    assert written[2].endswith(" F2100.0")
+
+
+def _ramp():
+    # flat up to X10, then rising at 60 degrees
+    slope = math.tan(math.radians(60))
+    lines = []
+    e = 0.0
+    for i in range(41):
+        y = i * 0.5
+        lines.append("G0 X0 Y{} Z2".format(y))
+        for x in range(1, 21):
+            e += 0.1
+            z = 2 + slope * max(x - 10, 0)
+            lines.append("G1 X{} Y{} Z{:.3f} E{:.3f} F1200".format(x, y, z, e))
+    return "\n".join(lines) + "\n"
+
+
+def test_normal_conform_with_feedrate(tmp_path):
+    surface = tmp_path / "ramp.gcode"
+    surface.write_text(_ramp())
+    part = tmp_path / "part.gcode"
+    # -n offsets the moves without splitting them
+    part.write_text(
+        "G1 X1 Y10 Z0.2 F600\nG1 X5 E1 F1800\nG1 X9 E2\nG1 X13 E3\nG1 X17 E4\n"
+    )
+    conform.main(
+        ["-n", "-f", str(part), "-s", str(surface), "--feedrate", "3000", "1200"]
+    )
+    moves = _moves(str(tmp_path / "conformed_1.0_part.gcode"))
+    assert [move.coords["F"] for move in moves[:3]] == [600.0, 3000.0, 3000.0]
+    assert moves[-1].coords["F"] == 1200.0
@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import pytest
+import conform
+from conftest import CONFORM
+from Gcode_Parser import GcodeParser
+from fixed_point import FixedMoves
+
+
+def _extrusion(moves):
+    """
+    Extrusion and 3D length of the extruding moves of moves
+    """
+    n = len(moves)
+    # measured from the last move, whatever G92 rows are in between
+    last = np.maximum.accumulate(np.where(moves.move, np.arange(n), -1))
+    last = np.concatenate([[-1], last[:-1]])
+    start = np.where((last >= 0)[:, None], moves.coords[np.maximum(last, 0)], moves.start)
+    start[:, 3] = np.concatenate([[moves.start[3]], moves.coords[:-1, 3]])
+    delta = moves.coords - start
+    e = np.where(moves.reset, 0, delta[:, 3]) / 1e6
+    length = np.linalg.norm(delta[:, :3], axis=1) / 1e3
+    extruding = moves.move & (e > 0) & (length > 0)
+    return e, length, extruding
+
+
+def test_conform_keeps_extrusion_per_length():
+    model = GcodeParser().parse_file(os.path.join(CONFORM, "Thin_film.gcode"))
+    with open(os.path.join(CONFORM, "pointcloud_1.0_Thin_film.txt")) as f:
+        cloud = f.read().splitlines()
+    moves = FixedMoves(model).split(1.0)
+    e_before, length_before, extruding = _extrusion(moves)
+    moves.conform(cloud, 0.5)
+    e_after, length_after, extruding_after = _extrusion(moves)
+
+    assert (extruding == extruding_after).all()
+    assert (moves.coords[:, 2] > 1.0).any()
+    before = e_before[extruding] / length_before[extruding]
+    after = e_after[extruding] / length_after[extruding]
+    # to the nanometre of E rounding of each move
+    assert np.allclose(after, before, rtol=0, atol=1e-5 / length_after[extruding].min())
+    assert np.isclose(
+        (e_after[extruding] * length_before[extruding] / length_after[extruding]).sum(),
+        e_before[extruding].sum(),
+        rtol=1e-6,
+    )
+
+
+def test_split_keeps_move_ends():
+    model = GcodeParser().parse_file(os.path.join(CONFORM, "Thin_film.gcode"))
+    ends = {id(seg): dict(seg.coords) for seg in model.segments if hasattr(seg, "coords")}
+    moves = FixedMoves(model)
+    for _ in range(3):
+        moves.split(0.37)
+    moves.apply()
+    for seg in model.segments:
+        if id(seg) in ends and seg.type in ("G0", "G1"):
+            for axis in ("X", "Y", "Z", "E"):
+                if axis in ends[id(seg)]:
+                    assert seg.coords[axis] == ends[id(seg)][axis]
+
+
+def test_split_tessellates_arcs_and_keeps_comments(tmp_path):
+    path = tmp_path / "arc.gcode"
+    path.write_text(
+        "G90\nM82\nG92 E0\nG1 X20 Y0 Z0.2 F1200\nG2 X30 Y0 I5 J0 E2.0 ; arc\nG1 X31 Y0 E2.1\n"
+    )
+    model = GcodeParser().parse_file(str(path))
+    FixedMoves(model).split(2.0).apply()
+    lines = [line.line for line in model.segments]
+    assert not any(line.startswith(("G2", "G3")) for line in lines)
+    chords = [seg for seg in model.segments if seg.type == "G1" and 20 < seg.coords["X"] <= 30]
+    assert len(chords) == 8
+    for seg in chords:
+        radius = np.hypot(seg.coords["X"] - 25, seg.coords["Y"])
+        assert abs(radius - 5) < 1e-3
+        assert seg.coords["Y"] >= 0
+    assert chords[-1].line.endswith("; arc")
+    assert chords[-1].coords["E"] == 2.0
+
+
+@pytest.mark.parametrize("option", [["-t", "0.05"], ["-n"]])
+def test_fixed_rejects_options_it_ignores(option, capsys):
+    with pytest.raises(SystemExit):
+        conform.main(["--fixed"] + option)
+    assert "--fixed" in capsys.readouterr().err
@@ -0,0 +1,67 @@
+import io
+import os
+import sys
+import subprocess
+from conftest import CONFORM, MIXED, assert_same_model
+from Gcode_Parser import GcodeParser
+from gcode_binary import decode_lines, encode_lines
+
+# moves written in every style: fast fixed-point, Python's shortest
+# repr of a float, and digits no float gives back
+STYLES = [
+    "G1 X1.5 Y-0.25 Z0.2 F1200",
+    "G1 X2 Y0.30000000000000004 E0.3991354953951585",
+    "G1 X3.0000000000000000001 Y1 E12345678901234567.5",
+    "G0 X-0.000 Y-1",
+    "G1 X1e-05 ; not fixed-point",
+    "G1 Y2 X1",
+]
+
+
+def _round_trip(lines, block_lines):
+    data = b"".join(encode_lines(lines, block_lines))
+    return list(decode_lines(io.BytesIO(data)))
+
+
+def test_lines_round_trip_across_blocks():
+    lines = MIXED.splitlines() * 3 + STYLES * 3
+    for block_lines in (1, 7, 1 << 16):
+        assert _round_trip(lines, block_lines) == lines
+
+
+def _assert_model_round_trip(path, binary):
+    expected = GcodeParser().parse_file(path)
+    expected.write(binary)
+    assert_same_model(GcodeParser().parse_file(binary), expected)
+
+
+def test_model_round_trip(tmp_path):
+    path = str(tmp_path / "mixed.gcode")
+    with open(path, "w") as f:
+        f.write(MIXED * 3 + "\n".join(STYLES) + "\n")
+    _assert_model_round_trip(path, str(tmp_path / "mixed.gcb"))
+
+
+def test_conformed_model_round_trip(tmp_path):
+    path = os.path.join(CONFORM, "conformed_1.0_Thin_film.gcode")
+    binary = str(tmp_path / "conformed.gcb")
+    _assert_model_round_trip(path, binary)
+    assert os.path.getsize(binary) < os.path.getsize(path) / 3
+
+
+def test_text_files_do_not_import_numpy(tmp_path):
+    # only binary files need gcode_binary and numpy
+    script = (
+        "import sys; from Gcode_Parser import GcodeParser; "
+        "GcodeParser().parse_file(sys.argv[1]).write(sys.argv[2]); "
+        "print('numpy' in sys.modules)"
+    )
+    src = os.path.join(os.path.dirname(CONFORM), os.pardir, "src")
+    out = subprocess.run(
+        [sys.executable, "-c", script, os.path.join(CONFORM, "Thin_film.gcode"), str(tmp_path / "out.gcode")],
+        cwd=src,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert out.stdout.strip() == "False"
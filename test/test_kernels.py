@@ -0,0 +1,24 @@
+import os
+import pytest
+from conftest import CONFORM
+from Gcode_Parser import GcodeParser
+from line_splitter import convert_to_small_segments
+from point_cloud import extract_point_array
+from conform_surface import load_surface, increase_z
+
+numba = pytest.importorskip("numba")
+
+
+def test_numba_backend_writes_the_same_bytes(tmp_path):
+    surface = convert_to_small_segments(
+        GcodeParser().parse_file(os.path.join(CONFORM, "Dome.gcode")), 0.5, arcs=True
+    )
+    surface = load_surface(extract_point_array(surface)[0])
+    written = []
+    for backend in ("python", "numba"):
+        part = GcodeParser().parse_file(os.path.join(CONFORM, "Thin_film.gcode"))
+        part = increase_z(part, surface, 1.0, progress=False, backend=backend)
+        path = tmp_path / (backend + ".gcode")
+        part.write(str(path))
+        written.append(path.read_bytes())
+    assert written[0] == written[1]
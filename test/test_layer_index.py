@@ -0,0 +1,52 @@
+import os
+import shutil
+from conftest import CONFORM, MIXED
+from Gcode_Parser import GcodeParser, Segment
+from layer_index import LayerIndex, SUFFIX
+
+
+def _segments(model, first_line=1, stop_line=None):
+    return [
+        (line.line_num, line.line, line.coords, line.style, line.layer_idx)
+        for line in model.segments
+        if isinstance(line, Segment)
+        and line.line_num >= first_line
+        and (stop_line is None or line.line_num < stop_line)
+    ]
+
+
+def _assert_partial_parses_match(path):
+    full = GcodeParser().parse_file(path)
+    index = LayerIndex.open(path)
+    assert os.path.exists(path + SUFFIX)
+    assert len(index) == max(line.layer_idx for line in full.segments if isinstance(line, Segment)) + 1
+    for first, last in [(0, 0), (1, 2), (len(index) // 2, len(index) - 1), (len(index) - 1, None)]:
+        model = GcodeParser().parse_layers(path, first, last, index)
+        stop = index.layers[last + 1]["line"] if last is not None and last + 1 < len(index) else None
+        expected = _segments(full, index.layers[first]["line"], stop)
+        assert expected and _segments(model) == expected
+
+
+def test_partial_parse_matches_full_parse(tmp_path):
+    path = str(tmp_path / "Thin_film.gcode")
+    shutil.copy(os.path.join(CONFORM, "Thin_film.gcode"), path)
+    _assert_partial_parses_match(path)
+
+
+def test_partial_parse_restores_modes(tmp_path):
+    path = str(tmp_path / "mixed.gcode")
+    with open(path, "w") as f:
+        f.write(MIXED * 3)
+    _assert_partial_parses_match(path)
+
+
+def test_index_rebuilt_when_file_changes(tmp_path):
+    path = str(tmp_path / "mixed.gcode")
+    with open(path, "w") as f:
+        f.write(MIXED)
+    layers = len(LayerIndex.open(path))
+    with open(path, "a") as f:
+        f.write(MIXED)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert LayerIndex.load(path) is None
+    assert len(LayerIndex.open(path)) > layers
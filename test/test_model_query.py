@@ -0,0 +1,65 @@
+import os
+from conftest import CONFORM
+from Gcode_Parser import GcodeParser, Segment
+from gcode_edit import set_feedrate
+
+
+def _thin_film():
+    return GcodeParser().parse_file(os.path.join(CONFORM, "Thin_film.gcode"))
+
+
+def _layer_of_each_line(model):
+    layer_idx = model.start_layer[0]
+    for layer in model.layers:
+        for line in layer.lines:
+            if line.layer_idx is not None:
+                layer_idx = line.layer_idx
+            yield layer_idx, line
+
+
+def test_selects_the_same_lines_as_a_loop():
+    model = _thin_film()
+    selected = model.query().styles("extrude").layers(2, 3).region(100, 100, 150, 150)
+    expected = [
+        line
+        for layer_idx, line in _layer_of_each_line(model)
+        if isinstance(line, Segment)
+        and line.style == "extrude"
+        and 2 <= layer_idx <= 3
+        and 100 <= line.coords["X"] <= 150
+        and 100 <= line.coords["Y"] <= 150
+    ]
+    assert expected
+    assert all(a is b for a, b in zip(selected, expected))
+    assert len(selected) == len(expected)
+
+
+def test_delete_and_rewrite_are_written(tmp_path):
+    model = _thin_film()
+    moves = [
+        (line.type, line.coords["X"], line.coords["Y"], line.coords["Z"])
+        for layer in model.layers
+        for line in layer.lines
+        if isinstance(line, Segment)
+    ]
+    travels = model.query().styles("fly").layers(2)
+    count = len(travels)
+    assert count and travels.rewrite(lambda line: set_feedrate(line.line, 1234)) == count
+    removed = (model.query().types(";") | model.query().commands("M")).delete()
+    assert removed
+    # the index follows the deletion, nothing is left to select
+    assert not len(model.query().types(";"))
+
+    path = str(tmp_path / "edited.gcode")
+    model.write(path)
+    with open(path) as f:
+        text = f.read().splitlines()
+    assert not any(line.startswith((";", "M")) for line in text)
+    assert sum(" F1234" in line for line in text) == count
+    written = GcodeParser().parse_file(path)
+    segments = [
+        line for layer in written.layers for line in layer.lines if isinstance(line, Segment)
+    ]
+    assert [
+        (line.type, line.coords["X"], line.coords["Y"], line.coords["Z"]) for line in segments
+    ] == moves
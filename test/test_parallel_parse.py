@@ -0,0 +1,19 @@
+import os
+from conftest import CONFORM, MIXED, assert_same_model
+from Gcode_Parser import GcodeParser
+from parallel_parse import parse_file_parallel
+
+
+def test_parallel_parse_equals_parse_file():
+    path = os.path.join(CONFORM, "Thin_film.gcode")
+    assert_same_model(parse_file_parallel(path, 2), GcodeParser().parse_file(path))
+
+
+def test_parallel_parse_carries_modes_across_chunks(tmp_path):
+    path = str(tmp_path / "mixed.gcode")
+    with open(path, "w") as f:
+        # moves with unknown words are left to the parser, which warns
+        f.write(MIXED * 3 + "G1 X2 S5\nG92\nG1 Y3\n")
+    expected = GcodeParser().parse_file(path)
+    for chunks in (1, 5, 40, 300):
+        assert_same_model(parse_file_parallel(path, 1, chunks), expected)
@@ -0,0 +1,26 @@
+import tracemalloc
+import numpy as np
+from point_cloud import decimate_point_array
+
+
+def _points():
+    rng = np.random.default_rng(0)
+    return rng.random((1000, 3)) * [10.0, 10.0, 2.0]
+
+
+def test_decimate_keeps_the_callers_tracing():
+    tracemalloc.start()
+    try:
+        points, report = decimate_point_array(_points(), 1.0)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    assert len(points) == report["points_out"] == 100
+    assert report["peak_bytes"] > 0
+
+
+def test_decimate_stops_its_own_tracing():
+    assert not tracemalloc.is_tracing()
+    _, report = decimate_point_array(_points(), 1.0)
+    assert not tracemalloc.is_tracing()
+    assert report["peak_bytes"] > 0
@@ -0,0 +1,25 @@
+from conftest import squares
+from Gcode_Parser import GcodeParser
+from line_splitter import convert_to_small_segments
+from print_time import estimate_time
+
+
+def test_split_moves_count_towards_their_layer():
+    lines = squares([0, 10]) + squares([0, 10], 0.4)
+    model = GcodeParser().parse_lines([line + "\n" for line in lines])
+    before = estimate_time(model)
+    model = convert_to_small_segments(model, 1.0)
+    after = estimate_time(model)
+
+    assert after["moves"] > before["moves"]
+    assert set(after["layers"]) <= set(range(len(model.layers)))
+    assert abs(sum(after["layers"].values()) - after["total"]) < 1e-9
+
+
+def test_known_move_times():
+    # 100 mm/s reached after 5 mm at 1000 mm/s², 90 mm at full speed
+    model = GcodeParser().parse_lines(["G1 X100 F6000\n"])
+    assert abs(estimate_time(model, acceleration=1000)["total"] - 1.1) < 1e-9
+    # too short to reach full speed, accelerates for half the move
+    model = GcodeParser().parse_lines(["G1 X4 F6000\n"])
+    assert abs(estimate_time(model, acceleration=1000)["total"] - 2 * (4 / 1000) ** 0.5) < 1e-9
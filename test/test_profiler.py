@@ -0,0 +1,33 @@
+import os
+import json
+import cli
+from conftest import CONFORM
+from profiler import Profiler, profiler as shared
+
+
+def test_nested_stage_keeps_the_outer_peak():
+    profiler = Profiler()
+    profiler.enable(track_allocations=True)
+    try:
+        with profiler.stage("outer"):
+            block = bytearray(8 << 20)
+            del block
+            with profiler.stage("inner"):
+                small = bytearray(1 << 20)
+                del small
+    finally:
+        profiler.disable()
+    stages = profiler.stats()["stages"]
+    assert stages["outer"]["peak_bytes"] >= 8 << 20
+    assert (1 << 20) <= stages["inner"]["peak_bytes"] < 8 << 20
+
+
+def test_profile_memory_switch(capsys):
+    try:
+        cli.stat(["-f", os.path.join(CONFORM, "Thin_film.gcode"), "--profile-memory"])
+    finally:
+        shared.disable()
+        shared.reset()
+    out = capsys.readouterr().out
+    stats = json.loads(out[out.index("{\n"):])
+    assert stats["stages"]["parse"]["peak_bytes"] > 0
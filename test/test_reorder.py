@@ -0,0 +1,66 @@
+from collections import Counter
+import pytest
+from conftest import squares
+from Gcode_Parser import GcodeParser, Segment
+from reorder import reorder_islands
+
+
+def _parse(lines):
+    parser = GcodeParser()
+    return parser.parse_lines([line + "\n" for line in lines])
+
+
+def _deltas(segments):
+    """
+    E moved by each move from the one before, by id
+    """
+    deltas = {}
+    e = 0.0
+    for line in segments:
+        if isinstance(line, Segment):
+            if line.type not in ("G92", "G28"):
+                deltas[id(line)] = line.coords["E"] - e
+            e = line.coords["E"]
+    return deltas
+
+
+def test_reorder_keeps_lines_and_extrusion(tmp_path):
+    model = _parse(squares([0, 40, 10, 30, 20]) + squares([0, 40, 10, 30, 20], 0.4))
+    lines = list(model.segments)
+    texts = Counter(line.line.split(" E")[0] for line in lines)
+    deltas = _deltas(lines)
+
+    report = reorder_islands(model)
+    assert report["layers_reordered"] == 2
+    assert report["travel_after"] < report["travel_before"]
+    assert report["time_after"] < report["time_before"]
+
+    # every line is kept, only the E of the moved islands is rewritten
+    assert sorted(map(id, model.segments)) == sorted(map(id, lines))
+    assert Counter(line.line.split(" E")[0] for line in model.segments) == texts
+    new = _deltas(model.segments)
+    assert all(abs(new[key] - delta) < 1e-9 for key, delta in deltas.items())
+
+    # the close and wipe moves still follow their square
+    order = [line.line for line in model.segments]
+    for x in [0, 40, 10, 30, 20]:
+        i = order.index("G1 X{} Y0 F1200".format(x))
+        assert order[i - 1].startswith("G1 X{} Y1 E".format(x))
+        assert order[i + 1] == "G1 X{} Y0 F3000".format(x + 2)
+
+    # and the written E parses back the same
+    path = str(tmp_path / "reordered.gcode")
+    model.write(path)
+    written = GcodeParser().parse_file(path)
+    assert [line.line for line in written.segments] == order
+    assert [line.coords["E"] for line in written.segments if isinstance(line, Segment)] == [
+        line.coords["E"] for line in model.segments if isinstance(line, Segment)
+    ]
+
+
+def test_rejects_relative_extrusion_part_way():
+    lines = squares([0, 40, 10]) + ["M83"] + squares([0, 40, 10], 0.4) + ["M82"]
+    model = _parse(lines)
+    assert not model.relative_extrusion
+    with pytest.raises(ValueError):
+        reorder_islands(model)
@@ -0,0 +1,63 @@
+import pytest
+import conform
+from Gcode_Parser import GcodeParser, Segment
+from simplify import merge_collinear
+
+
+def _parse(lines):
+    return GcodeParser().parse_lines([line + "\n" for line in lines])
+
+
+def _line(x, y, e):
+    return "G1 X{} Y{} Z0.2 E{} F1200".format(x, y, e)
+
+
+def _ends(model):
+    return [
+        (line.coords["X"], line.coords["Y"], line.coords["Z"], line.coords["E"])
+        for layer in model.layers
+        for line in layer.lines
+        if isinstance(line, Segment)
+    ][-1]
+
+
+def test_merges_full_moves_and_reparses_the_same(tmp_path):
+    lines = ["G1 Z0.2 F600"] + [_line(x, 0, x * 0.1) for x in range(1, 11)] + [_line(10, 5, 1.5)]
+    model = _parse(lines)
+    end = _ends(model)
+    report = merge_collinear(model)
+    assert report["lines_after"] == report["lines_before"] - 8
+
+    path = str(tmp_path / "merged.gcode")
+    model.write(path)
+    assert _ends(GcodeParser().parse_file(path)) == end
+
+
+def test_keeps_moves_without_their_whole_position():
+    # Y and Z only come from the first move, dropping it would move the rest
+    lines = ["G1 X0 Y5 Z0.2 F1200"] + ["G1 X{} E{}".format(x, x * 0.1) for x in range(1, 11)]
+    report = merge_collinear(_parse(lines))
+    assert report["lines_after"] == report["lines_before"]
+
+
+def test_rejects_relative_extrusion_anywhere(tmp_path, capsys):
+    # relative extrusion part way through, back to absolute by the end
+    lines = (
+        ["G1 Z0.2 F600", "M83"]
+        + [_line(x, 0, 0.1) for x in range(1, 11)]
+        + ["M82", "G92 E0"]
+        + [_line(x, 5, x * 0.1) for x in range(1, 11)]
+    )
+    model = _parse(lines)
+    assert not model.relative_extrusion
+    with pytest.raises(ValueError):
+        merge_collinear(model)
+
+    part = tmp_path / "part.gcode"
+    part.write_text("\n".join(lines) + "\n")
+    surface = tmp_path / "surface.gcode"
+    surface.write_text("G1 X0 Y0 Z2 F1200\nG1 X20 Y0 E1\nG1 X20 Y20 E2\nG1 X0 Y20 E3\n")
+    with pytest.raises(SystemExit):
+        conform.main(["-m", "0.01", "-f", str(part), "-s", str(surface)])
+    assert "G91 or M83" in capsys.readouterr().err
+    assert not list(tmp_path.glob("conformed_*"))
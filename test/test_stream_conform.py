@@ -0,0 +1,50 @@
+import os
+import asyncio
+import pytest
+from conftest import CONFORM
+from Gcode_Parser import GcodeParser
+from conform_surface import increase_z, load_surface_file
+from line_splitter import convert_to_small_segments
+from stream_conform import conform_lines, file_source
+
+PART = os.path.join(CONFORM, "Thin_film.gcode")
+
+
+def _stream(surface, chunk_size):
+    async def collect():
+        return [line async for line in conform_lines(file_source(PART, chunk_size), surface, 1.0)]
+
+    return asyncio.run(collect())
+
+
+def _batch(surface, path):
+    model = GcodeParser().parse_file(PART)
+    if surface is None:
+        model = convert_to_small_segments(model, 1.0, arcs=True)
+    else:
+        model = increase_z(model, surface, 1.0, progress=False)
+    model.write(path)
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+@pytest.mark.parametrize("conform", [False, True])
+def test_stream_matches_batch(conform, tmp_path):
+    surface = None
+    if conform:
+        surface = load_surface_file(os.path.join(CONFORM, "pointcloud_1.0_Thin_film.txt"), 1.0)
+    with open(PART) as f:
+        text = f.read()
+    first_layer = text.index("; layer 2") - text.index("; layer 1")
+    # small chunks end part way through lines and split the layers across reads
+    chunk_size = 97
+    assert first_layer > 2 * chunk_size
+    streamed = _stream(surface, chunk_size)
+    batch = _batch(surface, str(tmp_path / "batch.gcode"))
+    assert len(streamed) == len(batch)
+    # the batch path splits the last retract into G92 lines after G28
+    # changes the parser state it shares, which the stream copies
+    end = next(idx for idx, line in enumerate(batch) if line.startswith("G92 X"))
+    assert end > len(batch) - 200
+    assert streamed[:end] == batch[:end]
+    assert not any(line.startswith("G92 X") for line in streamed)
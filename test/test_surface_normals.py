@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from Gcode_Parser import GcodeParser, Segment
+from surface_normals import NormalField, offset_normals
+import conform
+
+
+def _plateau(height=2.0, size=20.0):
+    xs, ys = np.meshgrid(np.arange(0, size, 0.25), np.arange(0, size, 0.25))
+    return np.column_stack([xs.ravel(), ys.ravel(), np.full(xs.size, height)])
+
+
+def test_travel_moves_clear_the_surface():
+    field = NormalField.build(_plateau(), 0.5)
+    lines = [
+        "G1 X2 Y2 Z0.2 F1200",
+        "G1 X6 Y2 E1 F1200",
+        "G0 X6 Y8 F3000",
+        "G1 X2 Y8 E2 F1200",
+    ]
+    model = GcodeParser().parse_lines([line + "\n" for line in lines])
+    model = offset_normals(model, field, 1.0)
+    moves = [line for layer in model.layers for line in layer.lines if isinstance(line, Segment)]
+    assert {line.type for line in moves} == {"G0", "G1"}
+    assert all(line.coords["Z"] > 2.0 for line in moves)
+    assert all(" Z{}".format(line.coords["Z"]) in line.line for line in moves)
+    # travel does not extrude
+    assert all(" E" not in line.line for line in moves if line.type == "G0")
+
+
+@pytest.mark.parametrize("option", [["-t", "0.05"], ["--tiles", "tiles"]])
+def test_normal_rejects_options_it_ignores(option, capsys):
+    with pytest.raises(SystemExit):
+        conform.main(["-n"] + option)
+    assert "-n/--normal" in capsys.readouterr().err
+
+
+RELATIVE = ["G1 X2 Y2 Z0.2 F1200", "M83", "G1 X6 Y2 E1", "M82", "G92 E0", "G1 X6 Y8 E1"]
+
+
+def test_relative_input_is_rejected(tmp_path, capsys):
+    field = NormalField.build(_plateau(), 0.5)
+    model = GcodeParser().parse_lines([line + "\n" for line in RELATIVE])
+    with pytest.raises(ValueError):
+        offset_normals(model, field, 1.0)
+
+    part = tmp_path / "part.gcode"
+    part.write_text("\n".join(RELATIVE) + "\n")
+    surface = tmp_path / "surface.gcode"
+    surface.write_text("G1 X0 Y0 Z2 F1200\nG1 X20 Y0 E1\nG1 X20 Y20 E2\nG1 X0 Y20 E3\n")
+    with pytest.raises(SystemExit):
+        conform.main(["-n", "-f", str(part), "-s", str(surface)])
+    assert "G91 or M83" in capsys.readouterr().err
+    assert not list(tmp_path.glob("conformed_*"))